@@ -0,0 +1,230 @@
+"""
+CPU execution autotuner of the trained sequence labeling model run this file by
+
+```
+    >>> python autotune.py
+    >>> python autotune.py --model-location trained/RNNHidden.pt --max-p99-ms 20
+    >>> python autotune.py --threads 1 2 4 --interop-threads 1 --batch-sizes 16 64
+```
+Every combination of torch intra op threads, inter op threads and batch size
+runs the model over test batches and is measured for throughput and p50/p99
+batch latency. Inter op threads can only be set once per process, so every
+inter op value is measured in a fresh process. The fastest combination, or
+the fastest within --max-p99-ms, is saved as the CPU profile of the model on
+this host and its threads are applied by train.py.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import platform
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from config.hyperparameters import BATCH_SIZE
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    SEED,
+    TRAINED_CLASSIFIER_FOLDER,
+    TRAINED_CLASSIFIER_RNNHIDDEN,
+    device,
+    seed_all,
+)
+from cpuprofile import host_name, model_name, save_profile
+from datasetloader import GrammarDasetAnswerKey
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Batches run before the latency is measured
+WARMUP_BATCHES = 5
+
+
+def thread_candidates():
+    """Powers of two up to the core count and the core count itself"""
+    cores = os.cpu_count() or 1
+    return sorted({2 ** power for power in range(cores.bit_length())} | {cores})
+
+
+def timed_batches(iterator, batch_size, n_batches):
+    """Warm up batches followed by n_batches timed test batches"""
+    # The iterator batches its examples again with this size on every pass
+    iterator.batch_size = batch_size
+    batches = []
+    while len(batches) < WARMUP_BATCHES + n_batches:
+        batches.extend(iterator)
+    return batches[: WARMUP_BATCHES + n_batches]
+
+
+def measure(model_location, interop_threads, config):
+    """
+    Throughput and latency of every thread count and batch size with the given
+    inter op threads, runs in a fresh process started by autotune
+    Output:
+        rows: list -> Dict of the measurements of every combination
+    """
+    torch.set_num_interop_threads(interop_threads)
+    seed_all(SEED)
+
+    dataset = GrammarDasetAnswerKey.get_iterators(BATCH_SIZE)
+    model = torch.load(model_location, map_location=device)
+    model.eval()
+
+    rows = []
+    for batch_size in config["batch_sizes"]:
+        batches = timed_batches(dataset.test_iterator, batch_size, config["batches"])
+        for threads in config["threads"]:
+            torch.set_num_threads(threads)
+
+            timings = []
+            records = 0
+            with torch.no_grad():
+                for index, batch in enumerate(batches):
+                    text, text_lengths = batch.answer
+                    start_time = time.perf_counter()
+                    model(text, text_lengths)
+                    if index >= WARMUP_BATCHES:
+                        timings.append(time.perf_counter() - start_time)
+                        records += batch.batch_size
+
+            rows.append(
+                {
+                    "threads": threads,
+                    "interop_threads": interop_threads,
+                    "batch_size": batch_size,
+                    "records_per_second": records / sum(timings),
+                    "p50_ms": 1000 * float(np.percentile(timings, 50)),
+                    "p99_ms": 1000 * float(np.percentile(timings, 99)),
+                }
+            )
+            logger.debug(rows[-1])
+
+    return rows
+
+
+def autotune(args):
+    """Measure every inter op value in its own process one after another"""
+    config = {
+        "threads": args.threads,
+        "batch_sizes": args.batch_sizes,
+        "batches": args.batches,
+    }
+
+    rows = []
+    for interop_threads in args.interop_threads:
+        logger.info("Measuring with {} inter op threads".format(interop_threads))
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            rows += executor.submit(
+                measure, args.model_location, interop_threads, config
+            ).result()
+    return rows
+
+
+def best_configuration(rows, max_p99_ms=None):
+    """Highest throughput within the p99 budget, the lowest p99 if none is"""
+    candidates = [
+        row for row in rows if max_p99_ms is None or row["p99_ms"] <= max_p99_ms
+    ]
+    if not candidates:
+        logger.warning(
+            "No configuration has a p99 of at most {}ms, using the lowest".format(
+                max_p99_ms
+            )
+        )
+        return min(rows, key=lambda row: row["p99_ms"])
+    return max(candidates, key=lambda row: row["records_per_second"])
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to tune the threads and batch size of the trained model"
+    )
+
+    parser.add_argument(
+        "-loc",
+        "--model-location",
+        default=os.path.join(TRAINED_CLASSIFIER_FOLDER, TRAINED_CLASSIFIER_RNNHIDDEN),
+        help="Location of the trained model",
+    )
+    parser.add_argument(
+        "--threads",
+        default=thread_candidates(),
+        nargs="+",
+        help="Intra op thread counts to try",
+        type=int,
+    )
+    parser.add_argument(
+        "--interop-threads",
+        default=thread_candidates(),
+        nargs="+",
+        help="Inter op thread counts to try, each is measured in its own process",
+        type=int,
+    )
+    parser.add_argument(
+        "--batch-sizes",
+        default=sorted({1, 16, BATCH_SIZE, 256}),
+        nargs="+",
+        help="Batch sizes to try",
+        type=int,
+    )
+    parser.add_argument(
+        "-n", "--batches", default=30, help="Timed batches per case", type=int
+    )
+    parser.add_argument(
+        "--max-p99-ms",
+        default=None,
+        help="Latency budget of a batch, the fastest case within it is kept",
+        type=float,
+    )
+
+    args = parser.parse_args()
+
+    rows = autotune(args)
+    best = best_configuration(rows, args.max_p99_ms)
+
+    print(
+        "{:>8}{:>8}{:>8}{:>12}{:>10}{:>10}".format(
+            "Threads", "Interop", "Batch", "Records/s", "p50 ms", "p99 ms"
+        )
+    )
+    for row in rows:
+        print(
+            "{:>8}{:>8}{:>8}{:>12.1f}{:>10.3f}{:>10.3f}{}".format(
+                row["threads"],
+                row["interop_threads"],
+                row["batch_size"],
+                row["records_per_second"],
+                row["p50_ms"],
+                row["p99_ms"],
+                "  *" if row is best else "",
+            )
+        )
+
+    profile = dict(
+        {
+            "model": model_name(args.model_location),
+            "host": host_name(),
+            "cpu_count": os.cpu_count(),
+            "processor": platform.processor(),
+            "torch": torch.__version__,
+            "max_p99_ms": args.max_p99_ms,
+        },
+        **best,
+        results=rows,
+    )
+    logger.info("Saved the CPU profile to {}".format(save_profile(profile)))
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
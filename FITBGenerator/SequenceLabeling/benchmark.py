@@ -0,0 +1,160 @@
+"""
+Micro benchmarks of the sequence labeling model run this file by
+
+```
+    >>> python benchmark.py sparse
+    >>> python benchmark.py --threads 1 sparse --vocab-sizes 10000 40000
+```
+sparse times a training step of RNNHiddenClassifier with unfrozen embeddings
+of several vocabulary sizes on the train batches, trained by dense Adam
+against sparse gradients and SparseAdam.
+"""
+
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+
+from config.hyperparameters import (
+    BATCH_SIZE,
+    BIDIRECTION,
+    DROPOUT,
+    EMBEDDING_DIM,
+    HIDDEN_DIM,
+    LR,
+    MAX_VOCAB,
+    N_LAYERS,
+    WEIGHT_DECAY,
+)
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL, SEED, seed_all
+from datasetloader import GrammarDasetAnswerKey
+from helperfunctions import get_mask_key_from_batch
+from lossfunction import BCEWithLogitLossWithMask
+from model import RNNHiddenClassifier
+from sparseoptimizer import build_optimizer
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Calls run before the latency is measured
+WARMUP_RUNS = 10
+
+
+def dataset_batches(iterator, n_batches):
+    """Warm up batches followed by n_batches timed batches"""
+    batches = []
+    while len(batches) < WARMUP_RUNS + n_batches:
+        batches.extend(iterator)
+    return batches[: WARMUP_RUNS + n_batches]
+
+
+def benchmark_sparse(args):
+    dataset = GrammarDasetAnswerKey.get_iterators(args.batch_size)
+    vocab = dataset.answer.vocab
+
+    batches = dataset_batches(dataset.train_iterator, args.batches)
+    distinct = np.mean(
+        [len(torch.unique(batch.answer[0])) for batch in batches[WARMUP_RUNS:]]
+    )
+    print(
+        "Batches of {} touch {:.0f} distinct tokens".format(args.batch_size, distinct)
+    )
+
+    criterion = BCEWithLogitLossWithMask()
+
+    def training_ms(vocab_size, sparse):
+        seed_all(SEED)
+        # Bigger table than the dataset vocabulary, batches only use its first rows
+        model = RNNHiddenClassifier(
+            max(vocab_size, len(vocab)),
+            EMBEDDING_DIM,
+            HIDDEN_DIM,
+            1,
+            N_LAYERS,
+            BIDIRECTION,
+            DROPOUT,
+            vocab.stoi[dataset.answer.pad_token],
+        )
+        model.embedding.sparse = sparse
+        model.train()
+        optimizer = build_optimizer(model, LR, WEIGHT_DECAY)
+
+        timings = []
+        for index, batch in enumerate(batches):
+            text, text_lengths = batch.answer
+            mask, key = get_mask_key_from_batch(
+                batch, text, text.shape[1], text_lengths
+            )
+            start_time = time.perf_counter()
+            optimizer.zero_grad()
+            criterion(model(text, text_lengths), key, mask).backward()
+            optimizer.step()
+            if index >= WARMUP_RUNS:
+                timings.append(1000 * (time.perf_counter() - start_time))
+        return float(np.percentile(timings, 50))
+
+    print("{:>8}{:>12}{:>12}{:>10}".format("Vocab", "Dense ms", "Sparse ms", "Speedup"))
+    for vocab_size in args.vocab_sizes:
+        dense_ms = training_ms(vocab_size, False)
+        sparse_ms = training_ms(vocab_size, True)
+        print(
+            "{:>8}{:>12.3f}{:>12.3f}{:>9.2f}x".format(
+                vocab_size, dense_ms, sparse_ms, dense_ms / sparse_ms
+            )
+        )
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to benchmark the sequence labeling model"
+    )
+    parser.add_argument(
+        "-th",
+        "--threads",
+        default=None,
+        help="Torch threads, defaults to the torch default",
+        type=int,
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    sparse_parser = subparsers.add_parser(
+        "sparse", help="Training step with sparse embedding gradients against dense"
+    )
+    sparse_parser.add_argument(
+        "--vocab-sizes",
+        default=[MAX_VOCAB, 4 * MAX_VOCAB],
+        nargs="+",
+        help="Rows of the trained embedding table",
+        type=int,
+    )
+    sparse_parser.add_argument(
+        "-batch",
+        "--batch-size",
+        default=BATCH_SIZE,
+        help="Batch size of the train batches",
+        type=int,
+    )
+    sparse_parser.add_argument(
+        "-n", "--batches", default=50, help="Timed batches per case", type=int
+    )
+    sparse_parser.set_defaults(function=benchmark_sparse)
+
+    args = parser.parse_args()
+
+    seed_all(SEED)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    logger.debug("Benchmarking with {} threads".format(torch.get_num_threads()))
+
+    args.function(args)
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
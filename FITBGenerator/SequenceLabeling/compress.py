@@ -0,0 +1,192 @@
+"""
+Product quantization of the embedding table of the trained sequence labeling
+model run this file by
+
+```
+    >>> python compress.py --model-location trained/RNNHidden.pt
+    >>> python compress.py -loc trained/RNNHidden.pt --subvectors 30
+```
+Every row of the embedding table is split into --subvectors parts and each
+part is replaced by the uint8 code of its nearest k-means centroid, see
+model.PQEmbedding. The compressed model is saved as <model>.pq.pt and both
+models are compared on the test split for loss, accuracy, F1 and serialized
+size, together with the relative squared error of the reconstructed table.
+"""
+
+import argparse
+import copy
+import io
+import json
+import logging
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from config.hyperparameters import (
+    BATCH_SIZE,
+    PQ_CENTROIDS,
+    PQ_ITERATIONS,
+    PQ_SUBVECTORS,
+)
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    TRAINED_CLASSIFIER_FOLDER,
+    TRAINED_CLASSIFIER_RNNHIDDEN,
+    device,
+)
+from datasetloader import GrammarDasetAnswerKey
+from helperfunctions import evaluate
+from lossfunction import BCEWithLogitLossWithMask
+from model import PQEmbedding
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+METRICS = ["loss", "accuracy", "f1", "precision", "recall"]
+
+
+def compress(model, n_subvectors, n_centroids=PQ_CENTROIDS, iterations=PQ_ITERATIONS):
+    """PQEmbedding copy of the model, the float model is left untouched"""
+    model = copy.deepcopy(model)
+    model.embedding = PQEmbedding.from_embedding(
+        model.embedding, n_subvectors, n_centroids, iterations
+    ).to(model.embedding.weight.device)
+    return model
+
+
+def model_size(model):
+    """Size in bytes of the serialized weights"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def reconstruction_error(model, compressed_model):
+    """Squared error of the compressed table relative to the float one"""
+    with torch.no_grad():
+        weight = model.embedding.weight.float()
+        error = (compressed_model.embedding.weight - weight).pow(2).sum()
+        return (error / weight.pow(2).sum()).item()
+
+
+def report(model, iterator, criterion):
+    result = dict(zip(METRICS, evaluate(model, iterator, criterion)))
+    result["size_mb"] = model_size(model) / 2 ** 20
+    result["embedding_mb"] = model_size(model.embedding) / 2 ** 20
+    return result
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to product quantize the embeddings of a trained model"
+    )
+
+    parser.add_argument(
+        "-loc",
+        "--model-location",
+        default=os.path.join(TRAINED_CLASSIFIER_FOLDER, TRAINED_CLASSIFIER_RNNHIDDEN),
+        help="Location of the trained model",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Location of the compressed model, defaults to <model>.pq.pt",
+    )
+    parser.add_argument(
+        "-s",
+        "--subvectors",
+        default=PQ_SUBVECTORS,
+        help="Number of parts every embedding row is split into",
+        type=int,
+    )
+    parser.add_argument(
+        "-c",
+        "--centroids",
+        default=PQ_CENTROIDS,
+        help="Centroids of the codebook of every part, at most 256",
+        type=int,
+    )
+    parser.add_argument(
+        "-i",
+        "--iterations",
+        default=PQ_ITERATIONS,
+        help="K-means iterations of every codebook",
+        type=int,
+    )
+    parser.add_argument(
+        "-batch",
+        "--batch_size",
+        default=BATCH_SIZE,
+        help="Batch size of the evaluation",
+        type=int,
+    )
+    parser.add_argument(
+        "-r", "--report", default=None, help="Also write the report to a json file"
+    )
+
+    args = parser.parse_args()
+
+    model = torch.load(args.model_location, map_location=device)
+    model.eval()
+
+    compressed_model = compress(
+        model, args.subvectors, args.centroids, args.iterations
+    )
+
+    output = args.output or "{}.pq.pt".format(
+        os.path.splitext(args.model_location)[0]
+    )
+    torch.save(compressed_model, output)
+    logger.info("Saved compressed model to {}".format(output))
+
+    dataset = GrammarDasetAnswerKey.get_iterators(args.batch_size)
+    criterion = BCEWithLogitLossWithMask().to(device)
+
+    results = {
+        name: report(candidate, dataset.test_iterator, criterion)
+        for name, candidate in (("float", model), ("pq", compressed_model))
+    }
+    results["delta"] = {
+        key: results["pq"][key] - results["float"][key] for key in results["float"]
+    }
+    error = reconstruction_error(model, compressed_model)
+
+    print(
+        "{:<8}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+            "", "Loss", "Acc", "F1", "Size MB", "Emb MB"
+        )
+    )
+    for name, result in results.items():
+        print(
+            "{:<8}{:>10.4f}{:>10.4f}{:>10.4f}{:>10.2f}{:>10.2f}".format(
+                name,
+                result["loss"],
+                result["accuracy"],
+                result["f1"],
+                result["size_mb"],
+                result["embedding_mb"],
+            )
+        )
+    print("Relative reconstruction error of the embeddings: {:.4f}".format(error))
+
+    if args.report:
+        results["reconstruction_error"] = error
+        results["pq_embedding"] = {
+            "n_subvectors": args.subvectors,
+            "n_centroids": args.centroids,
+            "iterations": args.iterations,
+        }
+        with open(args.report, "w") as report_file:
+            json.dump(results, report_file, indent=2)
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
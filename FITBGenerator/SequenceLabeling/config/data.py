@@ -21,3 +21,8 @@ PROCESSED_DATASET = {
 }
 
 TEMP_DIR = ".temp"
+
+# Built once and shared by every project, override with the GLOVE_STORE variable
+GLOVE_STORE_FOLDER = os.environ.get(
+    "GLOVE_STORE", os.path.join(os.path.expanduser("~"), ".cache", "glove_store")
+)
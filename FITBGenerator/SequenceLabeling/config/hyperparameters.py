@@ -13,7 +13,22 @@ DROPOUT = 0.7
 LR = 0.001
 EPOCHS = 5
 FREEZE_EMBEDDINGS = 1
+# Unfrozen embeddings get sparse gradients and are trained by SparseAdam
+SPARSE_EMBEDDINGS = 0
 WEIGHT_DECAY = 0.001
 CNN_FILTER_SIZES = [1, 3, 5]
 CNN_N_FILTER = 64
 LINEAR_HIDDEN_DIM = 128
+# Training stops after PATIENCE epochs without a validation loss improvement
+# of MIN_DELTA, the learning rate is multiplied by LR_FACTOR after LR_PATIENCE
+PATIENCE = 3
+LR_PATIENCE = 1
+LR_FACTOR = 0.5
+MIN_LR = 1e-6
+MIN_DELTA = 1e-4
+# Product quantization of the embedding table by compress.py, every row is
+# split into PQ_SUBVECTORS parts stored as uint8 codes into codebooks of
+# PQ_CENTROIDS centroids learned in PQ_ITERATIONS k-means iterations
+PQ_SUBVECTORS = 50
+PQ_CENTROIDS = 256
+PQ_ITERATIONS = 20
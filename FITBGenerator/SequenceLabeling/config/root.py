@@ -17,6 +17,9 @@ LOGGING_FORMAT = (
 
 SEED = 1234
 
+SPACY_MODEL = "en"
+TOKENIZER_BATCH_SIZE = 1000
+
 
 def seed_all(seed):
     """Seed the results for duplication"""
@@ -30,3 +33,12 @@ def seed_all(seed):
 
 TRAINED_CLASSIFIER_FOLDER = "trained"
 TRAINED_CLASSIFIER_RNNHIDDEN = "RNNHidden.pt"
+
+# Exported TorchScript and ONNX graphs
+EXPORTED_CLASSIFIER_FOLDER = "exported"
+ONNX_OPSET_VERSION = 11
+
+# CPU execution profiles written by autotune.py, one per model and host, the
+# trainer applies the profile of its model when it exists
+AUTOTUNE_FOLDER = os.path.join(TRAINED_CLASSIFIER_FOLDER, "autotune")
+AUTOTUNE_AUTOLOAD = True
@@ -2,6 +2,7 @@
 Load Dataset
 """
 
+import csv
 import logging
 import os
 
@@ -19,6 +20,7 @@ from config.data import (
 )
 from config.hyperparameters import BATCH_SIZE, MAX_VOCAB
 from config.root import LOGGING_FORMAT, LOGGING_LEVEL, device
+from glovestore import glove_store
 from utility import tokenizer, isin
 
 # Initialize logger for this file
@@ -26,6 +28,30 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
 
 
+def pretokenize(fields):
+    """
+    Tokenize every column read by the tokenizer fields in one batched pass
+    over the processed splits, so TabularDataset only does memoized lookups
+    and the next run finds all of them in the on disk token cache
+    """
+    columns = [
+        index
+        for index, (_, field) in enumerate(fields)
+        if getattr(field, "tokenize", None) is tokenizer
+    ]
+
+    texts = []
+    for split in ("train", "test"):
+        with open(PROCESSED_DATASET[split], encoding="utf8") as dataset_file:
+            reader = csv.reader(dataset_file, delimiter="\t")
+            next(reader)
+            for row in reader:
+                texts.extend(row[index] for index in columns)
+
+    logger.debug("Tokenized {} uncached texts".format(tokenizer.pipe(texts)))
+    tokenizer.save()
+
+
 class GrammarDasetAnswerKey:
     def __init__(self):
 
@@ -62,6 +88,8 @@ class GrammarDasetAnswerKey:
                 "Please run the preprocessdata.py first by executing python preprocessdata.py"
             )
 
+        pretokenize(grammar_dataset.fields)
+
         grammar_dataset.trainset, grammar_dataset.testset = data.TabularDataset.splits(
             path=os.path.join(DATASET_FOLDER, PROCESSED_DATASET_FOLDER),
             train=PROCESSED_DATASET_TRAIN_FILENAME,
@@ -74,10 +102,10 @@ class GrammarDasetAnswerKey:
         logger.debug("Data Loaded Successfully!")
 
         grammar_dataset.answer.build_vocab(
-            grammar_dataset.trainset,
-            max_size=MAX_VOCAB,
-            vectors="glove.6B.300d",
-            unk_init=torch.Tensor.normal_,
+            grammar_dataset.trainset, max_size=MAX_VOCAB
+        )
+        glove_store("glove.6B.300d").load_vectors(
+            grammar_dataset.answer.vocab, unk_init=torch.Tensor.normal_
         )
 
         grammar_dataset.key.vocab = grammar_dataset.answer.vocab
@@ -0,0 +1,210 @@
+"""
+Export the trained sequence labeling model to TorchScript and ONNX run this
+file by
+
+```
+    >>> python export.py --model-location trained/RNNHidden.pt
+    >>> python export.py -loc trained/RNNHidden.pt --check
+```
+Both graphs take the padded answer [batch, sequence] and its lengths with
+dynamic batch and sequence axes and return the per token outputs, so they can
+be served by the TorchScript runtime or ONNX Runtime without importing the
+training code. --check compares them with the eager model on inputs of other
+shapes than the traced one.
+"""
+
+import argparse
+import inspect
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+
+from config.root import (
+    EXPORTED_CLASSIFIER_FOLDER,
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    ONNX_OPSET_VERSION,
+    TRAINED_CLASSIFIER_FOLDER,
+    TRAINED_CLASSIFIER_RNNHIDDEN,
+)
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Newer torch defaults to the dynamo exporter, the TorchScript based one is
+# the exporter that understands packed sequences
+ONNX_EXPORTER_ARGUMENTS = (
+    {"dynamo": False}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters
+    else {}
+)
+
+# Batch and sequence length of the traced inputs and of the parity checks
+TRACE_SHAPE = (4, 12)
+CHECK_SHAPES = [(1, 5), (3, 20), (16, 37)]
+
+INPUT_NAMES = ["text", "text_lengths"]
+DYNAMIC_AXES = {
+    "text": {0: "batch", 1: "sequence"},
+    "text_lengths": {0: "batch"},
+    "predictions": {0: "batch", 1: "sequence"},
+}
+
+
+def example_inputs(model, batch_size, seq_len):
+    """
+    Random padded inputs of the model, the lengths are decreasing and the
+    longest one fills the sequence like the batches of the iterators
+    """
+    vocab_size = model.embedding.num_embeddings
+    pad_idx = model.embedding.padding_idx
+
+    lengths = torch.randint(1, seq_len + 1, (batch_size,))
+    lengths[0] = seq_len
+    lengths, _ = lengths.sort(descending=True)
+
+    text = torch.randint(2, vocab_size, (batch_size, seq_len))
+    text[torch.arange(seq_len).unsqueeze(0) >= lengths.unsqueeze(1)] = pad_idx
+
+    return text, lengths
+
+
+def export_torchscript(model, inputs, location):
+    traced = torch.jit.trace(model, inputs)
+    traced.save(location)
+    logger.info("Saved TorchScript graph to {}".format(location))
+
+
+def export_onnx(model, inputs, location, opset_version=ONNX_OPSET_VERSION):
+    torch.onnx.export(
+        model,
+        inputs,
+        location,
+        input_names=INPUT_NAMES,
+        output_names=["predictions"],
+        dynamic_axes=DYNAMIC_AXES,
+        opset_version=opset_version,
+        **ONNX_EXPORTER_ARGUMENTS,
+    )
+    logger.info("Saved ONNX graph to {}".format(location))
+
+
+def check_parity(model, torchscript_location, onnx_location, tolerance):
+    """
+    Returns the largest absolute difference of the exported graphs to the
+    eager model over CHECK_SHAPES, ONNX is skipped without onnxruntime
+    """
+    torchscript_model = torch.jit.load(torchscript_location)
+
+    session = None
+    if onnxruntime is None:
+        logger.warning("onnxruntime is not installed, skipping the ONNX check")
+    else:
+        session = onnxruntime.InferenceSession(
+            onnx_location, providers=["CPUExecutionProvider"]
+        )
+
+    differences = {"torchscript": 0.0, "onnx": 0.0}
+    with torch.no_grad():
+        for batch_size, seq_len in CHECK_SHAPES:
+            inputs = example_inputs(model, batch_size, seq_len)
+            expected = model(*inputs).numpy()
+
+            differences["torchscript"] = max(
+                differences["torchscript"],
+                float(np.abs(torchscript_model(*inputs).numpy() - expected).max()),
+            )
+
+            if session is not None:
+                feed = {
+                    name: value.numpy() for name, value in zip(INPUT_NAMES, inputs)
+                }
+                differences["onnx"] = max(
+                    differences["onnx"],
+                    float(np.abs(session.run(None, feed)[0] - expected).max()),
+                )
+
+    for runtime, difference in differences.items():
+        logger.info(
+            "{} max abs difference {:.2e} ({})".format(
+                runtime, difference, "ok" if difference <= tolerance else "MISMATCH"
+            )
+        )
+
+    return max(differences.values())
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to export a trained model to TorchScript and ONNX"
+    )
+
+    parser.add_argument(
+        "-loc",
+        "--model-location",
+        default=os.path.join(TRAINED_CLASSIFIER_FOLDER, TRAINED_CLASSIFIER_RNNHIDDEN),
+        help="Location of the trained model",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-folder",
+        default=EXPORTED_CLASSIFIER_FOLDER,
+        help="Folder to write the .torchscript.pt and .onnx files to",
+    )
+    parser.add_argument(
+        "--opset", default=ONNX_OPSET_VERSION, help="ONNX opset version", type=int
+    )
+    parser.add_argument(
+        "--check",
+        default=False,
+        action="store_true",
+        help="Compare the exported graphs with the eager model",
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=1e-4,
+        help="Largest absolute difference accepted by --check",
+        type=float,
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder)
+
+    torch.manual_seed(0)
+
+    model = torch.load(args.model_location, map_location="cpu")
+    model.eval()
+
+    name = os.path.splitext(os.path.basename(args.model_location))[0]
+    torchscript_location = os.path.join(
+        args.output_folder, "{}.torchscript.pt".format(name)
+    )
+    onnx_location = os.path.join(args.output_folder, "{}.onnx".format(name))
+
+    inputs = example_inputs(model, *TRACE_SHAPE)
+    with torch.no_grad():
+        export_torchscript(model, inputs, torchscript_location)
+        export_onnx(model, inputs, onnx_location, args.opset)
+
+    if args.check and check_parity(
+        model, torchscript_location, onnx_location, args.tolerance
+    ) > args.tolerance:
+        raise SystemExit("Exported graphs do not match the eager model")
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
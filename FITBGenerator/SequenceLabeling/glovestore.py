@@ -0,0 +1,111 @@
+"""
+Shared memory mapped store of the pretrained GloVe vectors
+
+The vectors are converted once into a float32 .npy matrix and a word to row
+index. Every project opens the same store with mmap_mode, so building the
+vectors of a vocabulary reads only the rows of its tokens instead of parsing
+and holding the whole GloVe matrix in memory.
+"""
+
+import logging
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+
+from config.data import GLOVE_STORE_FOLDER
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+
+class GloveStore:
+    """
+    GloVe vectors of a torchtext style name like glove.6B.300d
+    """
+
+    def __init__(self, name, location=GLOVE_STORE_FOLDER):
+        self.name = name
+        _, self.corpus, dim = name.split(".")
+        self.dim = int(dim.rstrip("d"))
+
+        self.matrix_location = os.path.join(location, "{}.npy".format(name))
+        self.index_location = os.path.join(location, "{}.index.pickle".format(name))
+
+        if not os.path.exists(self.matrix_location) or not os.path.exists(
+            self.index_location
+        ):
+            self.build()
+
+        self.vectors = np.load(self.matrix_location, mmap_mode="r")
+        with open(self.index_location, "rb") as index_file:
+            self.stoi = pickle.load(index_file)
+
+    def build(self):
+        """Convert the vectors downloaded by torchtext into the store, runs once"""
+        from torchtext.vocab import GloVe
+
+        start_time = time.time()
+        logger.info("Building GloVe store for {}".format(self.name))
+        glove = GloVe(name=self.corpus, dim=self.dim)
+
+        folder = os.path.dirname(self.matrix_location)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # Write under temporary names first so concurrent runs never open
+        # a half written store
+        partial_suffix = ".{}.partial".format(os.getpid())
+        with open(self.matrix_location + partial_suffix, "wb") as matrix_file:
+            np.save(matrix_file, glove.vectors.numpy().astype(np.float32))
+        with open(self.index_location + partial_suffix, "wb") as index_file:
+            pickle.dump(dict(glove.stoi), index_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(self.matrix_location + partial_suffix, self.matrix_location)
+        os.replace(self.index_location + partial_suffix, self.index_location)
+
+        logger.info(
+            "GloVe store built in {:.4f}s at {}".format(
+                time.time() - start_time, folder
+            )
+        )
+
+    def vectors_for(self, itos, unk_init=torch.Tensor.zero_):
+        """
+        Returns a tensor with the vector of every token in itos, tokens missing
+        from GloVe are initialized with unk_init like torchtext.vocab.Vectors
+        """
+        rows = np.array([self.stoi.get(token.strip(), -1) for token in itos])
+        found = np.flatnonzero(rows >= 0)
+        # Gathering in row order keeps the reads on the memory map sequential
+        found = found[np.argsort(rows[found], kind="stable")]
+
+        vectors = torch.Tensor(len(itos), self.dim)
+        vectors[torch.from_numpy(found)] = torch.from_numpy(
+            np.ascontiguousarray(self.vectors[rows[found]])
+        )
+        for index in np.flatnonzero(rows < 0):
+            vectors[int(index)] = unk_init(torch.Tensor(self.dim))
+
+        logger.debug(
+            "Found {} of {} tokens in {}".format(len(found), len(itos), self.name)
+        )
+        return vectors
+
+    def load_vectors(self, vocab, unk_init=torch.Tensor.zero_):
+        """Drop in for Vocab.load_vectors"""
+        vocab.vectors = self.vectors_for(vocab.itos, unk_init)
+
+
+_glove_stores = {}
+
+
+def glove_store(name):
+    """Store of the given vectors opened once per process"""
+    if name not in _glove_stores:
+        _glove_stores[name] = GloveStore(name)
+    return _glove_stores[name]
@@ -10,13 +10,14 @@ from utility import categorical_accuracy, binary_accuracy, other_evaluations
 from config.root import device
 
 
-def train(model, iterator, optimizer, criterion):
+def train(model, iterator, optimizer, criterion, control=None):
 
     epoch_loss = 0
     epoch_acc = 0
     epoch_f1 = 0
     epoch_precision = 0
     epoch_recall = 0
+    n_batches = 0
 
     model.train()
 
@@ -44,13 +45,18 @@ def train(model, iterator, optimizer, criterion):
         epoch_f1 += f1_score
         epoch_precision += precision
         epoch_recall += recall
+        n_batches += 1
+
+        # Ends the epoch early once the training budget is spent
+        if control is not None and control.step():
+            break
 
     return (
-        epoch_loss / len(iterator),
-        epoch_acc / len(iterator),
-        epoch_f1 / len(iterator),
-        epoch_precision / len(iterator),
-        epoch_recall / len(iterator),
+        epoch_loss / n_batches,
+        epoch_acc / n_batches,
+        epoch_f1 / n_batches,
+        epoch_precision / n_batches,
+        epoch_recall / n_batches,
     )
 
 
@@ -3,3 +3,4 @@ Diretory for model related information
 """
 
 from .RNNClassifiers import RNNHiddenClassifier
+from .PQEmbedding import PQEmbedding
@@ -0,0 +1,90 @@
+"""
+Optimizer of models training their embeddings with sparse gradients
+
+An nn.Embedding with sparse=True only gets gradient rows for the tokens of the
+batch, SparseAdam updates just those rows and their moments while Adam keeps
+training every other parameter. Dense Adam would update all rows of the table
+every step, so fine tuning costs scale with the batch vocabulary instead of
+the full vocabulary.
+"""
+
+import logging
+
+import torch.nn as nn
+import torch.optim as optim
+
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+
+class SparseEmbeddingOptimizer:
+    """
+    SparseAdam for the trainable sparse embeddings and Adam for the rest,
+    zeroed and stepped together. SparseAdam has no weight decay, the
+    embeddings are only regularized by the dense Adam path.
+    Input:
+        model: nn.Module -> Model with at least one sparse nn.Embedding
+        lr: float -> Learning rate of both optimizers
+        weight_decay: float -> L2 regularization of the dense parameters
+    """
+
+    def __init__(self, model, lr, weight_decay=0):
+        sparse = [
+            module.weight
+            for module in model.modules()
+            if isinstance(module, nn.Embedding)
+            and module.sparse
+            and module.weight.requires_grad
+        ]
+        sparse_ids = {id(parameter) for parameter in sparse}
+        dense = [
+            parameter
+            for parameter in model.parameters()
+            if parameter.requires_grad and id(parameter) not in sparse_ids
+        ]
+
+        self.optimizers = [
+            optim.Adam(dense, lr=lr, weight_decay=weight_decay),
+            optim.SparseAdam(sparse, lr=lr),
+        ]
+
+    @property
+    def param_groups(self):
+        return [
+            group for optimizer in self.optimizers for group in optimizer.param_groups
+        ]
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+def has_sparse_embeddings(model):
+    return any(
+        isinstance(module, nn.Embedding)
+        and module.sparse
+        and module.weight.requires_grad
+        for module in model.modules()
+    )
+
+
+def build_optimizer(model, lr, weight_decay=0):
+    """Adam, split with SparseAdam when the model trains sparse embeddings"""
+    if has_sparse_embeddings(model):
+        logger.debug("Training the embeddings with sparse gradients")
+        return SparseEmbeddingOptimizer(model, lr, weight_decay)
+    return optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
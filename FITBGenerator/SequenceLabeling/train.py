@@ -8,7 +8,6 @@ import time
 
 import torch
 import torch.nn as nn
-import torch.optim as optim
 from tqdm.auto import tqdm
 
 from config.hyperparameters import (
@@ -21,6 +20,8 @@ from config.hyperparameters import (
     HIDDEN_DIM,
     LR,
     N_LAYERS,
+    PATIENCE,
+    SPARSE_EMBEDDINGS,
     WEIGHT_DECAY,
     CNN_N_FILTER,
     CNN_FILTER_SIZES,
@@ -35,11 +36,14 @@ from config.root import (
     seed_all,
     SEED,
 )
+from cpuprofile import apply_profile
 from datasetloader import GrammarDasetAnswerKey
 from helperfunctions import evaluate, train
 from model import RNNHiddenClassifier
 from utility import categorical_accuracy, epoch_time
 from lossfunction import BCEWithLogitLossWithMask
+from sparseoptimizer import build_optimizer
+from trainingcontrol import TrainingControl
 
 # Initialize logger for this file
 logger = logging.getLogger(__name__)
@@ -61,6 +65,7 @@ def initialize_new_model(
     dropout,
     freeze_embeddings,
     linear_hidden_dim,
+    sparse_embeddings=SPARSE_EMBEDDINGS,
 ):
     """Method to initialise new model, takes in dataset object and hyperparameters as parameter"""
     logger.debug("Initializing Model")
@@ -86,6 +91,7 @@ def initialize_new_model(
 
     if freeze_embeddings:
         model.embedding.weight.requires_grad = False
+    model.embedding.sparse = bool(sparse_embeddings)
 
     logger.debug(
         "Freeze Embeddings Value {}: {}".format(
@@ -191,6 +197,14 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "-se",
+        "--sparse-embeddings",
+        default=SPARSE_EMBEDDINGS,
+        help="Train unfrozen embeddings with sparse gradients and SparseAdam",
+        type=int,
+    )
+
     parser.add_argument(
         "-l2",
         "--l2-regularization",
@@ -215,12 +229,35 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "-p",
+        "--patience",
+        default=PATIENCE,
+        help="Epochs without validation improvement before stopping, 0 disables",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-minutes",
+        default=None,
+        help="Stop training once this many minutes have passed",
+        type=float,
+    )
+    parser.add_argument(
+        "--max-steps",
+        default=None,
+        help="Stop training after this many optimizer steps",
+        type=int,
+    )
+
     args = parser.parse_args()
 
     seed_all(args.seed)
     logger.debug(args)
     logger.debug("Custom seed set with: {}".format(args.seed))
 
+    # Only the threads of the CPU profile, its batch size is tuned for inference
+    apply_profile(args.model_location or TRAINED_CLASSIFIER_RNNHIDDEN)
+
     logger.info("Loading Dataset")
 
     dataset = GrammarDasetAnswerKey.get_iterators(args.batch_size)
@@ -240,11 +277,14 @@ if __name__ == "__main__":
             args.dropout,
             args.freeze_embeddings,
             args.linear_hidden_dim,
+            args.sparse_embeddings,
         )
+    model.embedding.sparse = bool(args.sparse_embeddings)
 
     criterion = BCEWithLogitLossWithMask()
-    optimizer = optim.Adam(
-        model.parameters(), lr=LR, weight_decay=args.l2_regularization
+    optimizer = build_optimizer(model, args.learning_rate, args.l2_regularization)
+    control = TrainingControl(
+        optimizer, args.patience, args.max_minutes, args.max_steps
     )
 
     model = model.to(device)
@@ -255,13 +295,11 @@ if __name__ == "__main__":
     if not os.path.exists(TRAINED_CLASSIFIER_FOLDER):
         os.mkdir(TRAINED_CLASSIFIER_FOLDER)
 
-    best_test_loss = float("inf")
-
     for epoch in range(int(args.epochs)):
 
         start_time = time.time()
         train_loss, train_acc, train_f1, train_precision, train_recall = train(
-            model, dataset.train_iterator, optimizer, criterion
+            model, dataset.train_iterator, optimizer, criterion, control
         )
         test_loss, test_acc, test_f1, test_precision, test_recall = evaluate(
             model, dataset.test_iterator, criterion
@@ -271,8 +309,8 @@ if __name__ == "__main__":
 
         epoch_mins, epoch_secs = epoch_time(start_time, end_time)
 
-        if test_loss < best_test_loss:
-            best_test_loss = test_loss
+        stop = control.epoch_finished(test_loss)
+        if control.improved:
             torch.save(
                 model,
                 os.path.join(TRAINED_CLASSIFIER_FOLDER, TRAINED_CLASSIFIER_RNNHIDDEN),
@@ -286,3 +324,8 @@ if __name__ == "__main__":
             f"\t Train. Precision: {train_precision:.2f} |  Val. Precision: {test_precision:.2f}"
         )
         print(f"\t Train. Recall: {train_recall:.2f} |  Val. Recall: {test_recall:.2f}")
+
+        if stop:
+            break
+
+    control.finished()
@@ -0,0 +1,193 @@
+"""
+Product quantization of the encoder and decoder embeddings of the trained
+Seq2Seq model
+
+Every row of both embedding tables is split into SUBVECTORS parts and each
+part is replaced by the uint8 code of its nearest k-means centroid, see
+models.PQEmbedding. The compressed model is saved as <model>.pq.pt and both
+models are compared on the test split for loss, perplexity and serialized
+size, together with the relative squared error of every reconstructed table.
+"""
+
+import argparse
+import copy
+import io
+import json
+import logging
+import math
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from config.hyperparameters import PRODUCT_QUANTIZATION
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    TRAINED_MODEL_PATH,
+    device,
+    models,
+)
+from models.PQEmbedding import PQEmbedding
+from train import evaluate, initialize_vanillaSeq2Seq
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Modules of VanillaSeq2Seq holding an embedding table
+TABLES = ["encoder", "decoder"]
+
+
+def compress(
+    model,
+    n_subvectors,
+    n_centroids=PRODUCT_QUANTIZATION["CENTROIDS"],
+    iterations=PRODUCT_QUANTIZATION["ITERATIONS"],
+):
+    """PQEmbedding copy of the model, the float model is left untouched"""
+    model = copy.deepcopy(model)
+    for name in TABLES:
+        module = getattr(model, name)
+        module.embedding = PQEmbedding.from_embedding(
+            module.embedding, n_subvectors, n_centroids, iterations
+        ).to(module.embedding.weight.device)
+    return model
+
+
+def model_size(model):
+    """Size in bytes of the serialized weights"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def reconstruction_error(model, compressed_model):
+    """Squared error of every compressed table relative to the float one"""
+    errors = {}
+    with torch.no_grad():
+        for name in TABLES:
+            weight = getattr(model, name).embedding.weight.float()
+            error = (getattr(compressed_model, name).embedding.weight - weight).pow(2)
+            errors[name] = (error.sum() / weight.pow(2).sum()).item()
+    return errors
+
+
+def report(model, iterator, criterion):
+    loss = evaluate(model, iterator, criterion)
+    return {
+        "loss": loss,
+        "perplexity": math.exp(loss),
+        "size_mb": model_size(model) / 2 ** 20,
+        "embedding_mb": sum(
+            model_size(getattr(model, name).embedding) for name in TABLES
+        )
+        / 2 ** 20,
+    }
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to product quantize the embeddings of a trained model"
+    )
+    parser.add_argument(
+        "-l",
+        "--model-location",
+        default=os.path.join(TRAINED_MODEL_PATH, "{}.pt".format(models[1])),
+        help="Location of Model File",
+    )
+    parser.add_argument(
+        "-d", "--dataset", default="SQUAD", help="Dataset to evaluate on"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Location of the compressed model, defaults to <model>.pq.pt",
+    )
+    parser.add_argument(
+        "-s",
+        "--subvectors",
+        default=PRODUCT_QUANTIZATION["SUBVECTORS"],
+        help="Number of parts every embedding row is split into",
+        type=int,
+    )
+    parser.add_argument(
+        "-c",
+        "--centroids",
+        default=PRODUCT_QUANTIZATION["CENTROIDS"],
+        help="Centroids of the codebook of every part, at most 256",
+        type=int,
+    )
+    parser.add_argument(
+        "-i",
+        "--iterations",
+        default=PRODUCT_QUANTIZATION["ITERATIONS"],
+        help="K-means iterations of every codebook",
+        type=int,
+    )
+    parser.add_argument(
+        "-r", "--report", default=None, help="Also write the report to a json file"
+    )
+
+    args = parser.parse_args()
+
+    _, _, TRG, _, _, test_iterator = initialize_vanillaSeq2Seq(args.dataset)
+
+    model = torch.load(args.model_location, map_location=device)
+    model.eval()
+
+    compressed_model = compress(
+        model, args.subvectors, args.centroids, args.iterations
+    )
+
+    output = args.output or "{}.pq.pt".format(
+        os.path.splitext(args.model_location)[0]
+    )
+    torch.save(compressed_model, output)
+    logger.info("Saved compressed model to {}".format(output))
+
+    criterion = nn.CrossEntropyLoss(ignore_index=TRG.vocab.stoi[TRG.pad_token])
+
+    results = {
+        name: report(candidate, test_iterator, criterion)
+        for name, candidate in (("float", model), ("pq", compressed_model))
+    }
+    results["delta"] = {
+        key: results["pq"][key] - results["float"][key] for key in results["float"]
+    }
+    errors = reconstruction_error(model, compressed_model)
+
+    print(
+        "{:<8}{:>10}{:>10}{:>10}{:>10}".format(
+            "", "Loss", "PPL", "Size MB", "Emb MB"
+        )
+    )
+    for name, result in results.items():
+        print(
+            "{:<8}{:>10.4f}{:>10.3f}{:>10.2f}{:>10.2f}".format(
+                name,
+                result["loss"],
+                result["perplexity"],
+                result["size_mb"],
+                result["embedding_mb"],
+            )
+        )
+    for name, error in errors.items():
+        print("Relative reconstruction error of the {}: {:.4f}".format(name, error))
+
+    if args.report:
+        results["reconstruction_error"] = errors
+        results["pq_embedding"] = {
+            "n_subvectors": args.subvectors,
+            "n_centroids": args.centroids,
+            "iterations": args.iterations,
+        }
+        with open(args.report, "w") as report_file:
+            json.dump(results, report_file, indent=2)
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
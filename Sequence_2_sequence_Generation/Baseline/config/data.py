@@ -2,6 +2,7 @@
 The Configurations Related to and Dataset and their properties
 like local filenames and URLs
 """
+import os
 
 DATA_FOLDER = "data"
 DATA_FOLDER_RAW = "raw"
@@ -24,3 +25,8 @@ DATASETS = {
         "valid": None,
     }
 }
+
+# Built once and shared by every project, override with the GLOVE_STORE variable
+GLOVE_STORE_FOLDER = os.environ.get(
+    "GLOVE_STORE", os.path.join(os.path.expanduser("~"), ".cache", "glove_store")
+)
@@ -11,3 +11,22 @@ VANILLA_SEQ2SEQ = {
     "DROPOUT": 0.7,
     "BATCHSIZE": 32,
 }
+
+# Training stops after PATIENCE epochs without a validation loss improvement
+# of MIN_DELTA, the learning rate is multiplied by LR_FACTOR after LR_PATIENCE
+TRAINING_CONTROL = {
+    "PATIENCE": 3,
+    "LR_PATIENCE": 1,
+    "LR_FACTOR": 0.5,
+    "MIN_LR": 1e-6,
+    "MIN_DELTA": 1e-4,
+}
+
+# Product quantization of the embedding tables by compress.py, every row is
+# split into SUBVECTORS parts stored as uint8 codes into codebooks of
+# CENTROIDS centroids learned in ITERATIONS k-means iterations
+PRODUCT_QUANTIZATION = {
+    "SUBVECTORS": 50,
+    "CENTROIDS": 256,
+    "ITERATIONS": 20,
+}
@@ -28,3 +28,10 @@ def seed_all(seed=1234):
 
 models = {1: "VanillaSeq2Seq"}
 TRAINED_MODEL_PATH = "trained_models"
+EXPORTED_MODEL_PATH = "exported_models"
+ONNX_OPSET_VERSION = 11
+
+# CPU execution profiles written by autotune.py, one per model and host, training
+# and inference apply the profile of their model when it exists
+AUTOTUNE_FOLDER = os.path.join(TRAINED_MODEL_PATH, "autotune")
+AUTOTUNE_AUTOLOAD = True
@@ -16,6 +16,7 @@ from torchtext.data import Field, BucketIterator
 from config.data import DATA_FOLDER, DATA_FOLDER_PROCESSED, DATASETS, SQUAD_NAME
 from config.root import LOGGING_FORMAT, LOGGING_LEVEL, seed_all, device
 from config.hyperparameters import VANILLA_SEQ2SEQ
+from glovestore import glove_store
 
 from utils import word_tokenizer
 
@@ -82,8 +83,10 @@ def load_dataset(
     start_time = time.time()
     if use_glove:
         logger.debug("Using Glove vectors")
-        SRC.build_vocab(train_dataset, max_size=source_vocab, vectors="glove.6B.300d")
-        TRG.build_vocab(train_dataset, max_size=target_vocab, vectors="glove.6B.300d")
+        SRC.build_vocab(train_dataset, max_size=source_vocab)
+        TRG.build_vocab(train_dataset, max_size=target_vocab)
+        glove_store("glove.6B.300d").load_vectors(SRC.vocab)
+        glove_store("glove.6B.300d").load_vectors(TRG.vocab)
     else:
         SRC.build_vocab(train_dataset, max_size=source_vocab)
         TRG.build_vocab(train_dataset, max_size=target_vocab)
@@ -0,0 +1,240 @@
+"""
+Export the trained Seq2Seq model to TorchScript and ONNX
+
+The encoder and a single decoder step are exported as two graphs with dynamic
+batch and source length axes, greedy or beam decoding loops over the decoder
+graph like generate_questons does over model.decoder
+"""
+
+import argparse
+import inspect
+import logging
+import os
+import time
+
+import torch
+
+from config.root import (
+    EXPORTED_MODEL_PATH,
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    ONNX_OPSET_VERSION,
+    TRAINED_MODEL_PATH,
+    models,
+)
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Newer torch defaults to the dynamo exporter, the TorchScript based one is
+# the exporter that understands packed sequences
+ONNX_EXPORTER_ARGUMENTS = (
+    {"dynamo": False}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters
+    else {}
+)
+
+# Batch and source length of the traced inputs and of the parity checks
+TRACE_SHAPE = (4, 12)
+CHECK_SHAPES = [(1, 5), (3, 20), (16, 37)]
+
+GRAPHS = {
+    "encoder": {
+        "input_names": ["src", "src_len"],
+        "output_names": ["encoder_outputs", "hidden"],
+        "dynamic_axes": {
+            "src": {0: "src_len", 1: "batch"},
+            "src_len": {0: "batch"},
+            "encoder_outputs": {0: "src_len", 1: "batch"},
+            "hidden": {0: "batch"},
+        },
+    },
+    "decoder": {
+        "input_names": ["input", "hidden", "encoder_outputs"],
+        "output_names": ["prediction", "next_hidden"],
+        "dynamic_axes": {
+            "input": {0: "batch"},
+            "hidden": {0: "batch"},
+            "encoder_outputs": {0: "src_len", 1: "batch"},
+            "prediction": {0: "batch"},
+            "next_hidden": {0: "batch"},
+        },
+    },
+}
+
+
+def example_inputs(model, batch_size, src_len):
+    """
+    Random inputs of the encoder and of a decoder step
+    Input:
+        model: nn.Module -> VanillaSeq2Seq model
+        batch_size: int -> Number of sentences
+        src_len: int -> Length of the longest source sentence
+    Output:
+        inputs: dict -> Graph name to the tuple of its inputs
+    """
+    lengths = torch.randint(1, src_len + 1, (batch_size,))
+    lengths[0] = src_len
+    lengths, _ = lengths.sort(descending=True)
+
+    src = torch.randint(2, model.encoder.input_dim, (src_len, batch_size))
+    src[torch.arange(src_len).unsqueeze(1) >= lengths.unsqueeze(0)] = 1
+
+    with torch.no_grad():
+        encoder_outputs, hidden = model.encoder(src, lengths)
+
+    trg = torch.randint(2, model.decoder.output_dim, (batch_size,))
+
+    return {
+        "encoder": (src, lengths),
+        "decoder": (trg, hidden, encoder_outputs),
+    }
+
+
+def export_graphs(model, inputs, location, opset_version=ONNX_OPSET_VERSION):
+    """
+    Trace the encoder and the decoder step to TorchScript and ONNX
+    Input:
+        model: nn.Module -> VanillaSeq2Seq model in eval mode
+        inputs: dict -> Output of example_inputs
+        location: string -> Prefix of the exported files
+    """
+    for name, module in (("encoder", model.encoder), ("decoder", model.decoder)):
+        torchscript_location = "{}.{}.torchscript.pt".format(location, name)
+        torch.jit.trace(module, inputs[name]).save(torchscript_location)
+        logger.info("Saved TorchScript graph to {}".format(torchscript_location))
+
+        onnx_location = "{}.{}.onnx".format(location, name)
+        torch.onnx.export(
+            module,
+            inputs[name],
+            onnx_location,
+            opset_version=opset_version,
+            **GRAPHS[name],
+            **ONNX_EXPORTER_ARGUMENTS,
+        )
+        logger.info("Saved ONNX graph to {}".format(onnx_location))
+
+
+def check_parity(model, location, tolerance):
+    """
+    Largest absolute difference of the exported graphs to the eager modules
+    over CHECK_SHAPES, ONNX is skipped without onnxruntime
+    Input:
+        model: nn.Module -> VanillaSeq2Seq model in eval mode
+        location: string -> Prefix of the exported files
+        tolerance: float -> Difference reported as a mismatch
+    Output:
+        difference: float -> Largest difference of every graph and runtime
+    """
+    differences = {}
+    for name, module in (("encoder", model.encoder), ("decoder", model.decoder)):
+        runtimes = {
+            "torchscript": torch.jit.load(
+                "{}.{}.torchscript.pt".format(location, name)
+            )
+        }
+        if onnxruntime is None:
+            logger.warning("onnxruntime is not installed, skipping the ONNX check")
+        else:
+            session = onnxruntime.InferenceSession(
+                "{}.{}.onnx".format(location, name),
+                providers=["CPUExecutionProvider"],
+            )
+            input_names = GRAPHS[name]["input_names"]
+            runtimes["onnx"] = lambda *inputs: [
+                torch.from_numpy(output)
+                for output in session.run(
+                    None,
+                    {
+                        input_name: value.numpy()
+                        for input_name, value in zip(input_names, inputs)
+                    },
+                )
+            ]
+
+        with torch.no_grad():
+            for shape in CHECK_SHAPES:
+                inputs = example_inputs(model, *shape)[name]
+                expected = module(*inputs)
+                for runtime, run in runtimes.items():
+                    key = "{} {}".format(name, runtime)
+                    differences[key] = max(
+                        [differences.get(key, 0.0)]
+                        + [
+                            float((output - target).abs().max())
+                            for output, target in zip(run(*inputs), expected)
+                        ]
+                    )
+
+    for key, difference in differences.items():
+        logger.info(
+            "{} max abs difference {:.2e} ({})".format(
+                key, difference, "ok" if difference <= tolerance else "MISMATCH"
+            )
+        )
+
+    return max(differences.values())
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to export a trained model to TorchScript and ONNX"
+    )
+    parser.add_argument(
+        "-l",
+        "--model-location",
+        default=os.path.join(TRAINED_MODEL_PATH, "{}.pt".format(models[1])),
+        help="Location of Model File",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-folder",
+        default=EXPORTED_MODEL_PATH,
+        help="Folder to write the encoder and decoder graphs to",
+    )
+    parser.add_argument(
+        "--opset", default=ONNX_OPSET_VERSION, help="ONNX opset version", type=int
+    )
+    parser.add_argument(
+        "--check",
+        default=False,
+        action="store_true",
+        help="Compare the exported graphs with the eager model",
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=1e-4,
+        help="Largest absolute difference accepted by --check",
+        type=float,
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder)
+
+    torch.manual_seed(0)
+
+    model = torch.load(args.model_location, map_location="cpu")
+    model.eval()
+
+    location = os.path.join(
+        args.output_folder,
+        os.path.splitext(os.path.basename(args.model_location))[0],
+    )
+
+    with torch.no_grad():
+        export_graphs(model, example_inputs(model, *TRACE_SHAPE), location, args.opset)
+
+    if args.check and check_parity(model, location, args.tolerance) > args.tolerance:
+        raise SystemExit("Exported graphs do not match the eager model")
+
+    logger.info("Exported in {:.4f}s".format(time.time() - start_time))
@@ -19,6 +19,7 @@ from config.root import (
     models,
     seed_all,
 )
+from cpuprofile import apply_profile
 from train import initialize_vanillaSeq2Seq
 
 logger = logging.getLogger(__name__)
@@ -85,6 +86,9 @@ def generate_questions_vanilla_seq2Seq(max_len, dataset, model_location):
         model_location: string -> Location to load model
     """
 
+    # Questions are generated one sentence at a time, only the threads apply
+    apply_profile(model_location)
+
     logger.debug("Loading Model")
     model, SRC, TRG, train_iterator, valid_iterator, test_iterator = initialize_vanillaSeq2Seq(
         dataset
@@ -11,7 +11,7 @@ import torch
 import torch.optim as optim
 from tqdm import tqdm
 
-from config.hyperparameters import VANILLA_SEQ2SEQ
+from config.hyperparameters import TRAINING_CONTROL, VANILLA_SEQ2SEQ
 from config.root import (
     LOGGING_FORMAT,
     LOGGING_LEVEL,
@@ -20,8 +20,10 @@ from config.root import (
     seed_all,
     TRAINED_MODEL_PATH,
 )
+from cpuprofile import apply_profile
 from dataloader import load_dataset
 from models.VanillaSeq2Seq import *
+from trainingcontrol import TrainingControl
 
 seed_all()
 
@@ -40,14 +42,18 @@ def epoch_time(start_time, end_time):
     return elapsed_mins, elapsed_secs
 
 
-def train(model, iterator, optimizer, criterion, clip, teacher_forcing=0.5):
+def train(
+    model, iterator, optimizer, criterion, clip, teacher_forcing=0.5, control=None
+):
     """
-    Generic Training Method
+    Generic Training Method, a TrainingControl ends the epoch early once the
+    training budget is spent
     """
 
     model.train()
 
     epoch_loss = 0
+    n_batches = 0
 
     for i, batch in tqdm(enumerate(iterator), total=len(iterator)):
 
@@ -68,17 +74,21 @@ def train(model, iterator, optimizer, criterion, clip, teacher_forcing=0.5):
         optimizer.step()
 
         epoch_loss += loss.detach().item()
+        n_batches += 1
 
         # Throwing GPU out of memory on Colab
         del output
         del loss
 
+        if control is not None and control.step():
+            break
+
     # Force emptying the GPU caches reduces runtime but effective to
     # save space on GPU at Colab
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
 
-    return epoch_loss / len(iterator)
+    return epoch_loss / n_batches
 
 
 def evaluate(model, iterator, criterion):
@@ -153,12 +163,24 @@ def initialize_vanillaSeq2Seq(dataset_name):
 
 
 def train_vanilla_seq2seq(
-    dataset_name, clip, lr, validation, epochs, train_model_path, teacher_forcing
+    dataset_name,
+    clip,
+    lr,
+    validation,
+    epochs,
+    train_model_path,
+    teacher_forcing,
+    patience=TRAINING_CONTROL["PATIENCE"],
+    max_minutes=None,
+    max_steps=None,
 ):
     """
     Method to train the Vanilla Seq2Seq
     """
 
+    # Only the threads of the CPU profile, its batch size is tuned for inference
+    apply_profile(train_model_path or models[1])
+
     logger.debug("Data Loading")
 
     model, SRC, TRG, train_iterator, valid_iterator, _ = initialize_vanillaSeq2Seq(
@@ -178,25 +200,26 @@ def train_vanilla_seq2seq(
 
     logger.debug(model)
 
-    optimizer = optim.Adam(model.parameters())
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    control = TrainingControl(optimizer, patience, max_minutes, max_steps)
 
     TRG_PADDING = TRG.vocab.stoi[TRG.pad_token]
 
     criterion = nn.CrossEntropyLoss(ignore_index=TRG_PADDING)
 
-    best_valid_loss = float("inf")
-
     for epoch in range(epochs):
         start_time = time.time()
 
-        train_loss = train(model, train_iterator, optimizer, criterion, clip)
+        train_loss = train(
+            model, train_iterator, optimizer, criterion, clip, control=control
+        )
         valid_loss = evaluate(model, valid_iterator, criterion)
 
         end_time = time.time()
         epoch_mins, epoch_secs = epoch_time(start_time, end_time)
 
-        if valid_loss < best_valid_loss:
-            best_valid_loss = valid_loss
+        stop = control.epoch_finished(valid_loss)
+        if control.improved:
             torch.save(
                 model, os.path.join(TRAINED_MODEL_PATH, "{}.pt".format(models[1]))
             )
@@ -218,6 +241,11 @@ def train_vanilla_seq2seq(
             )
         )
 
+        if stop:
+            break
+
+    control.finished()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -260,6 +288,26 @@ if __name__ == "__main__":
         help="Load the model from the directory",
     )
 
+    parser.add_argument(
+        "-p",
+        "--patience",
+        default=TRAINING_CONTROL["PATIENCE"],
+        help="Epochs without validation improvement before stopping, 0 disables",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-minutes",
+        default=None,
+        help="Stop training once this many minutes have passed",
+        type=float,
+    )
+    parser.add_argument(
+        "--max-steps",
+        default=None,
+        help="Stop training after this many optimizer steps",
+        type=int,
+    )
+
     args = parser.parse_args()
 
     if args.model == 1:
@@ -271,4 +319,7 @@ if __name__ == "__main__":
             args.epochs,
             args.trained_model_path,
             args.teacherforcing,
+            args.patience,
+            args.max_minutes,
+            args.max_steps,
         )
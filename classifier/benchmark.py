@@ -0,0 +1,475 @@
+"""
+Micro benchmarks of the classifier building blocks run this file by
+
+```
+    >>> python benchmark.py conv
+    >>> python benchmark.py --threads 1 conv --batch-sizes 1 --lengths 8 32 128
+    >>> python benchmark.py packed --batches 50
+    >>> python benchmark.py ensemble --members RNNHiddenClassifier CNN1dClassifier
+    >>> python benchmark.py sparse --model CNN1dClassifier --vocab-sizes 10000 40000
+```
+conv times the Conv2d filters of CNN2dClassifier run as the Conv1d it
+applies them with against the Conv2d it used before, on random embeddings
+of the configured sizes. Outputs are checked to match before timing.
+
+packed times RNNFieldClassifer on GrammarDasetMultiTag batches with its
+packed LSTM against the LSTM over the whole padded tensor it ran before, for
+inference and for a training step, and reports the share of padding.
+
+ensemble times an EnsembleClassifier of untrained members sharing one
+embedding, run in turn and in threads, against the sum of its members run one
+after the other.
+
+sparse times a training step with unfrozen embeddings of several vocabulary
+sizes, trained by dense Adam against sparse gradients and SparseAdam.
+"""
+
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from config.hyperparameters import (
+    BATCH_SIZE,
+    BIDIRECTION,
+    CNN_FILTER_SIZES,
+    CNN_N_FILTER,
+    DROPOUT,
+    EMBEDDING_DIM,
+    HIDDEN_DIM,
+    LINEAR_HIDDEN_DIM,
+    LR,
+    MAX_VOCAB,
+    N_LAYERS,
+    WEIGHT_DECAY,
+)
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL, SEED, seed_all
+from datasetloader import GrammarDasetAnswerTag, GrammarDasetMultiTag
+from helperfunctions import get_batch_data, get_batch_data_and_tag
+from model import COMBINE_METHODS, EnsembleClassifier, RNNFieldClassifer
+from model.CNNClassifiers import pooled_convs
+from modelbuilder import CLASSIFIERS, build_model
+from sparseoptimizer import build_optimizer
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Calls run before the latency is measured
+WARMUP_RUNS = 10
+
+HYPERPARAMETERS = {
+    "embedding_dim": EMBEDDING_DIM,
+    "hidden_dim": HIDDEN_DIM,
+    "n_layers": N_LAYERS,
+    "bidirectional": BIDIRECTION,
+    "dropout": DROPOUT,
+    "n_filters": CNN_N_FILTER,
+    "filter_sizes": CNN_FILTER_SIZES,
+    "linear_hidden_dim": LINEAR_HIDDEN_DIM,
+}
+
+
+def p50_ms(function, repeats):
+    """Median milliseconds of a call"""
+    timings = []
+    with torch.no_grad():
+        for index in range(WARMUP_RUNS + repeats):
+            start_time = time.perf_counter()
+            function()
+            if index >= WARMUP_RUNS:
+                timings.append(1000 * (time.perf_counter() - start_time))
+    return float(np.percentile(timings, 50))
+
+
+def per_width_conv2d(convs, embedded):
+    """Block of CNN2dClassifier before it ran its filters as a Conv1d"""
+    embedded = embedded.permute(0, 2, 1).unsqueeze(1)
+    return torch.cat(
+        [F.relu(conv(embedded)).squeeze(3).max(dim=2)[0] for conv in convs], dim=1
+    )
+
+
+def benchmark_conv(args):
+    conv2d = nn.ModuleList(
+        [nn.Conv2d(1, CNN_N_FILTER, (fs, EMBEDDING_DIM)) for fs in CNN_FILTER_SIZES]
+    )
+    weights = [(conv.weight.squeeze(1).permute(0, 2, 1), conv.bias) for conv in conv2d]
+
+    print(
+        "{:>6}{:>8}{:>11}{:>11}{:>10}".format(
+            "Batch", "Length", "Conv2d ms", "Conv1d ms", "Speedup"
+        )
+    )
+    for batch_size in args.batch_sizes:
+        for length in args.lengths:
+            # Permuted from the embedding output like in the classifiers
+            embedded = torch.randn(batch_size, length, EMBEDDING_DIM).permute(0, 2, 1)
+
+            with torch.no_grad():
+                reference = per_width_conv2d(conv2d, embedded)
+                if not torch.allclose(
+                    pooled_convs(embedded, weights), reference, atol=1e-4
+                ):
+                    raise ValueError("Conv1d output does not match the Conv2d one")
+
+            conv2d_ms = p50_ms(lambda: per_width_conv2d(conv2d, embedded), args.repeats)
+            conv1d_ms = p50_ms(lambda: pooled_convs(embedded, weights), args.repeats)
+            print(
+                "{:>6}{:>8}{:>11.3f}{:>11.3f}{:>9.2f}x".format(
+                    batch_size, length, conv2d_ms, conv1d_ms, conv2d_ms / conv1d_ms
+                )
+            )
+
+
+def dataset_batches(dataset, split, batch_size, n_batches):
+    """Warm up batches followed by n_batches timed batches on the cpu"""
+    cpu = torch.device("cpu")
+    batches = []
+    while len(batches) < WARMUP_RUNS + n_batches:
+        batches.extend(dataset.iterator(split, batch_size, True, device=cpu))
+    return batches[: WARMUP_RUNS + n_batches]
+
+
+def inputs(model, batch):
+    """Forward arguments of the model for a batch"""
+    if isinstance(model, RNNFieldClassifer) or getattr(model, "use_tags", False):
+        return get_batch_data_and_tag(batch)
+    return get_batch_data(batch)
+
+
+def padded_field_forward(model, text, text_lengths, tag):
+    """RNNFieldClassifer before packing, the LSTM also runs over the padding"""
+    embedded = model.dropout(model.embedding(text))
+    tag_embedded = model.dropout(model.tag_embedding(tag))
+
+    _, (hidden, _) = model.rnn(torch.cat((embedded, tag_embedded), -1))
+
+    if model.bidirectional:
+        hidden = model.dropout(torch.cat((hidden[-2, :, :], hidden[-1, :, :]), dim=1))
+    else:
+        hidden = model.dropout(hidden[-1, :, :])
+
+    return model.fc(hidden)
+
+
+def p50_step_ms(model, forward, batches, criterion):
+    """Median milliseconds of a forward and backward pass"""
+    timings = []
+    for index, batch in enumerate(batches):
+        model.zero_grad()
+        start_time = time.perf_counter()
+        criterion(forward(*get_batch_data_and_tag(batch)), batch.label).backward()
+        if index >= WARMUP_RUNS:
+            timings.append(1000 * (time.perf_counter() - start_time))
+    return float(np.percentile(timings, 50))
+
+
+def benchmark_packed(args):
+    dataset = GrammarDasetMultiTag()
+    dataset.load_compiled(GrammarDasetMultiTag.compile_if_needed())
+    model = build_model("RNNFieldClassifer", dataset, HYPERPARAMETERS)
+
+    batches = dataset_batches(dataset, args.split, args.batch_size, args.batches)
+
+    lengths = torch.cat([batch.text[1] for batch in batches[WARMUP_RUNS:]])
+    padded_tokens = sum(batch.text[0].numel() for batch in batches[WARMUP_RUNS:])
+    print(
+        "Padding is {:.1%} of the {:,} positions of {} {} batches of {}".format(
+            1 - lengths.sum().item() / padded_tokens,
+            padded_tokens,
+            args.batches,
+            args.split,
+            args.batch_size,
+        )
+    )
+
+    def inference_ms(forward):
+        model.eval()
+        batch_iterator = iter(batches)
+        return p50_ms(
+            lambda: forward(*get_batch_data_and_tag(next(batch_iterator))),
+            args.batches,
+        )
+
+    def training_ms(forward):
+        model.train()
+        return p50_step_ms(model, forward, batches, nn.CrossEntropyLoss())
+
+    padded = lambda *inputs: padded_field_forward(model, *inputs)
+    print("{:<12}{:>12}{:>12}{:>10}".format("", "Padded ms", "Packed ms", "Speedup"))
+    for name, measure in (("Inference", inference_ms), ("Train step", training_ms)):
+        padded_ms = measure(padded)
+        packed_ms = measure(model)
+        print(
+            "{:<12}{:>12.3f}{:>12.3f}{:>9.2f}x".format(
+                name, padded_ms, packed_ms, padded_ms / packed_ms
+            )
+        )
+
+
+def benchmark_ensemble(args):
+    dataset_class = (
+        GrammarDasetMultiTag
+        if "RNNFieldClassifer" in args.members
+        else GrammarDasetAnswerTag
+    )
+    dataset = dataset_class()
+    dataset.load_compiled(dataset_class.compile_if_needed())
+
+    members = [build_model(name, dataset, HYPERPARAMETERS) for name in args.members]
+    # Same frozen vectors in every member like after training on GloVe
+    for member in members[1:]:
+        member.embedding.weight.data.copy_(members[0].embedding.weight.data)
+    for member in members:
+        member.eval()
+
+    ensembles = [
+        ("Ensemble", EnsembleClassifier(members, args.combine)),
+        (
+            "Ensemble threaded",
+            EnsembleClassifier(members, args.combine, args.ensemble_threads),
+        ),
+    ]
+
+    batches = dataset_batches(dataset, args.split, args.batch_size, args.batches)
+
+    with torch.no_grad():
+        batch = batches[0]
+        expected = torch.stack(
+            [F.softmax(member(*inputs(member, batch)), dim=1) for member in members]
+        )
+        if args.combine == "mean":
+            expected = expected.mean(dim=0)
+            for _, ensemble in ensembles:
+                output = F.softmax(ensemble(*inputs(ensemble, batch)), dim=1)
+                if not torch.allclose(output, expected, atol=1e-5):
+                    raise ValueError("Ensemble output does not match its members")
+
+    def inference_ms(model):
+        batch_iterator = iter(batches)
+        return p50_ms(lambda: model(*inputs(model, next(batch_iterator))), args.batches)
+
+    member_ms = {member.__class__.__name__: inference_ms(member) for member in members}
+    total_ms = sum(member_ms.values())
+
+    print("{:<28}{:>10}{:>12}".format("", "p50 ms", "vs members"))
+    for name, milliseconds in member_ms.items():
+        print("{:<28}{:>10.3f}".format(name, milliseconds))
+    print("{:<28}{:>10.3f}{:>11.2f}x".format("Sum of members", total_ms, 1.0))
+    for name, ensemble in ensembles:
+        milliseconds = inference_ms(ensemble)
+        ensemble.close()
+        print(
+            "{:<28}{:>10.3f}{:>11.2f}x".format(
+                name, milliseconds, total_ms / milliseconds
+            )
+        )
+
+
+def benchmark_sparse(args):
+    dataset_class = (
+        GrammarDasetMultiTag
+        if args.model == "RNNFieldClassifer"
+        else GrammarDasetAnswerTag
+    )
+    dataset = dataset_class()
+    dataset.load_compiled(dataset_class.compile_if_needed())
+
+    batches = dataset_batches(dataset, args.split, args.batch_size, args.batches)
+    distinct = np.mean(
+        [len(torch.unique(batch.text[0])) for batch in batches[WARMUP_RUNS:]]
+    )
+    print(
+        "Batches of {} touch {:.0f} distinct tokens".format(args.batch_size, distinct)
+    )
+
+    criterion = nn.CrossEntropyLoss()
+
+    def training_ms(vocab_size, sparse):
+        seed_all(SEED)
+        model = build_model(args.model, dataset, HYPERPARAMETERS)
+        # Bigger table than the dataset vocabulary, batches only use its first rows
+        model.embedding = nn.Embedding(
+            max(vocab_size, model.embedding.num_embeddings),
+            EMBEDDING_DIM,
+            padding_idx=model.embedding.padding_idx,
+            sparse=sparse,
+        )
+        model.train()
+        optimizer = build_optimizer(model, LR, WEIGHT_DECAY)
+
+        timings = []
+        for index, batch in enumerate(batches):
+            start_time = time.perf_counter()
+            optimizer.zero_grad()
+            criterion(model(*inputs(model, batch)), batch.label).backward()
+            optimizer.step()
+            if index >= WARMUP_RUNS:
+                timings.append(1000 * (time.perf_counter() - start_time))
+        return float(np.percentile(timings, 50))
+
+    print("{:>8}{:>12}{:>12}{:>10}".format("Vocab", "Dense ms", "Sparse ms", "Speedup"))
+    for vocab_size in args.vocab_sizes:
+        dense_ms = training_ms(vocab_size, False)
+        sparse_ms = training_ms(vocab_size, True)
+        print(
+            "{:>8}{:>12.3f}{:>12.3f}{:>9.2f}x".format(
+                vocab_size, dense_ms, sparse_ms, dense_ms / sparse_ms
+            )
+        )
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to benchmark the classifier building blocks"
+    )
+    parser.add_argument(
+        "-th",
+        "--threads",
+        default=None,
+        help="Torch threads, defaults to the torch default",
+        type=int,
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    conv_parser = subparsers.add_parser(
+        "conv", help="Conv2d filters run as a Conv1d against the Conv2d"
+    )
+    conv_parser.add_argument(
+        "--batch-sizes",
+        default=[1, BATCH_SIZE],
+        nargs="+",
+        help="Batch sizes to time",
+        type=int,
+    )
+    conv_parser.add_argument(
+        "--lengths",
+        default=[8, 16, 32, 64],
+        nargs="+",
+        help="Sequence lengths to time",
+        type=int,
+    )
+    conv_parser.add_argument(
+        "-r", "--repeats", default=100, help="Timed calls per case", type=int
+    )
+    conv_parser.set_defaults(function=benchmark_conv)
+
+    packed_parser = subparsers.add_parser(
+        "packed", help="Packed RNNFieldClassifer against the padded LSTM"
+    )
+    packed_parser.add_argument(
+        "-batch",
+        "--batch-size",
+        default=BATCH_SIZE,
+        help="Batch size of the dataset batches",
+        type=int,
+    )
+    packed_parser.add_argument(
+        "-n", "--batches", default=50, help="Timed batches per case", type=int
+    )
+    packed_parser.add_argument(
+        "--split",
+        default="train",
+        choices=["train", "test"],
+        help="Split the batches are taken from",
+    )
+    packed_parser.set_defaults(function=benchmark_packed)
+
+    ensemble_parser = subparsers.add_parser(
+        "ensemble", help="Ensemble with a shared embedding against its members"
+    )
+    ensemble_parser.add_argument(
+        "-m",
+        "--members",
+        default=["RNNHiddenClassifier", "CNN1dClassifier", "CNN1dExtraLayerClassifier"],
+        nargs="+",
+        choices=CLASSIFIERS,
+        help="Classifiers of the ensemble",
+    )
+    ensemble_parser.add_argument(
+        "--combine",
+        default="mean",
+        choices=COMBINE_METHODS,
+        help="How the ensemble combines its members",
+    )
+    ensemble_parser.add_argument(
+        "-et",
+        "--ensemble-threads",
+        default=3,
+        help="Members run at once by the threaded ensemble",
+        type=int,
+    )
+    ensemble_parser.add_argument(
+        "-batch",
+        "--batch-size",
+        default=BATCH_SIZE,
+        help="Batch size of the dataset batches",
+        type=int,
+    )
+    ensemble_parser.add_argument(
+        "-n", "--batches", default=50, help="Timed batches per case", type=int
+    )
+    ensemble_parser.add_argument(
+        "--split",
+        default="test",
+        choices=["train", "test"],
+        help="Split the batches are taken from",
+    )
+    ensemble_parser.set_defaults(function=benchmark_ensemble)
+
+    sparse_parser = subparsers.add_parser(
+        "sparse", help="Training step with sparse embedding gradients against dense"
+    )
+    sparse_parser.add_argument(
+        "-m",
+        "--model",
+        default="RNNHiddenClassifier",
+        choices=CLASSIFIERS,
+        help="Classifier to train",
+    )
+    sparse_parser.add_argument(
+        "--vocab-sizes",
+        default=[MAX_VOCAB, 4 * MAX_VOCAB],
+        nargs="+",
+        help="Rows of the trained embedding table",
+        type=int,
+    )
+    sparse_parser.add_argument(
+        "-batch",
+        "--batch-size",
+        default=BATCH_SIZE,
+        help="Batch size of the dataset batches",
+        type=int,
+    )
+    sparse_parser.add_argument(
+        "-n", "--batches", default=50, help="Timed batches per case", type=int
+    )
+    sparse_parser.add_argument(
+        "--split",
+        default="train",
+        choices=["train", "test"],
+        help="Split the batches are taken from",
+    )
+    sparse_parser.set_defaults(function=benchmark_sparse)
+
+    args = parser.parse_args()
+
+    seed_all(SEED)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    logger.debug("Benchmarking with {} threads".format(torch.get_num_threads()))
+
+    args.function(args)
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
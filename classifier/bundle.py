@@ -0,0 +1,160 @@
+"""
+Self contained checkpoint bundles of the trained classifiers
+
+A bundle is a directory holding everything needed to rebuild a classifier
+without the dataset
+
+```
+    bundle.json         version, classifier, dataset, hyperparameters,
+                        tokenizer and the shape and dtype of every tensor
+    vocab.pickle        vocabularies of the dataset fields without vectors
+    weights/<name>.npy  one array per state_dict entry
+```
+On load the model is rebuilt from its hyperparameters and every parameter is
+pointed at its memory mapped array, so weights are only read from disk when
+they are first used.
+"""
+
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+
+import numpy as np
+import torch
+
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL, SPACY_MODEL, device
+from datasetloader import GrammarDasetAnswerTag, GrammarDasetMultiTag
+from modelbuilder import build_model
+from utility import tokenizer
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Bump whenever the layout of the bundle changes
+BUNDLE_VERSION = 1
+
+DATASETS = {"multi": GrammarDasetMultiTag, "answeronly": GrammarDasetAnswerTag}
+
+
+def weight_location(location, name):
+    return os.path.join(location, "weights", "{}.npy".format(name))
+
+
+def save_bundle(location, model, classifier_type, hyperparameters, dataset, dataset_tag):
+    """
+    Write a bundle, an existing bundle at location is only replaced once the
+    new one is complete
+    Input:
+        location: string -> Directory of the bundle
+        model: nn.Module -> Classifier built by modelbuilder.build_model
+        classifier_type: string -> Name the classifier was built with
+        hyperparameters: dict -> Hyperparameters it was built with
+        dataset: GrammarDataset -> Dataset holding the vocabularies
+        dataset_tag: string -> multi or answeronly
+    """
+    partial_location = location + ".partial"
+    if os.path.exists(partial_location):
+        shutil.rmtree(partial_location)
+    os.makedirs(os.path.join(partial_location, "weights"))
+
+    tensors = {}
+    for name, tensor in model.state_dict().items():
+        array = tensor.detach().cpu().numpy()
+        np.save(weight_location(partial_location, name), array)
+        tensors[name] = {"shape": list(array.shape), "dtype": str(array.dtype)}
+
+    # Vectors are already part of the embedding weights, fields of bundles
+    # written before the field existed have no vocabulary
+    vocabs = {
+        name: getattr(dataset, name).vocab
+        for name in dataset.vocab_fields
+        if hasattr(getattr(dataset, name), "vocab")
+    }
+    vectors = {name: vocab.vectors for name, vocab in vocabs.items()}
+    for vocab in vocabs.values():
+        vocab.vectors = None
+    try:
+        with open(os.path.join(partial_location, "vocab.pickle"), "wb") as vocab_file:
+            pickle.dump(vocabs, vocab_file, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for name, vocab in vocabs.items():
+            vocab.vectors = vectors[name]
+
+    with open(os.path.join(partial_location, "bundle.json"), "w") as bundle_file:
+        json.dump(
+            {
+                "version": BUNDLE_VERSION,
+                "classifier": classifier_type,
+                "dataset": dataset_tag,
+                "hyperparameters": hyperparameters,
+                "tokenizer": {"model": SPACY_MODEL, "signature": tokenizer.signature},
+                "tensors": tensors,
+            },
+            bundle_file,
+            indent=2,
+        )
+
+    if os.path.exists(location):
+        shutil.rmtree(location)
+    os.rename(partial_location, location)
+    logger.debug("Saved bundle to {}".format(location))
+
+
+def load_bundle(location, device=device):
+    """
+    Rebuild the classifier of a bundle in eval mode
+    Output:
+        model: nn.Module -> Classifier with memory mapped weights on the cpu
+        dataset: GrammarDataset -> Dataset with the vocabularies of the bundle
+        meta: dict -> Content of bundle.json
+    """
+    start_time = time.time()
+
+    with open(os.path.join(location, "bundle.json")) as bundle_file:
+        meta = json.load(bundle_file)
+
+    if meta["version"] != BUNDLE_VERSION:
+        raise ValueError(
+            "Bundle version {} is not supported, expected {}".format(
+                meta["version"], BUNDLE_VERSION
+            )
+        )
+    if meta["tokenizer"]["model"] != SPACY_MODEL:
+        logger.warning(
+            "Bundle was tokenized with {} but {} is configured".format(
+                meta["tokenizer"]["model"], SPACY_MODEL
+            )
+        )
+
+    dataset = DATASETS[meta["dataset"]]()
+    with open(os.path.join(location, "vocab.pickle"), "rb") as vocab_file:
+        for name, vocab in pickle.load(vocab_file).items():
+            getattr(dataset, name).vocab = vocab
+
+    model = build_model(meta["classifier"], dataset, meta["hyperparameters"])
+
+    # Copy on write keeps the files untouched if the weights are trained further
+    for name, tensor in model.state_dict(keep_vars=True).items():
+        tensor.data = torch.from_numpy(
+            np.load(weight_location(location, name), mmap_mode="c")
+        )
+
+    model = model.to(device)
+    model.eval()
+
+    logger.debug(
+        "Loaded bundle {} in {:.4f}s".format(location, time.time() - start_time)
+    )
+    return model, dataset, meta
+
+
+def load_model(location, device=device):
+    """Model of a bundle directory or of a file written by torch.save"""
+    if os.path.isdir(location):
+        model, _, _ = load_bundle(location, device)
+        return model
+    return torch.load(location, map_location=device)
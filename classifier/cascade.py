@@ -0,0 +1,428 @@
+"""
+Confidence gated cascade of a cheap and an expensive classifier run this file by
+
+```
+    >>> python cascade.py tune --fast trained/CNN1dClassifier \
+            --slow trained/RNNHiddenClassifier --target-accuracy 0.9
+    >>> python cascade.py predict -i questions.tsv -o predictions.tsv \
+            --calibration trained/cascade.json
+```
+The fast model predicts every record and only the records it is unsure of,
+whose confidence is below the threshold, are predicted again by the slow
+model, an EnsembleClassifier if several slow locations are given. Confidence
+is the margin between the two most probable classes or one minus the entropy
+of the class probabilities normalized by its maximum.
+
+tune runs both models over labeled records, the processed test split by
+default, and picks the lowest threshold whose cascade reaches the target
+accuracy, so as little traffic as possible is escalated. The threshold is
+written to a json calibration file together with the measured accuracies,
+the escalated fraction and the expected mean latency per record. predict
+runs the cascade over a file like predict.py and reports the fraction of
+records escalated and the mean latency per record.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import time
+
+import torch
+
+from config.data import PROCESSED_DATASET
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    TRAINED_CLASSIFIER_FOLDER,
+)
+from model import COMBINE_METHODS
+from predict import PREDICTION_CHUNK_SIZE, Predictor, predict_file, read_records
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+CONFIDENCE_MEASURES = ["margin", "entropy"]
+# Column of the processed dataset holding the type of question
+LABEL_COLUMN = "Type of Question"
+CASCADE_CALIBRATION = os.path.join(TRAINED_CLASSIFIER_FOLDER, "cascade.json")
+
+
+def confidence_scores(probabilities, measure):
+    """Confidence in [0, 1] of every row of class probabilities"""
+    if measure == "margin":
+        top = probabilities.topk(2, dim=1)[0]
+        return top[:, 0] - top[:, 1]
+    if measure == "entropy":
+        entropy = -(probabilities * probabilities.clamp_min(1e-12).log()).sum(dim=1)
+        return 1 - entropy / math.log(probabilities.shape[1])
+    raise ValueError(
+        "Unknown confidence measure {}, expected one of {}".format(
+            measure, CONFIDENCE_MEASURES
+        )
+    )
+
+
+class CascadePredictor:
+    """
+    Runs the fast predictor on every record and the slow predictor on the
+    records whose confidence is below the threshold, predicts the main label
+    of both and counts the escalated records and the time spent
+    Input:
+        fast: Predictor -> Cheap model run on every record
+        slow: Predictor -> Expensive model run on the unsure records
+        threshold: float -> Records less confident than it are escalated
+        measure: string -> One of CONFIDENCE_MEASURES
+    """
+
+    def __init__(self, fast, slow, threshold, measure="margin"):
+        if fast.labels != slow.labels:
+            raise ValueError("The fast and slow models predict different labels")
+
+        self.fast = fast
+        self.slow = slow
+        self.threshold = threshold
+        self.measure = measure
+        self.tasks = fast.tasks[:1]
+        self.task_labels = {self.tasks[0]: fast.labels}
+        self.labels = fast.labels
+
+        self.records = 0
+        self.escalated = 0
+        self.seconds = 0.0
+
+    def close(self):
+        self.fast.close()
+        self.slow.close()
+
+    @property
+    def escalated_fraction(self):
+        return self.escalated / max(self.records, 1)
+
+    @property
+    def mean_latency_ms(self):
+        """Mean milliseconds spent per record"""
+        return 1000 * self.seconds / max(self.records, 1)
+
+    def predict_probabilities(self, records):
+        """Returns the class probabilities of the records in input order"""
+        start_time = time.perf_counter()
+
+        probabilities = self.fast.predict_probabilities(records)
+        confidences = confidence_scores(probabilities, self.measure)
+        unsure = (confidences < self.threshold).nonzero().squeeze(1).tolist()
+        if unsure:
+            probabilities[unsure] = self.slow.predict_probabilities(
+                [records[index] for index in unsure]
+            )
+
+        self.records += len(records)
+        self.escalated += len(unsure)
+        self.seconds += time.perf_counter() - start_time
+        return probabilities
+
+    def predict_tasks(self, records):
+        """Same as Predictor.predict_tasks for the main label"""
+        name = self.tasks[0]
+        probabilities = self.predict_probabilities(records)
+        confidences, predictions = probabilities.max(dim=1)
+        for prediction, confidence, probability in zip(
+            predictions.tolist(), confidences.tolist(), probabilities.tolist()
+        ):
+            yield {name: (self.labels[prediction], confidence, probability)}
+
+    def predict(self, records):
+        """Yields the predicted label and the class probabilities of every record"""
+        for result in self.predict_tasks(records):
+            yield result[self.tasks[0]]
+
+
+def timed_probabilities(predictor, records):
+    """
+    Class probabilities of the records and the milliseconds per record of the
+    model, the records are tokenized before the clock starts
+    """
+    encoded = predictor.encode(records)
+    start_time = time.perf_counter()
+    probabilities = predictor.encoded_task_probabilities(encoded, len(records))
+    milliseconds = 1000 * (time.perf_counter() - start_time) / len(records)
+    return probabilities[predictor.tasks[0]], milliseconds
+
+
+def tune_threshold(fast_correct, slow_correct, confidences, target_accuracy):
+    """
+    Lowest threshold whose cascade reaches the target accuracy, escalating
+    the least confident records first. When the target can not be reached
+    the threshold of the most accurate cascade is returned
+    Output:
+        threshold: float -> Records less confident than it are escalated
+        reached: bool -> Whether the target accuracy is reached
+    """
+    order = confidences.argsort()
+    fast_correct = fast_correct[order].float()
+    slow_correct = slow_correct[order].float()
+    confidences = confidences[order]
+
+    # Correct predictions when the k least confident records are escalated
+    correct = torch.cat([torch.zeros(1), slow_correct.cumsum(0)]) + torch.cat(
+        [fast_correct.flip(0).cumsum(0).flip(0), torch.zeros(1)]
+    )
+    accuracies = correct / len(confidences)
+
+    reached = (accuracies >= target_accuracy).nonzero()
+    escalate = reached[0].item() if len(reached) else accuracies.argmax().item()
+
+    if escalate == 0:
+        return 0.0, bool(len(reached))
+
+    # Records tied with the last escalated one are escalated too
+    above = confidences[escalate:] > confidences[escalate - 1]
+    if not above.any():
+        return float("inf"), bool(len(reached))
+    return confidences[escalate:][above][0].item(), bool(len(reached))
+
+
+def tune(args):
+    records = [
+        record
+        for record in read_records(args.input)
+        if record.get(LABEL_COLUMN, "").strip()
+    ]
+
+    fast = Predictor.from_trained(args.fast, args.tag, args.batch_size)
+    slow = Predictor.from_trained(
+        args.slow, args.tag, args.batch_size, args.combine, args.ensemble_threads
+    )
+
+    # Labels the models were not trained on are never predicted right
+    gold = torch.tensor(
+        [
+            fast.labels.index(record[LABEL_COLUMN].strip())
+            if record[LABEL_COLUMN].strip() in fast.labels
+            else -1
+            for record in records
+        ]
+    )
+
+    fast_probabilities, fast_ms = timed_probabilities(fast, records)
+    slow_probabilities, slow_ms = timed_probabilities(slow, records)
+    slow.close()
+    fast_correct = fast_probabilities.argmax(dim=1) == gold
+    slow_correct = slow_probabilities.argmax(dim=1) == gold
+    confidences = confidence_scores(fast_probabilities, args.measure)
+
+    threshold, reached = tune_threshold(
+        fast_correct, slow_correct, confidences, args.target_accuracy
+    )
+    if not reached:
+        logger.warning(
+            "No threshold reaches an accuracy of {}, using the most accurate".format(
+                args.target_accuracy
+            )
+        )
+
+    escalated = confidences < threshold
+    accuracy = torch.where(escalated, slow_correct, fast_correct).float().mean()
+    escalated_fraction = escalated.float().mean().item()
+
+    calibration = {
+        "fast": args.fast,
+        "slow": args.slow,
+        "combine": args.combine,
+        "measure": args.measure,
+        "threshold": threshold,
+        "target_accuracy": args.target_accuracy,
+        "records": len(records),
+        "fast_accuracy": fast_correct.float().mean().item(),
+        "slow_accuracy": slow_correct.float().mean().item(),
+        "accuracy": accuracy.item(),
+        "escalated_fraction": escalated_fraction,
+        "batch_size": fast.batch_size,
+        "fast_ms": fast_ms,
+        "slow_ms": slow_ms,
+        # The escalated records are predicted again by the slow model
+        "expected_ms": fast_ms + escalated_fraction * slow_ms,
+    }
+
+    print("{:<10}{:>10}{:>12}{:>14}".format("", "Acc", "Escalated", "ms / record"))
+    for name, prefix, fraction in (
+        ("Fast", "fast_", 0.0),
+        ("Slow", "slow_", 1.0),
+        ("Cascade", "", escalated_fraction),
+    ):
+        print(
+            "{:<10}{:>10.4f}{:>12.2%}{:>14.3f}".format(
+                name,
+                calibration[prefix + "accuracy"],
+                fraction,
+                calibration[(prefix or "expected_") + "ms"],
+            )
+        )
+    print("{} threshold: {:.4f}".format(args.measure, threshold))
+
+    folder = os.path.dirname(args.calibration)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(args.calibration, "w") as calibration_file:
+        json.dump(calibration, calibration_file, indent=2)
+    logger.info("Saved the calibration to {}".format(args.calibration))
+
+
+def predict(args):
+    calibration = {}
+    if args.calibration and os.path.exists(args.calibration):
+        with open(args.calibration) as calibration_file:
+            calibration = json.load(calibration_file)
+
+    fast = args.fast or calibration.get("fast")
+    slow = args.slow or calibration.get("slow")
+    threshold = (
+        args.threshold if args.threshold is not None else calibration.get("threshold")
+    )
+    if not fast or not slow or threshold is None:
+        raise SystemExit(
+            "The fast and slow models and the threshold are needed, pass them or "
+            "a calibration written by cascade.py tune"
+        )
+
+    cascade = CascadePredictor(
+        Predictor.from_trained(fast, args.tag, args.batch_size),
+        Predictor.from_trained(
+            slow,
+            args.tag,
+            args.batch_size,
+            args.combine or calibration.get("combine", "mean"),
+            args.ensemble_threads,
+        ),
+        threshold,
+        args.measure or calibration.get("measure", "margin"),
+    )
+
+    try:
+        count = predict_file(cascade, args.input, args.output, args.chunk_size)
+    finally:
+        cascade.close()
+
+    logger.info(
+        "Predicted {} records, {:.2%} escalated, {:.3f}ms per record".format(
+            count, cascade.escalated_fraction, cascade.mean_latency_ms
+        )
+    )
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to run a cheap classifier before an expensive one"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    tune_parser = subparsers.add_parser(
+        "tune", help="Pick the threshold reaching a target accuracy"
+    )
+    tune_parser.add_argument(
+        "-i",
+        "--input",
+        default=PROCESSED_DATASET["test"],
+        help="Labeled tsv or jsonl records the threshold is tuned on",
+    )
+    tune_parser.add_argument(
+        "--target-accuracy",
+        default=0.9,
+        help="Accuracy the cascade has to reach",
+        type=float,
+    )
+    tune_parser.set_defaults(function=tune)
+
+    predict_parser = subparsers.add_parser(
+        "predict", help="Predict a file with the cascade"
+    )
+    predict_parser.add_argument(
+        "-i", "--input", required=True, help="Input tsv or jsonl file to predict"
+    )
+    predict_parser.add_argument(
+        "-o",
+        "--output",
+        default="predictions.tsv",
+        help="Output file, written as jsonl if it ends with .jsonl otherwise tsv",
+    )
+    predict_parser.add_argument(
+        "--threshold",
+        default=None,
+        help="Confidence threshold, overrides the calibration",
+        type=float,
+    )
+    predict_parser.add_argument(
+        "-c",
+        "--chunk-size",
+        default=PREDICTION_CHUNK_SIZE,
+        help="Number of records read, bucketed and written at once",
+        type=int,
+    )
+    predict_parser.set_defaults(function=predict)
+
+    for subparser, required in ((tune_parser, True), (predict_parser, False)):
+        subparser.add_argument(
+            "--fast",
+            default=None,
+            required=required,
+            help="Location of the cheap model run on every record",
+        )
+        subparser.add_argument(
+            "--slow",
+            default=None,
+            required=required,
+            nargs="+",
+            help="Location of the expensive model, several are run as an ensemble",
+        )
+        subparser.add_argument(
+            "--measure",
+            default="margin" if required else None,
+            choices=CONFIDENCE_MEASURES,
+            help="Confidence of the fast model the threshold applies to",
+        )
+        subparser.add_argument(
+            "--calibration",
+            default=CASCADE_CALIBRATION,
+            help="Json file the tuned threshold is written to and read from",
+        )
+        subparser.add_argument(
+            "-t",
+            "--tag",
+            default="answeronly",
+            choices=["multi", "answeronly"],
+            help="Dataset type the models were trained on, bundles know their own",
+        )
+        subparser.add_argument(
+            "-batch",
+            "--batch_size",
+            default=None,
+            help="Records in a forward pass, defaults to the autotuned or BATCH_SIZE",
+            type=int,
+        )
+        subparser.add_argument(
+            "--combine",
+            default="mean" if required else None,
+            choices=COMBINE_METHODS,
+            help="How an ensemble of slow models combines its members",
+        )
+        subparser.add_argument(
+            "-et",
+            "--ensemble-threads",
+            default=0,
+            help="Ensemble members run at once, 0 runs them in turn",
+            type=int,
+        )
+
+    args = parser.parse_args()
+
+    args.function(args)
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
@@ -0,0 +1,383 @@
+"""
+Compiled form of the processed datasets
+
+The vocabularies, their pretrained vectors and every numericalized sequence
+are written once to a directory keyed by the hash of the configuration that
+produced them. Sequences are stored as flat int32 token arrays with offsets
+and lengths and are memory mapped on load, so an unchanged configuration
+skips parsing, tokenization and vocabulary building entirely.
+
+```
+    >>> python compileddataset.py --tag multi
+    >>> python compileddataset.py --tag answeronly --force
+```
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import pickle
+import random
+import shutil
+import time
+from itertools import chain
+
+import numpy as np
+import torch
+
+from config.data import COMPILED_DATASET_FOLDER, PROCESSED_DATASET
+from config.hyperparameters import MAX_VOCAB
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL, device
+from utility import tokenizer
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Bump whenever the layout of the compiled files changes
+COMPILED_DATASET_VERSION = 4
+SPLITS = ("train", "test")
+# Split holding the train examples followed by the test examples, the folds
+# of cross validation are subsets of it
+POOLED_SPLIT = "all"
+# Same pool size as torchtext.data.pool uses to bucket examples of similar length
+BUCKET_POOL_BATCHES = 100
+
+
+def config_hash(dataset_name, vectors):
+    """Hash of everything that changes the compiled dataset"""
+    processed = {}
+    for split in SPLITS:
+        stat = os.stat(PROCESSED_DATASET[split])
+        processed[split] = [PROCESSED_DATASET[split], stat.st_size, stat.st_mtime_ns]
+
+    spec = {
+        "version": COMPILED_DATASET_VERSION,
+        "dataset": dataset_name,
+        "max_vocab": MAX_VOCAB,
+        "vectors": vectors,
+        "tokenizer": tokenizer.signature,
+        "split": processed,
+    }
+    return hashlib.blake2b(
+        json.dumps(spec, sort_keys=True).encode("utf8"), digest_size=8
+    ).hexdigest()
+
+
+def compiled_location(dataset_name, vectors):
+    return os.path.join(
+        COMPILED_DATASET_FOLDER,
+        "{}-{}".format(dataset_name, config_hash(dataset_name, vectors)),
+    )
+
+
+def array_location(location, split, name, kind):
+    return os.path.join(location, "{}.{}.{}.npy".format(split, name, kind))
+
+
+def numericalize(field, tokens):
+    """Same conversion as Field.process without the padding"""
+    if field.lower:
+        tokens = [token.lower() for token in tokens]
+    if field.init_token is not None:
+        tokens = [field.init_token] + tokens
+    if field.eos_token is not None:
+        tokens = tokens + [field.eos_token]
+    return [field.vocab.stoi[token] for token in tokens]
+
+
+def flatten(sequences):
+    """Flat int32 tokens, offsets and lengths of a list of index sequences"""
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int32)
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = np.fromiter(
+        chain.from_iterable(sequences), dtype=np.int32, count=offsets[-1]
+    )
+    return tokens, offsets, lengths
+
+
+def compile_dataset(location, sequences, labels, vocabs):
+    """
+    Write a compiled dataset
+    Input:
+        location: string -> Directory of the compiled dataset
+        sequences: dict -> Split name to a dict of sequence name to the list
+            of index sequences of every example
+        labels: dict -> Split name to a dict of label name to the list of
+            label indexes of every example
+        vocabs: dict -> Name to Vocab of every field the dataset reads
+    """
+    start_time = time.time()
+    # Named per process so concurrent compiles never remove each other's
+    partial_location = "{}.{}.partial".format(location, os.getpid())
+    if os.path.exists(partial_location):
+        shutil.rmtree(partial_location)
+    os.makedirs(partial_location)
+
+    sizes = {}
+    for split, split_sequences in sequences.items():
+        for name, index_sequences in split_sequences.items():
+            sizes[split] = len(index_sequences)
+            tokens, offsets, lengths = flatten(index_sequences)
+            np.save(array_location(partial_location, split, name, "tokens"), tokens)
+            np.save(array_location(partial_location, split, name, "offsets"), offsets)
+            np.save(array_location(partial_location, split, name, "lengths"), lengths)
+
+        for name, label_indexes in labels[split].items():
+            np.save(
+                array_location(partial_location, split, name, "labels"),
+                np.array(label_indexes, dtype=np.int64),
+            )
+
+    # Vocabularies shared between fields are pickled once and stay shared,
+    # their vectors are stored next to them as plain arrays
+    vectors = {}
+    for name, vocab in vocabs.items():
+        if vocab.vectors is not None and id(vocab) not in vectors:
+            vectors[id(vocab)] = (name, vocab.vectors)
+            np.save(
+                os.path.join(partial_location, "{}.vectors.npy".format(name)),
+                vocab.vectors.numpy(),
+            )
+            vocab.vectors = None
+
+    with open(os.path.join(partial_location, "vocab.pickle"), "wb") as vocab_file:
+        pickle.dump(vocabs, vocab_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    for name, vocab_vectors in vectors.values():
+        vocabs[name].vectors = vocab_vectors
+
+    with open(os.path.join(partial_location, "meta.json"), "w") as meta_file:
+        json.dump(
+            {
+                "version": COMPILED_DATASET_VERSION,
+                "sizes": sizes,
+                "sequence_fields": list(next(iter(sequences.values()))),
+                "label_fields": list(next(iter(labels.values()))),
+                "vectors": [name for name, _ in vectors.values()],
+            },
+            meta_file,
+            indent=2,
+        )
+
+    # A forced compile moves the previous one aside, readers keep the memory
+    # mapped files of it they already opened
+    old_location = "{}.{}.old".format(location, os.getpid())
+    try:
+        os.rename(location, old_location)
+    except FileNotFoundError:
+        pass
+    else:
+        shutil.rmtree(old_location)
+
+    try:
+        os.rename(partial_location, location)
+    except OSError:
+        # Another process finished the same compile in the meantime
+        if not os.path.exists(location):
+            raise
+        shutil.rmtree(partial_location)
+    logger.debug(
+        "Compiled dataset to {} in {:.4f}s".format(location, time.time() - start_time)
+    )
+
+
+class Batch:
+    """
+    Attribute container mirroring torchtext.data.Batch, indices holds the
+    position of every column of the batch in its split
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+
+
+class CompiledIterator:
+    """
+    Replacement of torchtext's BucketIterator over a compiled split. Examples
+    of similar length are batched together, every batch is sorted by
+    decreasing length and padded to its own longest sequence
+    """
+
+    def __init__(
+        self,
+        sequences,
+        labels,
+        pad_indexes,
+        batch_size,
+        train,
+        indices=None,
+        device=device,
+    ):
+        self.sequences = sequences
+        self.labels = labels
+        self.pad_indexes = pad_indexes
+        self.batch_size = batch_size
+        self.train = train
+        self.device = device
+
+        n_examples = len(next(iter(sequences.values()))[2])
+        self.indices = np.arange(n_examples) if indices is None else np.asarray(indices)
+        self.sort_key = sum(
+            lengths[self.indices] for _, _, lengths in self.sequences.values()
+        )
+
+    def __len__(self):
+        return math.ceil(len(self.indices) / self.batch_size)
+
+    def batch_positions(self):
+        """Positions into self.indices of every batch of this epoch"""
+        if not self.train:
+            order = np.argsort(self.sort_key, kind="stable")
+            return [
+                order[start : start + self.batch_size]
+                for start in range(0, len(order), self.batch_size)
+            ]
+
+        order = np.random.permutation(len(self.indices))
+        pool_size = self.batch_size * BUCKET_POOL_BATCHES
+        batches = []
+        for pool_start in range(0, len(order), pool_size):
+            pool = order[pool_start : pool_start + pool_size]
+            pool = pool[np.argsort(self.sort_key[pool], kind="stable")]
+            batches.extend(
+                pool[start : start + self.batch_size]
+                for start in range(0, len(pool), self.batch_size)
+            )
+        random.shuffle(batches)
+        return batches
+
+    def make_batch(self, examples):
+        batch = Batch(len(examples))
+        batch.indices = examples
+
+        for name, (tokens, offsets, lengths) in self.sequences.items():
+            batch_lengths = lengths[examples].astype(np.int64)
+            padded = np.full(
+                (batch_lengths.max(), len(examples)),
+                self.pad_indexes[name],
+                dtype=np.int64,
+            )
+            for column, example in enumerate(examples):
+                padded[: batch_lengths[column], column] = tokens[
+                    offsets[example] : offsets[example + 1]
+                ]
+            setattr(
+                batch,
+                name,
+                (
+                    torch.from_numpy(padded).to(self.device),
+                    torch.from_numpy(batch_lengths).to(self.device),
+                ),
+            )
+
+        for name, labels in self.labels.items():
+            setattr(
+                batch,
+                name,
+                torch.from_numpy(np.asarray(labels[examples])).to(self.device),
+            )
+
+        return batch
+
+    def __iter__(self):
+        for positions in self.batch_positions():
+            positions = positions[np.argsort(-self.sort_key[positions], kind="stable")]
+            yield self.make_batch(self.indices[positions])
+
+
+class CompiledDataset:
+    """Memory mapped view of a compiled dataset directory"""
+
+    def __init__(self, location):
+        self.location = location
+
+        with open(os.path.join(location, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+
+        with open(os.path.join(location, "vocab.pickle"), "rb") as vocab_file:
+            self.vocabs = pickle.load(vocab_file)
+
+        for name in self.meta["vectors"]:
+            # Copy on write keeps the file untouched if the tensor is modified
+            self.vocabs[name].vectors = torch.from_numpy(
+                np.load(
+                    os.path.join(location, "{}.vectors.npy".format(name)),
+                    mmap_mode="c",
+                )
+            )
+
+        self.sequences = {
+            split: {
+                name: tuple(
+                    np.load(array_location(location, split, name, kind), mmap_mode="r")
+                    for kind in ("tokens", "offsets", "lengths")
+                )
+                for name in self.meta["sequence_fields"]
+            }
+            for split in self.meta["sizes"]
+        }
+        self.labels = {
+            split: {
+                name: np.load(
+                    array_location(location, split, name, "labels"), mmap_mode="r"
+                )
+                for name in self.meta["label_fields"]
+            }
+            for split in self.meta["sizes"]
+        }
+
+    def iterator(
+        self, split, batch_size, train, pad_indexes, indices=None, device=device
+    ):
+        return CompiledIterator(
+            self.sequences[split],
+            self.labels[split],
+            pad_indexes,
+            batch_size,
+            train,
+            indices,
+            device,
+        )
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to compile the processed dataset"
+    )
+
+    parser.add_argument(
+        "-t",
+        "--tag",
+        default="answeronly",
+        choices=["multi", "answeronly"],
+        help="Use two different dataset type, multi type and Answer only",
+    )
+
+    parser.add_argument(
+        "-f",
+        "--force",
+        default=False,
+        action="store_true",
+        help="Compile again even if the configuration did not change",
+    )
+
+    args = parser.parse_args()
+
+    from datasetloader import GrammarDasetAnswerTag, GrammarDasetMultiTag
+
+    if args.tag == "multi":
+        GrammarDasetMultiTag.compile_if_needed(force=args.force)
+    else:
+        GrammarDasetAnswerTag.compile_if_needed(force=args.force)
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
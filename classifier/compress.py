@@ -0,0 +1,253 @@
+"""
+Product quantization of the embedding table of a trained classifier run this
+file by
+
+```
+    >>> python compress.py --model-location trained/RNNHiddenClassifier
+    >>> python compress.py -loc trained/CNN1dClassifier --subvectors 30
+```
+Every row of the embedding table is split into --subvectors parts and each
+part is replaced by the uint8 code of its nearest k-means centroid, see
+model.PQEmbedding. Bundles are written as a bundle next to the float one,
+<model>.pq, whose hyperparameters rebuild the compressed table, files written
+by torch.save as <model>.pq.pt. Both models are compared on the test split
+for accuracy, serialized size and p50/p99 CPU latency, together with the
+relative squared error of the reconstructed table. Tables with fewer rows than
+a codebook has centroids, like the tag embedding, stay as they are.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from config.hyperparameters import (
+    BATCH_SIZE,
+    PQ_CENTROIDS,
+    PQ_ITERATIONS,
+    PQ_SUBVECTORS,
+)
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    TRAINED_CLASSIFIER_FOLDER,
+    TRAINED_CLASSIFIER_DEFAULT,
+)
+from bundle import DATASETS, load_bundle, save_bundle
+from model import PQEmbedding
+from quantize import cpu, model_size, report
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+
+def compress(model, n_subvectors, n_centroids=PQ_CENTROIDS, iterations=PQ_ITERATIONS):
+    """PQEmbedding copy of the model, the float model is left untouched"""
+    model = copy.deepcopy(model)
+
+    # Tables shared by several modules are quantized once and stay shared
+    compressed = {}
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, nn.Embedding) and child.num_embeddings > n_centroids:
+                if id(child) not in compressed:
+                    compressed[id(child)] = PQEmbedding.from_embedding(
+                        child, n_subvectors, n_centroids, iterations
+                    )
+                setattr(parent, name, compressed[id(child)])
+
+    return model
+
+
+def embedding_size(model):
+    """Size in bytes of the serialized embedding tables"""
+    return sum(
+        model_size(module)
+        for module in model.modules()
+        if isinstance(module, (nn.Embedding, PQEmbedding))
+    )
+
+
+def reconstruction_error(model, compressed_model):
+    """Squared error of the compressed tables relative to the float ones"""
+    modules = dict(model.named_modules())
+    error, total = 0.0, 0.0
+    with torch.no_grad():
+        for name, module in compressed_model.named_modules():
+            if isinstance(module, PQEmbedding):
+                weight = modules[name].weight.float()
+                error += (module.weight - weight).pow(2).sum().item()
+                total += weight.pow(2).sum().item()
+    return error / total
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to product quantize the embeddings of a trained model"
+    )
+
+    parser.add_argument(
+        "-loc",
+        "--model-location",
+        default=os.path.join(TRAINED_CLASSIFIER_FOLDER, TRAINED_CLASSIFIER_DEFAULT),
+        help="Location of the trained model",
+    )
+    parser.add_argument(
+        "-t",
+        "--tag",
+        default="answeronly",
+        choices=["multi", "answeronly"],
+        help="Dataset type the model was trained on, bundles know their own",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Location of the compressed model, defaults to <model>.pq(.pt)",
+    )
+    parser.add_argument(
+        "-s",
+        "--subvectors",
+        default=PQ_SUBVECTORS,
+        help="Number of parts every embedding row is split into",
+        type=int,
+    )
+    parser.add_argument(
+        "-c",
+        "--centroids",
+        default=PQ_CENTROIDS,
+        help="Centroids of the codebook of every part, at most 256",
+        type=int,
+    )
+    parser.add_argument(
+        "-i",
+        "--iterations",
+        default=PQ_ITERATIONS,
+        help="K-means iterations of every codebook",
+        type=int,
+    )
+    parser.add_argument(
+        "-batch",
+        "--batch_size",
+        default=BATCH_SIZE,
+        help="Batch size of the accuracy evaluation",
+        type=int,
+    )
+    parser.add_argument(
+        "-lb",
+        "--latency-batch-size",
+        default=1,
+        help="Batch size of the latency measurement",
+        type=int,
+    )
+    parser.add_argument(
+        "-ln",
+        "--latency-batches",
+        default=500,
+        help="Number of batches timed for the latency percentiles, at least 1",
+        type=int,
+    )
+    parser.add_argument(
+        "-r", "--report", default=None, help="Also write the report to a json file"
+    )
+
+    args = parser.parse_args()
+
+    if args.latency_batches < 1:
+        parser.error("--latency-batches has to be at least 1")
+
+    location = args.model_location.rstrip(os.sep)
+    meta = None
+    if os.path.isdir(location):
+        model, bundle_dataset, meta = load_bundle(location, cpu)
+        args.tag = meta["dataset"]
+    else:
+        model = torch.load(location, map_location=cpu)
+        model.eval()
+
+    dataset_class = DATASETS[args.tag]
+    dataset = dataset_class()
+    dataset.load_compiled(dataset_class.compile_if_needed())
+
+    compressed_model = compress(
+        model, args.subvectors, args.centroids, args.iterations
+    )
+
+    if meta:
+        output = args.output or "{}.pq".format(location)
+        hyperparameters = dict(
+            meta["hyperparameters"],
+            pq_embedding={
+                "n_subvectors": args.subvectors,
+                "n_centroids": args.centroids,
+            },
+        )
+        save_bundle(
+            output,
+            compressed_model,
+            meta["classifier"],
+            hyperparameters,
+            bundle_dataset,
+            meta["dataset"],
+        )
+    else:
+        output = args.output or "{}.pq.pt".format(os.path.splitext(location)[0])
+        torch.save(compressed_model, output)
+    logger.info("Saved compressed model to {}".format(output))
+
+    results = {}
+    for name, candidate in (("float", model), ("pq", compressed_model)):
+        results[name] = report(
+            candidate,
+            dataset,
+            args.batch_size,
+            args.latency_batch_size,
+            args.latency_batches,
+        )
+        results[name]["embedding_mb"] = embedding_size(candidate) / 2 ** 20
+    results["delta"] = {
+        key: results["pq"][key] - results["float"][key] for key in results["float"]
+    }
+    error = reconstruction_error(model, compressed_model)
+
+    print(
+        "{:<8}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+            "", "Acc", "Macro F1", "Size MB", "Emb MB", "p50 ms", "p99 ms"
+        )
+    )
+    for name, result in results.items():
+        print(
+            "{:<8}{:>10.4f}{:>10.4f}{:>10.2f}{:>10.2f}{:>10.3f}{:>10.3f}".format(
+                name,
+                result["accuracy"],
+                result["macro_f1"],
+                result["size_mb"],
+                result["embedding_mb"],
+                result["p50_ms"],
+                result["p99_ms"],
+            )
+        )
+    print("Relative reconstruction error of the embeddings: {:.4f}".format(error))
+
+    if args.report:
+        results["reconstruction_error"] = error
+        results["pq_embedding"] = {
+            "n_subvectors": args.subvectors,
+            "n_centroids": args.centroids,
+            "iterations": args.iterations,
+        }
+        with open(args.report, "w") as report_file:
+            json.dump(results, report_file, indent=2)
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
@@ -19,5 +19,15 @@ PROCESSED_DATASET = {
         DATASET_FOLDER, PROCESSED_DATASET_FOLDER, PROCESSED_DATASET_TEST_FILENAME
     ),
 }
+# Share of the rows in the test split
+TEST_SPLIT = 0.15
+# Rows read, normalized and written at once by preprocessdata.py --stream
+PREPROCESS_CHUNK_SIZE = 100000
 
 TEMP_DIR = ".temp"
+COMPILED_DATASET_FOLDER = os.path.join(TEMP_DIR, "compiled")
+
+# Built once and shared by every project, override with the GLOVE_STORE variable
+GLOVE_STORE_FOLDER = os.environ.get(
+    "GLOVE_STORE", os.path.join(os.path.expanduser("~"), ".cache", "glove_store")
+)
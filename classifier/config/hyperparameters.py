@@ -1,6 +1,7 @@
 """
 Hyper Parameters of Model
 """
+from config.root import SEED
 
 MAX_VOCAB = 10000
 BATCH_SIZE = 64
@@ -13,7 +14,70 @@ DROPOUT = 0.7
 LR = 0.001
 EPOCHS = 5
 FREEZE_EMBEDDINGS = 1
+# Unfrozen embeddings get sparse gradients and are trained by SparseAdam
+SPARSE_EMBEDDINGS = 0
 WEIGHT_DECAY = 0.001
 CNN_FILTER_SIZES = [1, 3, 5]
 CNN_N_FILTER = 64
 LINEAR_HIDDEN_DIM = 128
+# Training stops after PATIENCE epochs without a validation loss improvement
+# of MIN_DELTA, the learning rate is multiplied by LR_FACTOR after LR_PATIENCE
+PATIENCE = 3
+LR_PATIENCE = 1
+LR_FACTOR = 0.5
+MIN_LR = 1e-6
+MIN_DELTA = 1e-4
+# Labels predicted by the classifier, more than one trains a shared encoder
+# with a head per label on the sum of their losses times LABEL_WEIGHTS
+LABELS = ["label"]
+LABEL_WEIGHTS = None
+# Product quantization of the embedding tables by compress.py, every row is
+# split into PQ_SUBVECTORS parts stored as uint8 codes into codebooks of
+# PQ_CENTROIDS centroids learned in PQ_ITERATIONS k-means iterations
+PQ_SUBVECTORS = 50
+PQ_CENTROIDS = 256
+PQ_ITERATIONS = 20
+# Structured pruning by prune.py keeps PRUNE_KEEP of the conv filters of every
+# width and of the hidden units, ranked by PRUNE_CRITERION, and fine tunes the
+# smaller classifier for PRUNE_EPOCHS epochs
+PRUNE_KEEP = 0.5
+PRUNE_CRITERION = "activation"
+PRUNE_EPOCHS = 2
+# Share of the training folds of a cross validation fold held out to pick its
+# best epoch, the fold itself only gives the reported metrics
+KFOLD_VALIDATION_SPLIT = 0.1
+# Configuration of a sweep, cross validation or pareto trial, any of them can
+# be swept and a spec naming anything else is rejected by sweep.py
+TRIAL_DEFAULTS = {
+    "model": "RNNHiddenClassifier",
+    "embedding_dim": EMBEDDING_DIM,
+    "hidden_dim": HIDDEN_DIM,
+    "n_layers": N_LAYERS,
+    "bidirectional": BIDIRECTION,
+    "dropout": DROPOUT,
+    "n_filters": CNN_N_FILTER,
+    "filter_sizes": CNN_FILTER_SIZES,
+    "linear_hidden_dim": LINEAR_HIDDEN_DIM,
+    "labels": LABELS,
+    "label_weights": LABEL_WEIGHTS,
+    "learning_rate": LR,
+    "l2_regularization": WEIGHT_DECAY,
+    "batch_size": BATCH_SIZE,
+    "freeze_embeddings": FREEZE_EMBEDDINGS,
+    "sparse_embeddings": SPARSE_EMBEDDINGS,
+    "patience": PATIENCE,
+    "seed": SEED,
+}
+# Keys of TRIAL_DEFAULTS that are hyperparameters of build_model
+TRIAL_HYPERPARAMETERS = [
+    "embedding_dim",
+    "hidden_dim",
+    "n_layers",
+    "bidirectional",
+    "dropout",
+    "n_filters",
+    "filter_sizes",
+    "linear_hidden_dim",
+    "labels",
+    "label_weights",
+]
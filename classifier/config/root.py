@@ -17,6 +17,9 @@ LOGGING_FORMAT = (
 
 SEED = 1234
 
+SPACY_MODEL = "en"
+TOKENIZER_BATCH_SIZE = 1000
+
 
 def seed_all(seed):
     """Seed the results for duplication"""
@@ -29,4 +32,29 @@ def seed_all(seed):
 
 
 TRAINED_CLASSIFIER_FOLDER = "trained"
-TRAINED_CLASSIFIER_RNNHIDDEN = "RNNHidden.pt"
+# Bundle the tools load when no model location is given
+TRAINED_CLASSIFIER_DEFAULT = "RNNHiddenClassifier"
+
+# Defaults of the inference server
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8000
+SERVER_MAX_BATCH_SIZE = 64
+SERVER_MAX_WAIT_MS = 5
+
+# Exported TorchScript and ONNX graphs
+EXPORTED_CLASSIFIER_FOLDER = "exported"
+ONNX_OPSET_VERSION = 11
+
+# Results and bundles of hyperparameter sweeps
+SWEEP_FOLDER = "sweeps"
+
+# Per fold results of k-fold cross validation
+CROSSVALIDATION_FOLDER = "crossvalidation"
+
+# CPU execution profiles written by autotune.py, one per model and host, the
+# predictors and trainers apply the profile of their model when it exists
+AUTOTUNE_FOLDER = os.path.join(TRAINED_CLASSIFIER_FOLDER, "autotune")
+AUTOTUNE_AUTOLOAD = True
+
+# Bundles and report of the accuracy against latency benchmark of pareto.py
+PARETO_FOLDER = "pareto"
@@ -0,0 +1,98 @@
+"""
+CPU execution profiles of trained models
+
+autotune.py measures every combination of intra op threads, inter op threads
+and batch size of a model and saves the best one as
+AUTOTUNE_FOLDER/<model>.<host>.json. Thread counts depend on the cores of
+the host, so a profile is only applied on the host it was tuned on.
+"""
+
+import json
+import logging
+import os
+import socket
+
+import torch
+
+from config.root import (
+    AUTOTUNE_AUTOLOAD,
+    AUTOTUNE_FOLDER,
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    device,
+)
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+
+def host_name():
+    return socket.gethostname()
+
+
+def model_name(model_location):
+    """Name of a bundle or model file, several locations name their ensemble"""
+    if isinstance(model_location, str):
+        model_location = [model_location]
+    return "+".join(
+        os.path.splitext(os.path.basename(os.path.normpath(location)))[0]
+        for location in model_location
+    )
+
+
+def profile_location(name, host=None):
+    return os.path.join(AUTOTUNE_FOLDER, "{}.{}.json".format(name, host or host_name()))
+
+
+def save_profile(profile):
+    if not os.path.exists(AUTOTUNE_FOLDER):
+        os.makedirs(AUTOTUNE_FOLDER)
+
+    location = profile_location(profile["model"], profile["host"])
+    with open(location, "w") as profile_file:
+        json.dump(profile, profile_file, indent=2)
+    return location
+
+
+def load_profile(name):
+    """Profile of the model on this host, None if it was not tuned here"""
+    location = profile_location(name)
+    if not AUTOTUNE_AUTOLOAD or device.type != "cpu" or not os.path.exists(location):
+        return None
+
+    with open(location) as profile_file:
+        return json.load(profile_file)
+
+
+def set_threads(threads, interop_threads=None):
+    """
+    Inter op threads can only be changed before the first inter op parallel
+    work of the process, afterwards the current ones are kept
+    """
+    if interop_threads and interop_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            logger.warning(
+                "Inter op threads are already in use, keeping {}".format(
+                    torch.get_num_interop_threads()
+                )
+            )
+    if threads:
+        torch.set_num_threads(threads)
+
+
+def apply_profile(model_location):
+    """Set the threads of the profile of the model, returns the profile or None"""
+    profile = load_profile(model_name(model_location))
+    if profile is None:
+        return None
+
+    set_threads(profile["threads"], profile["interop_threads"])
+    logger.info(
+        "Applied the CPU profile of {}: {} threads, {} inter op threads".format(
+            profile["model"], profile["threads"], profile["interop_threads"]
+        )
+    )
+    return profile
@@ -0,0 +1,238 @@
+"""
+Parallel k-fold cross validation of a classifier, started from train.py by
+
+```
+    >>> python train.py --model CNN1dClassifier --kfold 5
+    >>> python train.py -m RNNHiddenClassifier --kfold 10 --workers 5
+```
+The train and test examples are pooled and split into K stratified folds
+once in the parent process. Every fold is trained in a worker process on the
+other K - 1 folds less a stratified KFOLD_VALIDATION_SPLIT share, that share
+picks the best epoch and the fold itself is only evaluated with the weights of
+that epoch. The workers memory map the same compiled arrays and only receive
+the indices of their fold. The per fold metrics are written to a tsv together
+with their mean and standard deviation.
+
+The folds use the vocabularies compiled from the original train split, tokens
+only seen in the original test split are <unk> in every fold.
+"""
+
+import copy
+import csv
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch.nn as nn
+from sklearn.model_selection import StratifiedKFold, train_test_split
+
+import sweep
+from bundle import DATASETS
+from compileddataset import POOLED_SPLIT
+from config.hyperparameters import (
+    KFOLD_VALIDATION_SPLIT,
+    TRIAL_DEFAULTS,
+    TRIAL_HYPERPARAMETERS,
+)
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL, device, seed_all
+from train import epoch_functions, fit, initialize_new_model
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+SUMMARY_COLUMNS = ["loss", "accuracy", "macro_f1"]
+
+
+def stratified_folds(labels, k, seed):
+    """
+    Train, validation and test indices into the pooled split of every fold,
+    the validation indices are a stratified share of the other folds
+    """
+    splitter = StratifiedKFold(n_splits=k, shuffle=True, random_state=seed)
+
+    folds = []
+    for train_indices, test_indices in splitter.split(np.zeros(len(labels)), labels):
+        train_indices, validation_indices = train_test_split(
+            train_indices,
+            test_size=KFOLD_VALIDATION_SPLIT,
+            random_state=seed,
+            stratify=labels[train_indices],
+        )
+        folds.append((train_indices, validation_indices, test_indices))
+    return folds
+
+
+def check_label_vocabs(dataset):
+    """
+    The vocabularies are built on the original train split only, every label
+    of the pooled split has to be in them
+    """
+    for name in dataset.label_fields:
+        labels = np.asarray(dataset.compiled.labels[POOLED_SPLIT][name])
+        if len(labels) and labels.max() >= len(getattr(dataset, name).vocab):
+            raise ValueError(
+                "Labels of the pooled split are missing from the {} vocabulary "
+                "of the train split, compile the dataset again".format(name)
+            )
+
+
+def run_fold(
+    fold, train_indices, validation_indices, test_indices, config, tag, epochs
+):
+    """Train one fold in a worker process started by sweep.init_worker"""
+    start_time = time.time()
+    seed_all(config["seed"])
+
+    dataset = sweep.worker_dataset
+    dataset.train_iterator = dataset.iterator(
+        POOLED_SPLIT, config["batch_size"], True, indices=train_indices
+    )
+    dataset.test_iterator = dataset.iterator(
+        POOLED_SPLIT, config["batch_size"], False, indices=validation_indices
+    )
+
+    hyperparameters = {name: config[name] for name in TRIAL_HYPERPARAMETERS}
+    model = initialize_new_model(
+        config["model"],
+        dataset,
+        hyperparameters,
+        config["freeze_embeddings"],
+        config["sparse_embeddings"],
+    ).to(device)
+
+    best_state = {}
+    best = fit(
+        model,
+        dataset,
+        config["model"],
+        epochs,
+        config["learning_rate"],
+        config["l2_regularization"],
+        on_improvement=lambda model: best_state.update(
+            copy.deepcopy(model.state_dict())
+        ),
+        verbose=False,
+        patience=config["patience"],
+    )
+
+    # The epoch is picked on the validation indices, the fold is only evaluated
+    model.load_state_dict(best_state)
+    _, evaluate_epoch = epoch_functions(model, config["model"])
+    metrics = evaluate_epoch(
+        model,
+        dataset.iterator(
+            POOLED_SPLIT, config["batch_size"], False, indices=test_indices
+        ),
+        nn.CrossEntropyLoss().to(device),
+    )
+
+    return dict(
+        {
+            "fold": fold,
+            "train_size": len(train_indices),
+            "validation_size": len(validation_indices),
+            "test_size": len(test_indices),
+        },
+        **{column: metrics[column] for column in SUMMARY_COLUMNS},
+        epoch=best["epoch"],
+        stop_cause=best["stop_cause"],
+        seconds=time.time() - start_time,
+    )
+
+
+def summarize(rows):
+    """Mean and sample standard deviation of the metrics over the folds"""
+    summary = {}
+    for column in SUMMARY_COLUMNS:
+        values = np.array([row[column] for row in rows], dtype=np.float64)
+        summary[column] = (
+            float(values.mean()),
+            float(values.std(ddof=1)) if len(values) > 1 else 0.0,
+        )
+    return summary
+
+
+def run_kfold(config, tag, epochs, k, workers, threads, location):
+    """
+    Fan the folds out over a process pool
+    Input:
+        config: dict -> Trial configuration with the keys of TRIAL_DEFAULTS
+        tag: string -> multi or answeronly
+        k: int -> Number of folds
+        location: string -> Tsv file the per fold results are written to
+    Output:
+        rows: list -> Metrics of every finished fold sorted by fold
+        summary: dict -> Metric name to its mean and standard deviation
+    """
+    # Compile once in the parent so the workers only memory map the result
+    dataset_class = DATASETS[tag]
+    dataset = dataset_class()
+    dataset.load_compiled(dataset_class.compile_if_needed())
+    check_label_vocabs(dataset)
+    labels = np.asarray(dataset.compiled.labels[POOLED_SPLIT]["label"])
+
+    folds = stratified_folds(labels, k, config["seed"])
+
+    logger.info(
+        "Running {} folds of {} examples on {} workers with {} threads each".format(
+            k, len(labels), workers, threads
+        )
+    )
+
+    folder = os.path.dirname(location)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    rows = []
+    columns = (
+        ["fold", "train_size", "validation_size", "test_size"]
+        + sweep.METRIC_COLUMNS
+        + ["seconds"]
+    )
+    with open(location, "w", newline="") as results_file, ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=sweep.init_worker,
+        initargs=(tag, threads),
+    ) as executor:
+        writer = csv.DictWriter(results_file, fieldnames=columns, delimiter="\t")
+        writer.writeheader()
+
+        futures = {
+            executor.submit(run_fold, fold, *indices, config, tag, epochs): fold
+            for fold, indices in enumerate(folds)
+        }
+        for future in as_completed(futures):
+            try:
+                row = future.result()
+            except Exception:
+                logger.exception("Fold {} failed".format(futures[future]))
+                continue
+
+            writer.writerow(row)
+            results_file.flush()
+            rows.append(row)
+            logger.info(
+                "Fold {} finished: loss {:.4f} accuracy {:.4f} macro F1 {:.4f}".format(
+                    row["fold"], row["loss"], row["accuracy"], row["macro_f1"]
+                )
+            )
+
+        if not rows:
+            raise RuntimeError("Every fold failed")
+
+        rows.sort(key=lambda row: row["fold"])
+        summary = summarize(rows)
+        for statistic, index in (("mean", 0), ("std", 1)):
+            writer.writerow(
+                dict(
+                    {"fold": statistic},
+                    **{column: summary[column][index] for column in SUMMARY_COLUMNS},
+                )
+            )
+
+    return rows, summary
@@ -2,6 +2,7 @@
 Load Dataset
 """
 
+import csv
 import logging
 import os
 
@@ -9,6 +10,13 @@ import pandas as pd
 import torch
 from torchtext import data, datasets
 
+from compileddataset import (
+    POOLED_SPLIT,
+    CompiledDataset,
+    compile_dataset,
+    compiled_location,
+    numericalize,
+)
 from config.data import (
     DATASET_FOLDER,
     PROCESSED_DATASET,
@@ -19,164 +27,297 @@ from config.data import (
 )
 from config.hyperparameters import BATCH_SIZE, MAX_VOCAB
 from config.root import LOGGING_FORMAT, LOGGING_LEVEL, device
+from glovestore import glove_store
 from utility import tokenizer
 
 # Initialize logger for this file
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
 
+PRETRAINED_VECTORS = "glove.6B.300d"
+
+
+def pretokenize(fields):
+    """
+    Tokenize every column read by the tokenizer fields in one batched pass
+    over the processed splits, so TabularDataset only does memoized lookups
+    and the next run finds all of them in the on disk token cache
+    """
+    columns = [
+        index
+        for index, (_, field) in enumerate(fields)
+        if getattr(field, "tokenize", None) is tokenizer
+    ]
+
+    texts = []
+    for split in ("train", "test"):
+        with open(PROCESSED_DATASET[split], encoding="utf8") as dataset_file:
+            reader = csv.reader(dataset_file, delimiter="\t")
+            next(reader)
+            for row in reader:
+                texts.extend(row[index] for index in columns)
+
+    logger.debug("Tokenized {} uncached texts".format(tokenizer.pipe(texts)))
+    tokenizer.save()
+
+
+class GrammarDataset:
+    """
+    Base class of the grammar datasets. The processed tsv files are parsed by
+    torchtext only to compile the dataset, every load after that memory maps
+    the compiled arrays as long as the configuration does not change
+    """
+
+    # Text columns read by the fields, sequences and labels stored in the
+    # compiled dataset and fields whose vocabulary is stored with it
+    text_fields = []
+    sequence_fields = []
+    label_fields = ["label", "subsection"]
+    vocab_fields = []
 
-class GrammarDasetMultiTag:
     def __init__(self):
 
         self.dataset_location = PROCESSED_DATASET
 
-        self.question = data.Field(
-            tokenize=tokenizer, include_lengths=True, eos_token="</q>", init_token="<q>"
-        )
-        self.key = data.Field(
-            tokenize=tokenizer, include_lengths=True, eos_token="</k>", init_token="<k>"
-        )
-        self.answer = data.Field(
-            tokenize=tokenizer, include_lengths=True, eos_token="</a>", init_token="<a>"
-        )
-        self.label = data.LabelField()
-
-        self.tags = data.Field(tokenize=tokenizer)
-
         self.fields = None
         self.trainset = None
         self.testset = None
+        self.compiled = None
         self.train_iterator, self.test_iterator = None, None
 
-    @classmethod
-    def get_iterators(cls, batch_size):
+    def build_vocab(self):
         """
-        Load dataset and return iterators
+        Build the vocabularies of the text field, with its pretrained vectors,
+        and of the label fields from the trainset
         """
-        grammar_dataset = cls()
+        self.text_field.build_vocab(self.trainset, max_size=MAX_VOCAB)
+        glove_store(PRETRAINED_VECTORS).load_vectors(
+            self.text_field.vocab, unk_init=torch.Tensor.normal_
+        )
 
-        grammar_dataset.fields = [
-            ("question", grammar_dataset.question),
-            ("key", grammar_dataset.key),
-            ("answer", grammar_dataset.answer),
-            ("label", grammar_dataset.label),
-            (None, None),
-        ]
+        for name in self.label_fields:
+            getattr(self, name).build_vocab(self.trainset)
 
-        if not os.path.exists(PROCESSED_DATASET["train"]) or not os.path.exists(
-            PROCESSED_DATASET["test"]
-        ):
-            raise FileNotFoundError(
-                "Please run the preprocessdata.py first by executing python preprocessdata.py"
-            )
+    def load_tsv(self):
+        """Parse the processed splits with torchtext and build the vocabularies"""
+        pretokenize(self.fields)
 
-        grammar_dataset.trainset, grammar_dataset.testset = data.TabularDataset.splits(
+        self.trainset, self.testset = data.TabularDataset.splits(
             path=os.path.join(DATASET_FOLDER, PROCESSED_DATASET_FOLDER),
             train=PROCESSED_DATASET_TRAIN_FILENAME,
             test=PROCESSED_DATASET_TEST_FILENAME,
             format="tsv",
-            fields=grammar_dataset.fields,
+            fields=self.fields,
             skip_header=True,
         )
 
         logger.debug("Data Loaded Successfully!")
 
-        grammar_dataset.question.build_vocab(
-            grammar_dataset.trainset,
-            max_size=MAX_VOCAB,
-            vectors="glove.6B.300d",
-            unk_init=torch.Tensor.normal_,
+        self.build_vocab()
+
+        logger.debug("Vocabulary Loaded")
+
+    def numericalize(self, columns):
+        """
+        Index sequences of every sequence field
+        Input:
+            columns: dict -> Text field name to the token lists of the examples
+        """
+        return {
+            name: [numericalize(getattr(self, name), tokens) for tokens in columns[name]]
+            for name in self.sequence_fields
+        }
+
+    def compile(self, location):
+        self.load_tsv()
+
+        splits = {
+            "train": self.trainset.examples,
+            "test": self.testset.examples,
+            POOLED_SPLIT: self.trainset.examples + self.testset.examples,
+        }
+        sequences, labels = {}, {}
+        for split, examples in splits.items():
+            sequences[split] = self.numericalize(
+                {
+                    name: [getattr(example, name) for example in examples]
+                    for name in self.text_fields
+                }
+            )
+            labels[split] = {
+                name: [
+                    getattr(self, name).vocab.stoi[getattr(example, name)]
+                    for example in examples
+                ]
+                for name in self.label_fields
+            }
+
+        compile_dataset(
+            location,
+            sequences,
+            labels,
+            {name: getattr(self, name).vocab for name in self.vocab_fields},
         )
 
-        grammar_dataset.key.vocab = grammar_dataset.question.vocab
-        grammar_dataset.answer.vocab = grammar_dataset.question.vocab
+    def load_compiled(self, location):
+        self.compiled = CompiledDataset(location)
+        for name in self.vocab_fields:
+            getattr(self, name).vocab = self.compiled.vocabs[name]
+
+        logger.debug("Compiled Dataset Loaded from {}".format(location))
+
+    @property
+    def text_field(self):
+        """Field whose vocabulary numericalizes the text fed to the models"""
+        return getattr(self, self.text_fields[0])
+
+    @property
+    def pad_indexes(self):
+        return {
+            name: getattr(self, name).vocab.stoi[getattr(self, name).pad_token]
+            for name in self.sequence_fields
+        }
+
+    def iterator(self, split, batch_size, train, indices=None, device=device):
+        """Iterator over the compiled split, optionally over a subset of it"""
+        return self.compiled.iterator(
+            split, batch_size, train, self.pad_indexes, indices, device
+        )
 
-        grammar_dataset.label.build_vocab(grammar_dataset.trainset)
+    @classmethod
+    def compile_if_needed(cls, force=False):
+        """
+        Returns the location of the compiled dataset of the present
+        configuration, compiling it first if it does not exist yet
+        """
+        if not os.path.exists(PROCESSED_DATASET["train"]) or not os.path.exists(
+            PROCESSED_DATASET["test"]
+        ):
+            raise FileNotFoundError(
+                "Please run the preprocessdata.py first by executing python preprocessdata.py"
+            )
 
-        grammar_dataset.tags.build_vocab(["Q", "K", "A"])
+        location = compiled_location(cls.__name__, PRETRAINED_VECTORS)
+        if force or not os.path.exists(location):
+            logger.debug("Compiling Dataset")
+            cls().compile(location)
 
-        logger.debug("Vocabulary Loaded")
-        grammar_dataset.train_iterator, grammar_dataset.test_iterator = data.BucketIterator.splits(
-            (grammar_dataset.trainset, grammar_dataset.testset),
-            batch_size=batch_size,
-            sort_within_batch=True,
-            sort_key=lambda x: len(x.question) + len(x.key) + len(x.answer),
-            device=device,
+        return location
+
+    @classmethod
+    def get_iterators(cls, batch_size):
+        """
+        Load dataset and return iterators
+        """
+        grammar_dataset = cls()
+
+        grammar_dataset.load_compiled(cls.compile_if_needed())
+
+        grammar_dataset.train_iterator = grammar_dataset.iterator(
+            "train", batch_size, train=True
+        )
+        grammar_dataset.test_iterator = grammar_dataset.iterator(
+            "test", batch_size, train=False
         )
         logger.debug("Created Iterators")
 
         return grammar_dataset
 
 
-class GrammarDasetAnswerTag:
+class GrammarDasetMultiTag(GrammarDataset):
+    """
+    Question, key and answer are stored as one contiguous text sequence with
+    a parallel tag sequence holding the segment of every token, so a batch is
+    padded once and its lengths are the real lengths of the examples
+    """
+
+    text_fields = ["question", "key", "answer"]
+    sequence_fields = ["text", "tag"]
+    vocab_fields = ["question", "key", "answer", "tags", "label", "subsection"]
+    # Tag of the tokens of every text field
+    segment_tags = {"question": "Q", "key": "K", "answer": "A"}
+
     def __init__(self):
 
-        self.dataset_location = PROCESSED_DATASET
+        super().__init__()
 
-        self.text = data.Field(
-            tokenize=tokenizer,
-            include_lengths=True,
-            eos_token="<end>",
-            init_token="<start>",
+        self.question = data.Field(
+            tokenize=tokenizer, include_lengths=True, eos_token="</q>", init_token="<q>"
+        )
+        self.key = data.Field(
+            tokenize=tokenizer, include_lengths=True, eos_token="</k>", init_token="<k>"
+        )
+        self.answer = data.Field(
+            tokenize=tokenizer, include_lengths=True, eos_token="</a>", init_token="<a>"
         )
         self.label = data.LabelField()
+        # One sub section is written with a trailing space in the raw data
+        self.subsection = data.LabelField(preprocessing=str.strip)
 
-        self.fields = None
-        self.trainset = None
-        self.testset = None
-        self.train_iterator, self.test_iterator = None, None
+        self.tags = data.Field(tokenize=tokenizer)
+        self.tags.build_vocab(["Q", "K", "A"])
+
+        self.fields = [
+            ("question", self.question),
+            ("key", self.key),
+            ("answer", self.answer),
+            ("label", self.label),
+            ("subsection", self.subsection),
+        ]
 
-    @classmethod
-    def get_iterators(cls, batch_size):
-        """
-        Load dataset and return iterators
-        """
-        grammar_dataset = cls()
+    def build_vocab(self):
+        super().build_vocab()
 
-        grammar_dataset.fields = [
-            (None, None),
-            (None, None),
-            ("text", grammar_dataset.text),
-            ("label", grammar_dataset.label),
-            (None, None),
-        ]
+        self.key.vocab = self.question.vocab
+        self.answer.vocab = self.question.vocab
 
-        if not os.path.exists(PROCESSED_DATASET["train"]) or not os.path.exists(
-            PROCESSED_DATASET["test"]
-        ):
-            raise FileNotFoundError(
-                "Please run the preprocessdata.py first by executing python preprocessdata.py"
-            )
+    def numericalize(self, columns):
+        text, tag = [], []
+        for segments in zip(*(columns[name] for name in self.text_fields)):
+            example_text, example_tag = [], []
+            for name, tokens in zip(self.text_fields, segments):
+                indexes = numericalize(getattr(self, name), tokens)
+                example_text.extend(indexes)
+                example_tag.extend(
+                    [self.tags.vocab.stoi[self.segment_tags[name]]] * len(indexes)
+                )
+            text.append(example_text)
+            tag.append(example_tag)
 
-        grammar_dataset.trainset, grammar_dataset.testset = data.TabularDataset.splits(
-            path=os.path.join(DATASET_FOLDER, PROCESSED_DATASET_FOLDER),
-            train=PROCESSED_DATASET_TRAIN_FILENAME,
-            test=PROCESSED_DATASET_TEST_FILENAME,
-            format="tsv",
-            fields=grammar_dataset.fields,
-            skip_header=True,
-        )
+        return {"text": text, "tag": tag}
 
-        logger.debug("Data Loaded Successfully!")
+    @property
+    def pad_indexes(self):
+        return {
+            "text": self.question.vocab.stoi[self.question.pad_token],
+            "tag": self.tags.vocab.stoi[self.tags.pad_token],
+        }
 
-        grammar_dataset.text.build_vocab(
-            grammar_dataset.trainset,
-            max_size=MAX_VOCAB,
-            vectors="glove.6B.300d",
-            unk_init=torch.Tensor.normal_,
-        )
 
-        grammar_dataset.label.build_vocab(grammar_dataset.trainset)
+class GrammarDasetAnswerTag(GrammarDataset):
 
-        logger.debug("Vocabulary Loaded")
-        grammar_dataset.train_iterator, grammar_dataset.test_iterator = data.BucketIterator.splits(
-            (grammar_dataset.trainset, grammar_dataset.testset),
-            batch_size=batch_size,
-            sort_within_batch=True,
-            sort_key=lambda x: len(x.text),
-            device=device,
+    text_fields = ["text"]
+    sequence_fields = ["text"]
+    vocab_fields = ["text", "label", "subsection"]
+
+    def __init__(self):
+
+        super().__init__()
+
+        self.text = data.Field(
+            tokenize=tokenizer,
+            include_lengths=True,
+            eos_token="<end>",
+            init_token="<start>",
         )
-        logger.debug("Created Iterators")
+        self.label = data.LabelField()
+        # One sub section is written with a trailing space in the raw data
+        self.subsection = data.LabelField(preprocessing=str.strip)
 
-        return grammar_dataset
+        self.fields = [
+            (None, None),
+            (None, None),
+            ("text", self.text),
+            ("label", self.label),
+            ("subsection", self.subsection),
+        ]
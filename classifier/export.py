@@ -0,0 +1,288 @@
+"""
+Export a trained classifier to TorchScript and ONNX run this file by
+
+```
+    >>> python export.py --model-location trained/RNNHiddenClassifier
+    >>> python export.py -loc trained/RNNHiddenClassifier --check
+```
+Both graphs take the padded text [sequence, batch] and its lengths (and the
+tag sequence for RNNFieldClassifer) with dynamic batch and sequence axes, and
+return one predictions output per label, so they can be served by the
+TorchScript runtime or ONNX Runtime without importing the training code.
+--check compares them with the eager model on inputs of other shapes than the
+traced one.
+"""
+
+import argparse
+import inspect
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from config.root import (
+    EXPORTED_CLASSIFIER_FOLDER,
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    ONNX_OPSET_VERSION,
+    TRAINED_CLASSIFIER_FOLDER,
+    TRAINED_CLASSIFIER_DEFAULT,
+)
+from bundle import load_model
+from model import RNNFieldClassifer
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Newer torch defaults to the dynamo exporter, the TorchScript based one is
+# the exporter that understands packed sequences
+ONNX_EXPORTER_ARGUMENTS = (
+    {"dynamo": False}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters
+    else {}
+)
+
+# Batch and sequence length of the traced inputs and of the parity checks
+TRACE_SHAPE = (4, 12)
+CHECK_SHAPES = [(1, 5), (3, 20), (16, 37)]
+
+
+def uses_tags(model):
+    return isinstance(model, RNNFieldClassifer) or getattr(model, "use_tags", False)
+
+
+def input_names(model):
+    if uses_tags(model):
+        return ["text", "text_lengths", "tag"]
+    return ["text", "text_lengths"]
+
+
+def output_names(model):
+    """One output per label, MultiTaskClassifier has more than one"""
+    labels = getattr(model, "labels", ["label"])
+    return ["predictions"] + ["{}_predictions".format(name) for name in labels[1:]]
+
+
+def as_tuple(outputs):
+    return outputs if isinstance(outputs, tuple) else (outputs,)
+
+
+def dynamic_axes(model):
+    axes = {
+        "text": {0: "sequence", 1: "batch"},
+        "text_lengths": {0: "batch"},
+    }
+    for name in output_names(model):
+        axes[name] = {0: "batch"}
+    if uses_tags(model):
+        axes["tag"] = {0: "sequence", 1: "batch"}
+    return axes
+
+
+def example_inputs(model, batch_size, seq_len):
+    """
+    Random padded inputs of the model, the lengths are decreasing and the
+    longest one fills the sequence like the batches of the iterators
+    """
+    vocab_size = model.embedding.num_embeddings
+    pad_idx = model.embedding.padding_idx
+
+    lengths = torch.randint(1, seq_len + 1, (batch_size,))
+    lengths[0] = seq_len
+    lengths, _ = lengths.sort(descending=True)
+
+    padding = torch.arange(seq_len).unsqueeze(1) >= lengths.unsqueeze(0)
+    text = torch.randint(2, vocab_size, (seq_len, batch_size))
+    text[padding] = pad_idx if pad_idx is not None else 1
+
+    if uses_tags(model):
+        tag_embedding = getattr(model, "encoder", model).tag_embedding
+        tag = torch.randint(2, tag_embedding.num_embeddings, (seq_len, batch_size))
+        tag[padding] = tag_embedding.padding_idx
+        return text, lengths, tag
+
+    return text, lengths
+
+
+class ONNXExportWrapper(nn.Module):
+    """
+    Adds the padded outputs of a packed RNN as a second graph output. The ONNX
+    exporter moves the packing past the RNN and fails when nothing reads the
+    RNN outputs, as in the classifiers that only use the last hidden state
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.rnn_output = None
+        self.hook = None
+        rnn = getattr(getattr(model, "encoder", model), "rnn", None)
+        if isinstance(rnn, nn.RNNBase):
+            self.hook = rnn.register_forward_hook(self.keep_rnn_output)
+        # Exporting restores the mode of the wrapper on the model afterwards
+        self.train(model.training)
+
+    def keep_rnn_output(self, module, inputs, outputs):
+        self.rnn_output = outputs[0]
+
+    def forward(self, *inputs):
+        outputs = as_tuple(self.model(*inputs))
+        if isinstance(self.rnn_output, nn.utils.rnn.PackedSequence):
+            rnn_output, _ = nn.utils.rnn.pad_packed_sequence(self.rnn_output)
+            outputs += (rnn_output,)
+        return outputs if len(outputs) > 1 else outputs[0]
+
+
+def export_torchscript(model, inputs, location):
+    traced = torch.jit.trace(model, inputs)
+    traced.save(location)
+    logger.info("Saved TorchScript graph to {}".format(location))
+
+
+def export_onnx(model, inputs, location, opset_version=ONNX_OPSET_VERSION):
+    wrapper = ONNXExportWrapper(model)
+    names = output_names(model)
+    axes = dynamic_axes(model)
+    if len(as_tuple(wrapper(*inputs))) > len(names):
+        names.append("rnn_outputs")
+        axes["rnn_outputs"] = {0: "sequence", 1: "batch"}
+
+    torch.onnx.export(
+        wrapper,
+        inputs,
+        location,
+        input_names=input_names(model),
+        output_names=names,
+        dynamic_axes=axes,
+        opset_version=opset_version,
+        **ONNX_EXPORTER_ARGUMENTS,
+    )
+    if wrapper.hook is not None:
+        wrapper.hook.remove()
+    logger.info("Saved ONNX graph to {}".format(location))
+
+
+def check_parity(model, torchscript_location, onnx_location, tolerance):
+    """
+    Returns the largest absolute difference of the exported graphs to the
+    eager model over CHECK_SHAPES, ONNX is skipped without onnxruntime
+    """
+    torchscript_model = torch.jit.load(torchscript_location)
+
+    session = None
+    if onnxruntime is None:
+        logger.warning("onnxruntime is not installed, skipping the ONNX check")
+    else:
+        session = onnxruntime.InferenceSession(
+            onnx_location, providers=["CPUExecutionProvider"]
+        )
+        # Inputs the model ignores are pruned from the graph
+        session_inputs = {node.name for node in session.get_inputs()}
+
+    differences = {"torchscript": 0.0, "onnx": 0.0}
+    with torch.no_grad():
+        for batch_size, seq_len in CHECK_SHAPES:
+            inputs = example_inputs(model, batch_size, seq_len)
+            expected = [output.numpy() for output in as_tuple(model(*inputs))]
+
+            for output, target in zip(as_tuple(torchscript_model(*inputs)), expected):
+                differences["torchscript"] = max(
+                    differences["torchscript"],
+                    float(np.abs(output.numpy() - target).max()),
+                )
+
+            if session is not None:
+                feed = {
+                    name: value.numpy()
+                    for name, value in zip(input_names(model), inputs)
+                    if name in session_inputs
+                }
+                for output, target in zip(session.run(None, feed), expected):
+                    differences["onnx"] = max(
+                        differences["onnx"], float(np.abs(output - target).max())
+                    )
+
+    for runtime, difference in differences.items():
+        logger.info(
+            "{} max abs difference {:.2e} ({})".format(
+                runtime, difference, "ok" if difference <= tolerance else "MISMATCH"
+            )
+        )
+
+    return max(differences.values())
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to export a trained model to TorchScript and ONNX"
+    )
+
+    parser.add_argument(
+        "-loc",
+        "--model-location",
+        default=os.path.join(TRAINED_CLASSIFIER_FOLDER, TRAINED_CLASSIFIER_DEFAULT),
+        help="Location of the trained model",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-folder",
+        default=EXPORTED_CLASSIFIER_FOLDER,
+        help="Folder to write the .torchscript.pt and .onnx files to",
+    )
+    parser.add_argument(
+        "--opset", default=ONNX_OPSET_VERSION, help="ONNX opset version", type=int
+    )
+    parser.add_argument(
+        "--check",
+        default=False,
+        action="store_true",
+        help="Compare the exported graphs with the eager model",
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=1e-4,
+        help="Largest absolute difference accepted by --check",
+        type=float,
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder)
+
+    torch.manual_seed(0)
+
+    model = load_model(args.model_location, "cpu")
+    model.eval()
+
+    name = os.path.splitext(os.path.basename(args.model_location.rstrip(os.sep)))[0]
+    torchscript_location = os.path.join(
+        args.output_folder, "{}.torchscript.pt".format(name)
+    )
+    onnx_location = os.path.join(args.output_folder, "{}.onnx".format(name))
+
+    inputs = example_inputs(model, *TRACE_SHAPE)
+    with torch.no_grad():
+        export_torchscript(model, inputs, torchscript_location)
+        export_onnx(model, inputs, onnx_location, args.opset)
+
+    if args.check and check_parity(
+        model, torchscript_location, onnx_location, args.tolerance
+    ) > args.tolerance:
+        raise SystemExit("Exported graphs do not match the eager model")
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
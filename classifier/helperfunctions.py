@@ -4,158 +4,293 @@ Helper Functions containing training and evaluation methods
 
 import torch
 from tqdm.auto import tqdm
-from utility import categorical_accuracy, other_evaluations
-from config.root import device
+
+# Sweep workers turn the progress bars off
+PROGRESS_BAR = True
+
+
+class EpochMetrics:
+    """
+    Accumulates the loss sum and the confusion matrix of an epoch as tensors
+    on the device of the predictions, the correct and example counts are its
+    diagonal and its sum. Nothing is copied to the host until compute()
+    """
+
+    def __init__(self):
+        self.loss_sum = None
+        self.confusion = None
+
+    def update(self, predictions, labels, loss):
+        predictions = predictions.detach()
+        n_classes = predictions.shape[1]
+
+        if self.confusion is None:
+            self.confusion = torch.zeros(
+                n_classes, n_classes, dtype=torch.long, device=predictions.device
+            )
+            self.loss_sum = torch.zeros((), device=predictions.device)
+
+        # Row is the true label and column the predicted one
+        self.confusion += torch.bincount(
+            labels * n_classes + predictions.argmax(dim=1),
+            minlength=n_classes * n_classes,
+        ).view(n_classes, n_classes)
+        self.loss_sum += loss.detach() * labels.shape[0]
+
+    def compute(self):
+        """
+        Returns the mean loss, accuracy, macro F1, per class precision and
+        recall and the confusion matrix of the epoch
+        """
+        # An empty iterator leaves nothing to count, not even the classes. Its
+        # loss is nan so it never reads as an improvement
+        if self.confusion is None:
+            return {
+                "loss": float("nan"),
+                "accuracy": 0.0,
+                "macro_f1": 0.0,
+                "precision": [],
+                "recall": [],
+                "confusion_matrix": [],
+            }
+
+        confusion = self.confusion.cpu().double()
+        examples = confusion.sum().clamp(min=1)
+        true_positives = confusion.diag()
+        predicted = confusion.sum(dim=0)
+        actual = confusion.sum(dim=1)
+
+        precision = true_positives / predicted.clamp(min=1)
+        recall = true_positives / actual.clamp(min=1)
+        f1 = 2 * precision * recall / (precision + recall).clamp(min=1e-12)
+
+        # Macro average over the classes seen in the labels or predictions
+        # like sklearn does
+        seen = (predicted + actual) > 0
+
+        return {
+            "loss": self.loss_sum.item() / examples.item(),
+            "accuracy": (true_positives.sum() / examples).item(),
+            "macro_f1": f1[seen].mean().item() if seen.any() else 0.0,
+            "precision": precision.tolist(),
+            "recall": recall.tolist(),
+            "confusion_matrix": self.confusion.cpu().tolist(),
+        }
+
+
+class MultiTaskMetrics:
+    """
+    EpochMetrics of every label of a MultiTaskClassifier together with the
+    weighted joint loss and the count of examples with every label right
+    """
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.tasks = {name: EpochMetrics() for name in labels}
+        self.loss_sum = None
+        self.all_correct = None
+
+    def update(self, predictions, targets, losses, loss):
+        correct = None
+        for name, prediction, target, task_loss in zip(
+            self.labels, predictions, targets, losses
+        ):
+            self.tasks[name].update(prediction, target, task_loss)
+            right = prediction.detach().argmax(dim=1) == target
+            correct = right if correct is None else correct & right
+
+        if self.loss_sum is None:
+            self.loss_sum = torch.zeros((), device=loss.device)
+            self.all_correct = torch.zeros((), dtype=torch.long, device=loss.device)
+
+        self.loss_sum += loss.detach() * targets[0].shape[0]
+        self.all_correct += correct.sum()
+
+    def compute(self):
+        """
+        Returns the metrics of the first label with the joint loss in place of
+        its own, the joint accuracy and the metrics of every label under tasks
+        """
+        tasks = {name: metrics.compute() for name, metrics in self.tasks.items()}
+        examples = max(sum(map(sum, tasks[self.labels[0]]["confusion_matrix"])), 1)
+
+        # Empty like its tasks, whose loss is nan
+        if self.loss_sum is None:
+            return dict(tasks[self.labels[0]], joint_accuracy=0.0, tasks=tasks)
+
+        return dict(
+            tasks[self.labels[0]],
+            loss=self.loss_sum.item() / examples,
+            joint_accuracy=self.all_correct.item() / examples,
+            tasks=tasks,
+        )
 
 
-def train(model, iterator, optimizer, criterion, dataset_tag):
+def train(model, iterator, optimizer, criterion, control=None):
 
-    epoch_loss = 0
-    epoch_acc = 0
+    metrics = EpochMetrics()
 
     model.train()
 
-    for batch in tqdm(iterator, total=len(iterator)):
+    for batch in tqdm(iterator, total=len(iterator), disable=not PROGRESS_BAR):
 
         optimizer.zero_grad()
 
-        text, text_lengths = get_batch_data(batch, dataset_tag)
+        text, text_lengths = get_batch_data(batch)
 
         predictions = model(text, text_lengths).squeeze(1)
 
         loss = criterion(predictions, batch.label)
 
-        acc = categorical_accuracy(predictions, batch.label)
-
         loss.backward()
 
         optimizer.step()
 
-        epoch_loss += loss.item()
-        epoch_acc += acc.item()
+        metrics.update(predictions, batch.label, loss)
 
-    return epoch_loss / len(iterator), epoch_acc / len(iterator)
+        # Ends the epoch early once the training budget is spent
+        if control is not None and control.step():
+            break
 
+    return metrics.compute()
 
-def get_batch_data(batch, dataset_tag):
 
-    if dataset_tag == "multi":
-        (question, question_len), (key, key_len), (answer, answer_len) = (
-            batch.question,
-            batch.key,
-            batch.answer,
-        )
-
-        text = torch.cat((question, key, answer), dim=0)
-        text_lengths = question_len + key_len + answer_len
-    else:
+def get_batch_data(batch):
 
-        text, text_lengths = batch.text
+    text, text_lengths = batch.text
 
     return text, text_lengths
 
 
-def evaluate(model, iterator, criterion, dataset_tag):
-    epoch_loss = 0
-    epoch_acc = 0
+def evaluate(model, iterator, criterion):
+    metrics = EpochMetrics()
 
     model.eval()
 
     with torch.no_grad():
 
-        for batch in tqdm(iterator, total=len(iterator)):
+        for batch in tqdm(iterator, total=len(iterator), disable=not PROGRESS_BAR):
 
-            text, text_lengths = get_batch_data(batch, dataset_tag)
+            text, text_lengths = get_batch_data(batch)
 
             predictions = model(text, text_lengths).squeeze(1)
 
             loss = criterion(predictions, batch.label)
 
-            acc = categorical_accuracy(predictions, batch.label)
-
+            metrics.update(predictions, batch.label, loss)
 
+    return metrics.compute()
 
-            epoch_loss += loss.item()
-            epoch_acc += acc.item()
 
-    return epoch_loss / len(iterator), epoch_acc / len(iterator)
+def train_tag_model(model, iterator, optimizer, criterion, control=None):
 
-
-def train_tag_model(model, iterator, optimizer, criterion, tag_field):
-
-    epoch_loss = 0
-    epoch_acc = 0
+    metrics = EpochMetrics()
 
     model.train()
 
-    for batch in tqdm(iterator, total=len(iterator)):
+    for batch in tqdm(iterator, total=len(iterator), disable=not PROGRESS_BAR):
 
         optimizer.zero_grad()
 
-        text, text_lengths, tag = get_batch_data_and_tag(batch, tag_field)
+        text, text_lengths, tag = get_batch_data_and_tag(batch)
 
         predictions = model(text, text_lengths, tag).squeeze(1)
 
         loss = criterion(predictions, batch.label)
 
-        acc = categorical_accuracy(predictions, batch.label)
-
         loss.backward()
 
         optimizer.step()
 
-        epoch_loss += loss.item()
-        epoch_acc += acc.item()
-
-    return epoch_loss / len(iterator), epoch_acc / len(iterator)
-
-
-def get_batch_data_and_tag(batch, tag_field):
+        metrics.update(predictions, batch.label, loss)
 
-    (question, question_len), (key, key_len), (answer, answer_len) = (
-        batch.question,
-        batch.key,
-        batch.answer,
-    )
+        # Ends the epoch early once the training budget is spent
+        if control is not None and control.step():
+            break
 
-    question_tag = torch.full_like(
-        question, tag_field.vocab.stoi["Q"], dtype=torch.long, device=device
-    )
-    key_tag = torch.full_like(
-        key, tag_field.vocab.stoi["K"], dtype=torch.long, device=device
-    )
-    answer_tag = torch.full_like(
-        answer, tag_field.vocab.stoi["A"], dtype=torch.long, device=device
-    )
+    return metrics.compute()
 
-    tag = torch.cat((question_tag, key_tag, answer_tag), dim=0)
 
-    text = torch.cat((question, key, answer), dim=0)
+def get_batch_data_and_tag(batch):
 
-    text_lengths = question_len + key_len + answer_len
+    text, text_lengths = batch.text
+    tag, _ = batch.tag
 
     return text, text_lengths, tag
 
 
-def evaluate_tag_model(model, iterator, criterion, tag_field):
-    epoch_loss = 0
-    epoch_acc = 0
+def evaluate_tag_model(model, iterator, criterion):
+    metrics = EpochMetrics()
 
     model.eval()
 
     with torch.no_grad():
 
-        for batch in tqdm(iterator, total=len(iterator)):
+        for batch in tqdm(iterator, total=len(iterator), disable=not PROGRESS_BAR):
 
-            text, text_lengths, tag = get_batch_data_and_tag(batch, tag_field)
+            text, text_lengths, tag = get_batch_data_and_tag(batch)
 
             predictions = model(text, text_lengths, tag).squeeze(1)
 
             loss = criterion(predictions, batch.label)
 
-            acc = categorical_accuracy(predictions, batch.label)
+            metrics.update(predictions, batch.label, loss)
+
+    return metrics.compute()
+
+
+def get_model_inputs(model, batch):
+
+    if model.use_tags:
+        return get_batch_data_and_tag(batch)
+
+    return get_batch_data(batch)
+
+
+def train_multitask_model(model, iterator, optimizer, criterion, control=None):
+
+    metrics = MultiTaskMetrics(model.labels)
+
+    model.train()
+
+    for batch in tqdm(iterator, total=len(iterator), disable=not PROGRESS_BAR):
+
+        optimizer.zero_grad()
+
+        predictions = model(*get_model_inputs(model, batch))
+
+        targets = [getattr(batch, name) for name in model.labels]
+
+        loss, losses = model.loss(predictions, targets, criterion)
+
+        loss.backward()
+
+        optimizer.step()
+
+        metrics.update(predictions, targets, losses, loss)
+
+        # Ends the epoch early once the training budget is spent
+        if control is not None and control.step():
+            break
+
+    return metrics.compute()
+
+
+def evaluate_multitask_model(model, iterator, criterion):
+    metrics = MultiTaskMetrics(model.labels)
+
+    model.eval()
+
+    with torch.no_grad():
+
+        for batch in tqdm(iterator, total=len(iterator), disable=not PROGRESS_BAR):
+
+            predictions = model(*get_model_inputs(model, batch))
+
+            targets = [getattr(batch, name) for name in model.labels]
+
+            loss, losses = model.loss(predictions, targets, criterion)
 
-            epoch_loss += loss.item()
-            epoch_acc += acc.item()
+            metrics.update(predictions, targets, losses, loss)
 
-    return epoch_loss / len(iterator), epoch_acc / len(iterator)
+    return metrics.compute()
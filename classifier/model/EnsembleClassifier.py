@@ -0,0 +1,145 @@
+"""
+Ensemble of trained classifiers sharing their embedding lookup
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL
+from .RNNClassifiers import RNNFieldClassifer
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+COMBINE_METHODS = ["mean", "vote"]
+
+
+class EnsembleClassifier(nn.Module):
+    """
+    Runs every distinct embedding of the members once per batch and hands the
+    embedded text to the classify method of the members using it. Members
+    whose embedding weights are equal, like the frozen GloVe vectors, are
+    rebound to one shared nn.Embedding. With threads the members run
+    concurrently, torch releases the GIL inside its kernels.
+
+    mean averages the class probabilities of the members and vote counts
+    their predictions, ties are broken by the mean probabilities. Both are
+    returned as log probabilities so they read as logits downstream.
+
+    Only the embedding shapes of the members can be checked here, callers
+    building it from bundles compare their vocabularies first. The threads
+    are stopped by close, or on leaving a with block.
+    Input:
+        members: list -> Trained classifiers over the same text and label
+            vocabularies
+        combine: string -> One of COMBINE_METHODS
+        threads: int -> Members running at once, 0 runs them in turn
+    """
+
+    def __init__(self, members, combine="mean", threads=0):
+
+        super().__init__()
+
+        if combine not in COMBINE_METHODS:
+            raise ValueError(
+                "Unknown combine method {}, expected one of {}".format(
+                    combine, COMBINE_METHODS
+                )
+            )
+
+        if any(hasattr(member, "labels") for member in members):
+            raise ValueError("Members have to predict a single label")
+
+        shapes = {tuple(member.embedding.weight.shape) for member in members}
+        if len(shapes) > 1:
+            raise ValueError(
+                "Members embed different vocabularies {}".format(sorted(shapes))
+            )
+
+        self.members = nn.ModuleList(members)
+        self.combine = combine
+        self.threads = threads
+        self.executor = None
+
+        self.embeddings = nn.ModuleList()
+        self.embedding_of = []
+        for member in members:
+            for index, embedding in enumerate(self.embeddings):
+                if torch.equal(member.embedding.weight, embedding.weight):
+                    member.embedding = embedding
+                    break
+            else:
+                index = len(self.embeddings)
+                self.embeddings.append(member.embedding)
+            self.embedding_of.append(index)
+
+        self.use_tags = any(isinstance(member, RNNFieldClassifer) for member in members)
+
+        logger.debug(
+            "Ensemble of {} members over {} distinct embeddings".format(
+                len(members), len(self.embeddings)
+            )
+        )
+
+    @property
+    def embedding(self):
+        return self.embeddings[0]
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["executor"] = None
+        return state
+
+    def close(self):
+        """Stop the member threads, they are started again when needed"""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def member_logits(self, embedded, text_lengths, tag):
+        def run(index):
+            member = self.members[index]
+            inputs = (embedded[self.embedding_of[index]], text_lengths)
+            if isinstance(member, RNNFieldClassifer):
+                inputs += (tag,)
+            return member.classify(*inputs)
+
+        if self.threads and len(self.members) > 1:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.threads)
+            # Threads do not inherit the grad mode of the caller
+            grad_enabled = torch.is_grad_enabled()
+
+            def run_with_grad_mode(index):
+                with torch.set_grad_enabled(grad_enabled):
+                    return run(index)
+
+            return list(self.executor.map(run_with_grad_mode, range(len(self.members))))
+
+        return [run(index) for index in range(len(self.members))]
+
+    def forward(self, text, text_lengths, tag=None):
+
+        embedded = [embedding(text) for embedding in self.embeddings]
+
+        logits = torch.stack(self.member_logits(embedded, text_lengths, tag))
+
+        probabilities = F.softmax(logits, dim=2).mean(dim=0)
+
+        if self.combine == "vote":
+            votes = F.one_hot(logits.argmax(dim=2), logits.shape[2]).sum(dim=0)
+            # Mean probabilities sum to one, so they never outweigh a vote
+            probabilities = (votes + probabilities) / (len(self.members) + 1)
+
+        return probabilities.log()
@@ -0,0 +1,86 @@
+"""
+Classifier predicting several labels of a question with one shared encoder
+"""
+
+import logging
+
+import torch.nn as nn
+
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL
+from .RNNClassifiers import RNNFieldClassifer
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+
+class MultiTaskClassifier(nn.Module):
+    """
+    One of the classifiers used as a shared encoder, its fc layer is the
+    head of the first label and every other label gets its own linear head
+    on the same features, so one forward pass predicts all of them.
+    Input:
+        encoder: nn.Module -> Classifier with a features method and a fc layer
+        label_dims: dict -> Label name to its number of classes, in order
+        loss_weights: list -> Weight of every label in the joint loss
+    Output:
+        predictions: tuple -> Logits of every label in the order of labels
+    """
+
+    def __init__(self, encoder, label_dims, loss_weights=None):
+
+        super().__init__()
+
+        self.encoder = encoder
+        self.labels = list(label_dims)
+        self.loss_weights = list(loss_weights or [1.0] * len(self.labels))
+
+        if len(self.loss_weights) != len(self.labels):
+            raise ValueError(
+                "Got {} loss weights for the labels {}".format(
+                    len(self.loss_weights), self.labels
+                )
+            )
+
+        self.heads = nn.ModuleDict(
+            {
+                name: nn.Linear(encoder.fc.in_features, output_dim)
+                for name, output_dim in list(label_dims.items())[1:]
+            }
+        )
+
+        self.use_tags = isinstance(encoder, RNNFieldClassifer)
+
+    @property
+    def embedding(self):
+        return self.encoder.embedding
+
+    def forward(self, text, text_lengths, tag=None):
+
+        return self.classify(self.encoder.embedding(text), text_lengths, tag)
+
+    def classify(self, embedded, text_lengths, tag=None):
+        """Logits of every label for the embedded text"""
+
+        if self.use_tags:
+            features = self.encoder.features(embedded, text_lengths, tag)
+        else:
+            features = self.encoder.features(embedded, text_lengths)
+
+        return (self.encoder.fc(features),) + tuple(
+            self.heads[name](features) for name in self.labels[1:]
+        )
+
+    def loss(self, predictions, targets, criterion):
+        """
+        Weighted sum of the criterion of every label
+        Output:
+            loss: tensor -> Joint loss
+            losses: list -> Loss of every label
+        """
+        losses = [
+            criterion(prediction, target)
+            for prediction, target in zip(predictions, targets)
+        ]
+        loss = sum(weight * loss for weight, loss in zip(self.loss_weights, losses))
+        return loss, losses
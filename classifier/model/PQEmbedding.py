@@ -0,0 +1,150 @@
+"""
+Product quantized embedding table replacing a trained nn.Embedding
+"""
+
+import logging
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+
+def kmeans(vectors, n_centroids, iterations, generator):
+    """
+    Lloyd's k-means started from randomly chosen vectors
+    Output:
+        centroids: tensor -> [n_centroids, dim], fewer if there are fewer vectors
+        assignments: tensor -> Index of the nearest centroid of every vector
+    """
+    start = torch.randperm(len(vectors), generator=generator)[:n_centroids]
+    centroids = vectors[start].clone()
+
+    for _ in range(iterations):
+        assignments = torch.cdist(vectors, centroids).argmin(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, vectors)
+        counts = torch.bincount(assignments, minlength=len(centroids))
+        # Empty clusters keep their centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled].unsqueeze(1).float()
+
+    return centroids, torch.cdist(vectors, centroids).argmin(dim=1)
+
+
+class PQEmbedding(nn.Module):
+    """
+    Frozen embedding table stored as product quantization codes. Every row is
+    split into n_subvectors parts and each part is kept as the uint8 index of a
+    centroid in the codebook of its subspace, a lookup gathers the centroids
+    of the codes and concatenates them back into a row. Centroid 0 of every
+    codebook is the zero vector so all zero rows, like the padding and unknown
+    vectors, are reconstructed exactly.
+    Input:
+        num_embeddings: int -> Number of rows of the table
+        embedding_dim: int -> Size of a row, divisible by n_subvectors
+        n_subvectors: int -> Number of subspaces a row is split into
+        n_centroids: int -> Centroids of every codebook, at most 256
+        padding_idx: int -> Padding row, kept for the code reading it
+    """
+
+    def __init__(
+        self,
+        num_embeddings,
+        embedding_dim,
+        n_subvectors,
+        n_centroids=256,
+        padding_idx=None,
+    ):
+
+        super().__init__()
+
+        if embedding_dim % n_subvectors:
+            raise ValueError(
+                "Embedding dim {} is not divisible into {} subvectors".format(
+                    embedding_dim, n_subvectors
+                )
+            )
+        if not 2 <= n_centroids <= 256:
+            raise ValueError(
+                "Codes are uint8, got {} centroids per codebook".format(n_centroids)
+            )
+
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.n_subvectors = n_subvectors
+        self.n_centroids = n_centroids
+        self.padding_idx = padding_idx
+
+        # Codebooks of all subspaces stacked, subspace i starts at i * n_centroids
+        self.register_buffer(
+            "codebooks",
+            torch.zeros(n_subvectors * n_centroids, embedding_dim // n_subvectors),
+        )
+        self.register_buffer(
+            "codes", torch.zeros(num_embeddings, n_subvectors, dtype=torch.uint8)
+        )
+
+    @classmethod
+    def from_embedding(cls, embedding, n_subvectors, n_centroids=256, iterations=20):
+        """Quantize the weights of an nn.Embedding"""
+        weight = embedding.weight.detach().float().cpu()
+        pq = cls(
+            weight.shape[0],
+            weight.shape[1],
+            n_subvectors,
+            n_centroids,
+            embedding.padding_idx,
+        )
+
+        nonzero = (weight != 0).any(dim=1)
+        subvectors = weight[nonzero].view(-1, n_subvectors, pq.subvector_dim)
+        codebooks = pq.codebooks.view(n_subvectors, n_centroids, pq.subvector_dim)
+        generator = torch.Generator().manual_seed(0)
+
+        codes = torch.zeros(len(subvectors), n_subvectors, dtype=torch.uint8)
+        for index in range(n_subvectors):
+            centroids, assignments = kmeans(
+                subvectors[:, index], n_centroids - 1, iterations, generator
+            )
+            codebooks[index, 1 : len(centroids) + 1] = centroids
+            codes[:, index] = assignments + 1
+        pq.codes[nonzero] = codes
+
+        logger.debug(
+            "Quantized {} rows into {} subvectors of {} centroids".format(
+                len(weight), n_subvectors, n_centroids
+            )
+        )
+        return pq
+
+    @property
+    def subvector_dim(self):
+        return self.embedding_dim // self.n_subvectors
+
+    @property
+    def weight(self):
+        """Reconstructed float table"""
+        return self(torch.arange(self.num_embeddings, device=self.codes.device))
+
+    def forward(self, input):
+
+        offsets = self.n_centroids * torch.arange(
+            self.n_subvectors, device=self.codes.device
+        )
+        codes = self.codes[input].long() + offsets
+
+        return F.embedding(codes, self.codebooks).flatten(-2)
+
+    def extra_repr(self):
+        return "{}, {}, n_subvectors={}, n_centroids={}, padding_idx={}".format(
+            self.num_embeddings,
+            self.embedding_dim,
+            self.n_subvectors,
+            self.n_centroids,
+            self.padding_idx,
+        )
@@ -53,7 +53,17 @@ class RNNHiddenClassifier(nn.Module):
 
     def forward(self, text, text_lengths):
 
-        embedded = self.dropout(self.embedding(text))
+        return self.classify(self.embedding(text), text_lengths)
+
+    def classify(self, embedded, text_lengths):
+        """Logits of the embedded text [sent len, batch size, embedding dim]"""
+
+        return self.fc(self.features(embedded, text_lengths))
+
+    def features(self, embedded, text_lengths):
+        """Input of the fc layer"""
+
+        embedded = self.dropout(embedded)
 
         packed_embedded = nn.utils.rnn.pack_padded_sequence(embedded, text_lengths)
 
@@ -68,7 +78,7 @@ class RNNHiddenClassifier(nn.Module):
         else:
             hidden = self.dropout(hidden[-1, :, :])
 
-        return self.fc(hidden)
+        return hidden
 
 
 class RNNMaxpoolClassifier(nn.Module):
@@ -106,7 +116,17 @@ class RNNMaxpoolClassifier(nn.Module):
 
     def forward(self, text, text_lengths):
 
-        embedded = self.dropout(self.embedding(text))
+        return self.classify(self.embedding(text), text_lengths)
+
+    def classify(self, embedded, text_lengths):
+        """Logits of the embedded text [sent len, batch size, embedding dim]"""
+
+        return self.fc(self.features(embedded, text_lengths))
+
+    def features(self, embedded, text_lengths):
+        """Input of the fc layer"""
+
+        embedded = self.dropout(embedded)
 
         packed_embedded = nn.utils.rnn.pack_padded_sequence(embedded, text_lengths)
 
@@ -116,7 +136,7 @@ class RNNMaxpoolClassifier(nn.Module):
 
         hidden, _ = torch.max(hidden, dim=0)
 
-        return self.fc(hidden)
+        return hidden
 
 
 class RNNFieldClassifer(nn.Module):
@@ -163,17 +183,27 @@ class RNNFieldClassifer(nn.Module):
 
     def forward(self, text, text_lengths, tag):
 
-        embedded = self.dropout(self.embedding(text))
+        return self.classify(self.embedding(text), text_lengths, tag)
+
+    def classify(self, embedded, text_lengths, tag):
+        """Logits of the embedded text [sent len, batch size, embedding dim]"""
+
+        return self.fc(self.features(embedded, text_lengths, tag))
+
+    def features(self, embedded, text_lengths, tag):
+        """Input of the fc layer"""
+
+        embedded = self.dropout(embedded)
 
         tag_embedded = self.dropout(self.tag_embedding(tag))
 
         embed = torch.cat((embedded, tag_embedded), -1)
 
-        # packed_embedded = nn.utils.rnn.pack_padded_sequence(embedded, text_lengths)
-
-        packed_output, (hidden, cell) = self.rnn(embed)
+        # Packed so the LSTM skips the padding and hidden is the state at the
+        # true end of every question, key and answer sequence
+        packed_embedded = nn.utils.rnn.pack_padded_sequence(embed, text_lengths)
 
-        # output, output_lengths = nn.utils.rnn.pad_packed_sequence(packed_output)
+        packed_output, (hidden, cell) = self.rnn(packed_embedded)
 
         if self.bidirectional:
             hidden = self.dropout(
@@ -182,4 +212,4 @@ class RNNFieldClassifer(nn.Module):
         else:
             hidden = self.dropout(hidden[-1, :, :])
 
-        return self.fc(hidden)
+        return hidden
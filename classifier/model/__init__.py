@@ -4,3 +4,6 @@ Diretory for model related information
 
 from .RNNClassifiers import RNNHiddenClassifier, RNNMaxpoolClassifier, RNNFieldClassifer
 from .CNNClassifiers import CNN2dClassifier, CNN1dClassifier, CNN1dExtraLayerClassifier
+from .EnsembleClassifier import EnsembleClassifier, COMBINE_METHODS
+from .MultiTaskClassifier import MultiTaskClassifier
+from .PQEmbedding import PQEmbedding
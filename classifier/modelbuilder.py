@@ -0,0 +1,148 @@
+"""
+Build a classifier from its name, the vocabularies of a dataset and a dict of
+hyperparameters, shared by training and by loading checkpoint bundles
+"""
+
+import logging
+
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL
+from model import (
+    CNN1dClassifier,
+    CNN1dExtraLayerClassifier,
+    CNN2dClassifier,
+    MultiTaskClassifier,
+    PQEmbedding,
+    RNNFieldClassifer,
+    RNNHiddenClassifier,
+    RNNMaxpoolClassifier,
+)
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+CLASSIFIERS = [
+    "RNNHiddenClassifier",
+    "RNNMaxpoolClassifier",
+    "CNN2dClassifier",
+    "CNN1dClassifier",
+    "RNNFieldClassifer",
+    "CNN1dExtraLayerClassifier",
+]
+
+
+def build_model(classifier_type, dataset, hyperparameters):
+    """
+    Initialize an untrained classifier
+    Input:
+        classifier_type: string -> One of CLASSIFIERS
+        dataset: GrammarDataset -> Dataset whose fields have their vocabularies
+        hyperparameters: dict -> embedding_dim, hidden_dim, n_layers,
+            bidirectional, dropout, n_filters, filter_sizes and linear_hidden_dim,
+            optionally labels and label_weights, labels other than just label
+            build a MultiTaskClassifier around the classifier so the labels are
+            read by name, and pq_embedding with the n_subvectors and
+            n_centroids of a table compressed by compress.py
+    """
+    labels = hyperparameters.get("labels", ["label"])
+    label_dims = {name: len(getattr(dataset, name).vocab) for name in labels}
+
+    model = build_classifier(
+        classifier_type, dataset, hyperparameters, label_dims[labels[0]]
+    )
+
+    pq_embedding = hyperparameters.get("pq_embedding")
+    if pq_embedding:
+        model.embedding = PQEmbedding(
+            model.embedding.num_embeddings,
+            model.embedding.embedding_dim,
+            pq_embedding["n_subvectors"],
+            pq_embedding["n_centroids"],
+            model.embedding.padding_idx,
+        )
+
+    # The plain classifiers are trained and decoded against the label field
+    if labels == ["label"]:
+        return model
+
+    return MultiTaskClassifier(
+        model, label_dims, hyperparameters.get("label_weights")
+    )
+
+
+def build_classifier(classifier_type, dataset, hyperparameters, output_dim):
+    """Classifier of classifier_type with a single output layer"""
+    text_field = dataset.text_field
+    vocab_size = len(text_field.vocab)
+    pad_idx = text_field.vocab.stoi[text_field.pad_token]
+
+    embedding_dim = hyperparameters["embedding_dim"]
+    dropout = hyperparameters["dropout"]
+
+    if classifier_type == "RNNHiddenClassifier":
+        return RNNHiddenClassifier(
+            vocab_size,
+            embedding_dim,
+            hyperparameters["hidden_dim"],
+            output_dim,
+            hyperparameters["n_layers"],
+            hyperparameters["bidirectional"],
+            dropout,
+            pad_idx,
+        )
+    if classifier_type == "RNNMaxpoolClassifier":
+        return RNNMaxpoolClassifier(
+            vocab_size,
+            embedding_dim,
+            hyperparameters["hidden_dim"],
+            output_dim,
+            hyperparameters["n_layers"],
+            hyperparameters["bidirectional"],
+            dropout,
+            pad_idx,
+        )
+    if classifier_type == "CNN2dClassifier":
+        return CNN2dClassifier(
+            vocab_size,
+            embedding_dim,
+            hyperparameters["n_filters"],
+            hyperparameters["filter_sizes"],
+            output_dim,
+            dropout,
+            pad_idx,
+        )
+    if classifier_type == "CNN1dClassifier":
+        return CNN1dClassifier(
+            vocab_size,
+            embedding_dim,
+            hyperparameters["n_filters"],
+            hyperparameters["filter_sizes"],
+            output_dim,
+            dropout,
+            pad_idx,
+        )
+    if classifier_type == "RNNFieldClassifer":
+        return RNNFieldClassifer(
+            vocab_size,
+            embedding_dim,
+            hyperparameters["hidden_dim"],
+            output_dim,
+            hyperparameters["n_layers"],
+            hyperparameters["bidirectional"],
+            dropout,
+            pad_idx,
+            dataset.tags,
+        )
+    if classifier_type == "CNN1dExtraLayerClassifier":
+        return CNN1dExtraLayerClassifier(
+            vocab_size,
+            embedding_dim,
+            hyperparameters["n_filters"],
+            hyperparameters["filter_sizes"],
+            hyperparameters["linear_hidden_dim"],
+            output_dim,
+            dropout,
+            pad_idx,
+        )
+
+    raise TypeError("Invalid Classifier selected")
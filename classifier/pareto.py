@@ -0,0 +1,356 @@
+"""
+Accuracy against CPU latency benchmark of every classifier run this file by
+
+```
+    >>> python pareto.py
+    >>> python pareto.py --models RNNHiddenClassifier CNN1dClassifier --retrain
+    >>> python pareto.py --threads 1 --lengths 8 32 128 --batch-size 64
+```
+Every classifier is trained with the same seed and the default
+hyperparameters, RNNFieldClassifer on the multi dataset and the others on
+--tag, and its best epoch is saved as a bundle in PARETO_FOLDER. Bundles that
+already exist there are loaded instead unless --retrain is given, --bundles
+trained compares the bundles of train.py. Every model is measured for test
+accuracy, macro F1, parameter count, memory of its weights and the p50/p99
+CPU latency of a single record and of a batch of random tokens at every
+sequence length. A model is on the Pareto front of single or batched latency
+when no other model is at least as accurate and at least as fast at every
+length while better in one of them. The results are written to a json report
+and printed as tables.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+
+from bundle import DATASETS, load_bundle, save_bundle
+from config.hyperparameters import (
+    BATCH_SIZE,
+    EPOCHS,
+    TRIAL_DEFAULTS,
+    TRIAL_HYPERPARAMETERS,
+)
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    PARETO_FOLDER,
+    SEED,
+    device,
+    seed_all,
+)
+from model import RNNFieldClassifer
+from modelbuilder import CLASSIFIERS
+from quantize import cpu, model_size, test_metrics
+from train import fit, initialize_new_model
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Classifiers that need another dataset than --tag
+MODEL_TAGS = {"RNNFieldClassifer": "multi"}
+LATENCY_MODES = ["single", "batched"]
+# Calls run before the latency is measured
+WARMUP_RUNS = 10
+
+
+def load_dataset(tag, datasets):
+    """Compiled dataset of the tag with its iterators, loaded once"""
+    if tag not in datasets:
+        datasets[tag] = DATASETS[tag].get_iterators(TRIAL_DEFAULTS["batch_size"])
+    return datasets[tag]
+
+
+def train_bundle(classifier_type, tag, location, epochs, seed, datasets):
+    """Train a classifier with the default hyperparameters and save its bundle"""
+    dataset = load_dataset(tag, datasets)
+
+    seed_all(seed)
+    hyperparameters = {name: TRIAL_DEFAULTS[name] for name in TRIAL_HYPERPARAMETERS}
+    model = initialize_new_model(
+        classifier_type,
+        dataset,
+        hyperparameters,
+        TRIAL_DEFAULTS["freeze_embeddings"],
+        TRIAL_DEFAULTS["sparse_embeddings"],
+    ).to(device)
+
+    best = fit(
+        model,
+        dataset,
+        classifier_type,
+        epochs,
+        TRIAL_DEFAULTS["learning_rate"],
+        TRIAL_DEFAULTS["l2_regularization"],
+        on_improvement=lambda model: save_bundle(
+            location, model, classifier_type, hyperparameters, dataset, tag
+        ),
+        verbose=False,
+        patience=TRIAL_DEFAULTS["patience"],
+    )
+    logger.info(
+        "Trained {} for {} epochs, best epoch {}".format(
+            classifier_type, epochs, best["epoch"]
+        )
+    )
+
+
+def random_inputs(model, dataset, batch_size, length):
+    """Forward arguments of a batch of random tokens of one length"""
+    # The first two indexes of the vocabulary are unk and pad
+    text = torch.randint(2, len(dataset.text_field.vocab), (length, batch_size))
+    text_lengths = torch.full((batch_size,), length, dtype=torch.long)
+    if isinstance(model, RNNFieldClassifer) or getattr(model, "use_tags", False):
+        segments = torch.tensor(
+            [dataset.tags.vocab.stoi[tag] for tag in dataset.segment_tags.values()]
+        )
+        tag = segments[torch.randint(len(segments), (length, batch_size))]
+        return text, text_lengths, tag
+    return text, text_lengths
+
+
+def latency(model, dataset, batch_size, length, repeats):
+    """p50 and p99 milliseconds of a forward pass"""
+    inputs = random_inputs(model, dataset, batch_size, length)
+
+    timings = []
+    with torch.no_grad():
+        for index in range(WARMUP_RUNS + repeats):
+            start_time = time.perf_counter()
+            model(*inputs)
+            if index >= WARMUP_RUNS:
+                timings.append(1000 * (time.perf_counter() - start_time))
+
+    return {
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p99_ms": float(np.percentile(timings, 99)),
+    }
+
+
+def measure(classifier_type, location, args, datasets):
+    """Row of the report of one bundle"""
+    model, dataset, meta = load_bundle(location, cpu)
+    model.eval()
+
+    metrics = test_metrics(model, load_dataset(meta["dataset"], datasets), BATCH_SIZE)
+    batch_sizes = {"single": 1, "batched": args.batch_size}
+
+    return {
+        "model": classifier_type,
+        "tag": meta["dataset"],
+        "accuracy": metrics["accuracy"],
+        "macro_f1": metrics["macro_f1"],
+        "parameters": sum(parameter.numel() for parameter in model.parameters()),
+        "trainable_parameters": sum(
+            parameter.numel()
+            for parameter in model.parameters()
+            if parameter.requires_grad
+        ),
+        "memory_mb": sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in itertools.chain(model.parameters(), model.buffers())
+        )
+        / 2 ** 20,
+        "size_mb": model_size(model) / 2 ** 20,
+        "latency": {
+            mode: {
+                str(length): latency(
+                    model, dataset, batch_sizes[mode], length, args.repeats
+                )
+                for length in args.lengths
+            }
+            for mode in LATENCY_MODES
+        },
+    }
+
+
+def dominates(row, other, mode):
+    """row is at least as accurate and as fast as other and better in one"""
+    pairs = [(-row["accuracy"], -other["accuracy"])] + [
+        (row["latency"][mode][length]["p50_ms"], timing["p50_ms"])
+        for length, timing in other["latency"][mode].items()
+    ]
+    return all(mine <= theirs for mine, theirs in pairs) and any(
+        mine < theirs for mine, theirs in pairs
+    )
+
+
+def pareto_front(rows, mode):
+    """Models no other model dominates on accuracy and latency of the mode"""
+    return [
+        row["model"]
+        for row in rows
+        if not any(dominates(other, row, mode) for other in rows if other is not row)
+    ]
+
+
+def print_report(report, lengths, batch_size):
+    rows = report["models"]
+
+    print("* marks the Pareto fronts of accuracy against single and batched latency")
+    print(
+        "{:<28}{:>12}{:>8}{:>8}{:>12}{:>9}{:>8}{:>8}".format(
+            "Model", "Tag", "Acc", "F1", "Params", "Mem MB", "Single", "Batched"
+        )
+    )
+    for row in rows:
+        print(
+            "{:<28}{:>12}{:>8.4f}{:>8.4f}{:>12,}{:>9.2f}{:>8}{:>8}".format(
+                row["model"],
+                row["tag"],
+                row["accuracy"],
+                row["macro_f1"],
+                row["parameters"],
+                row["memory_mb"],
+                *(
+                    "*" if row["model"] in report["pareto"][mode] else ""
+                    for mode in LATENCY_MODES
+                )
+            )
+        )
+
+    titles = {
+        "single": "p50 ms of a single record by length",
+        "batched": "p50 ms of a batch of {} by length".format(batch_size),
+    }
+    for mode in LATENCY_MODES:
+        print("\n" + titles[mode])
+        print(
+            "{:<28}".format("Model") + "".join("{:>10}".format(n) for n in lengths)
+        )
+        for row in rows:
+            print(
+                "{:<28}".format(row["model"])
+                + "".join(
+                    "{:>10.3f}".format(row["latency"][mode][str(length)]["p50_ms"])
+                    for length in lengths
+                )
+            )
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to compare the accuracy and latency of the classifiers"
+    )
+
+    parser.add_argument(
+        "-m",
+        "--models",
+        default=CLASSIFIERS,
+        nargs="+",
+        choices=CLASSIFIERS,
+        help="Classifiers to compare",
+    )
+    parser.add_argument(
+        "-t",
+        "--tag",
+        default="answeronly",
+        choices=["multi", "answeronly"],
+        help="Dataset of the classifiers, RNNFieldClassifer always uses multi",
+    )
+    parser.add_argument(
+        "--bundles",
+        default=PARETO_FOLDER,
+        help="Folder of the bundles named after their classifier",
+    )
+    parser.add_argument(
+        "--retrain",
+        default=False,
+        action="store_true",
+        help="Train every classifier again even if its bundle exists",
+    )
+    parser.add_argument(
+        "--epochs", default=EPOCHS, help="Epochs of the classifiers trained", type=int
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        default=SEED,
+        help="Seed of every classifier trained",
+        type=int,
+    )
+    parser.add_argument(
+        "--lengths",
+        default=[8, 16, 32, 64],
+        nargs="+",
+        help="Sequence lengths the latency is measured at",
+        type=int,
+    )
+    parser.add_argument(
+        "-batch",
+        "--batch-size",
+        default=BATCH_SIZE,
+        help="Records of the batched latency",
+        type=int,
+    )
+    parser.add_argument(
+        "-n", "--repeats", default=50, help="Timed calls per case", type=int
+    )
+    parser.add_argument(
+        "-th",
+        "--threads",
+        default=None,
+        help="Torch threads, defaults to the torch default",
+        type=int,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=os.path.join(PARETO_FOLDER, "pareto.json"),
+        help="Json report of every model and the Pareto fronts",
+    )
+
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    datasets = {}
+    rows = []
+    for classifier_type in args.models:
+        location = os.path.join(args.bundles, classifier_type)
+        if args.retrain or not os.path.exists(location):
+            train_bundle(
+                classifier_type,
+                MODEL_TAGS.get(classifier_type, args.tag),
+                location,
+                args.epochs,
+                args.seed,
+                datasets,
+            )
+        rows.append(measure(classifier_type, location, args, datasets))
+        logger.info(
+            "Measured {}: accuracy {:.4f}".format(classifier_type, rows[-1]["accuracy"])
+        )
+
+    report = {
+        "seed": args.seed,
+        "epochs": args.epochs,
+        "threads": torch.get_num_threads(),
+        "batch_size": args.batch_size,
+        "lengths": args.lengths,
+        "models": rows,
+        "pareto": {mode: pareto_front(rows, mode) for mode in LATENCY_MODES},
+    }
+
+    print_report(report, args.lengths, args.batch_size)
+
+    folder = os.path.dirname(args.output)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(args.output, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    logger.info("Saved the report to {}".format(args.output))
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
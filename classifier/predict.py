@@ -0,0 +1,397 @@
+"""
+Batched offline prediction of the type of question with a trained classifier
+run this file by
+
+```
+    >>> python predict.py --input questions.tsv --output predictions.tsv
+    >>> python predict.py -i questions.jsonl -o predictions.jsonl --tag multi
+    >>> python predict.py -i questions.tsv -loc trained/RNNHiddenClassifier \
+            trained/CNN1dClassifier --combine vote --ensemble-threads 2
+```
+Input rows are read from a tsv with a header or from jsonl and need the
+columns of the processed dataset, answer for answeronly models and Question,
+key and answer for multi models. Several model locations are run as one
+EnsembleClassifier which embeds every batch once for all of its members
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import time
+from itertools import islice
+
+import torch
+import torch.nn.functional as F
+
+from bundle import load_bundle
+from compileddataset import CompiledIterator, flatten
+from cpuprofile import apply_profile
+from config.hyperparameters import BATCH_SIZE
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    TRAINED_CLASSIFIER_FOLDER,
+    TRAINED_CLASSIFIER_DEFAULT,
+    device,
+)
+from datasetloader import GrammarDasetAnswerTag, GrammarDasetMultiTag
+from helperfunctions import get_batch_data, get_batch_data_and_tag
+from model import COMBINE_METHODS, EnsembleClassifier, RNNFieldClassifer
+from utility import tokenizer
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Column of the input rows read by every sequence field of the datasets
+INPUT_COLUMNS = {
+    "question": "Question",
+    "key": "key",
+    "answer": "answer",
+    "text": "answer",
+}
+PREDICTION_CHUNK_SIZE = 10000
+
+
+def load_trained(model_location, dataset_tag):
+    """
+    Model, dataset and dataset tag of a bundle, or of a model saved by
+    torch.save with the vocabularies of the compiled dataset_tag dataset
+    """
+    if os.path.isdir(model_location):
+        model, dataset, meta = load_bundle(model_location)
+        return model, dataset, meta["dataset"]
+
+    if dataset_tag == "multi":
+        dataset_class = GrammarDasetMultiTag
+    else:
+        dataset_class = GrammarDasetAnswerTag
+
+    dataset = dataset_class()
+    dataset.load_compiled(dataset_class.compile_if_needed())
+
+    return torch.load(model_location, map_location=device), dataset, dataset_tag
+
+
+class Predictor:
+    """
+    Trained classifier together with the vocabularies of its dataset, records
+    are numericalized in bulk and run through length bucketed batches
+    """
+
+    def __init__(self, model, dataset, dataset_tag, batch_size=BATCH_SIZE):
+        self.model = model.to(device)
+        self.model.eval()
+        self.dataset = dataset
+        self.dataset_tag = dataset_tag
+        self.batch_size = batch_size
+        # MultiTaskClassifier predicts several labels, the first is the main one
+        self.tasks = getattr(model, "labels", ["label"])
+        self.task_labels = {
+            name: getattr(dataset, name).vocab.itos for name in self.tasks
+        }
+        self.labels = self.task_labels[self.tasks[0]]
+        self.use_tags = isinstance(model, RNNFieldClassifer) or getattr(
+            model, "use_tags", False
+        )
+
+    @classmethod
+    def from_trained(
+        cls,
+        model_location,
+        dataset_tag,
+        batch_size=None,
+        combine="mean",
+        threads=0,
+        apply_cpu_profile=True,
+    ):
+        """
+        Load a bundle saved by train.py, or a model saved by torch.save
+        together with the vocabularies of the compiled dataset_tag dataset.
+        A list of several locations is loaded as an EnsembleClassifier, its
+        members have to be trained on the same dataset with the same
+        vocabularies, its threads are stopped by close. The threads of the
+        autotuned CPU profile of the model are set and its batch size is used
+        when batch_size is not given
+        """
+        if isinstance(model_location, str):
+            model_location = [model_location]
+
+        profile = apply_profile(model_location) if apply_cpu_profile else None
+        if batch_size is None:
+            batch_size = profile["batch_size"] if profile else BATCH_SIZE
+
+        members = []
+        dataset = None
+        for location in model_location:
+            model, member_dataset, member_tag = load_trained(location, dataset_tag)
+            if dataset is None:
+                dataset, dataset_tag = member_dataset, member_tag
+            elif member_tag != dataset_tag or any(
+                getattr(member_dataset, name).vocab.itos
+                != getattr(dataset, name).vocab.itos
+                for name in dataset.vocab_fields
+            ):
+                raise ValueError(
+                    "{} was not trained on the dataset and vocabularies of {}".format(
+                        location, model_location[0]
+                    )
+                )
+            members.append(model)
+
+        if len(members) == 1:
+            return cls(members[0], dataset, dataset_tag, batch_size)
+
+        return cls(
+            EnsembleClassifier(members, combine, threads),
+            dataset,
+            dataset_tag,
+            batch_size,
+        )
+
+    def close(self):
+        """Stop the member threads of an EnsembleClassifier model"""
+        if isinstance(self.model, EnsembleClassifier):
+            self.model.close()
+
+    def encode(self, records):
+        """Flat arrays of every sequence field of the records"""
+        columns = {
+            name: tokenizer.tokenize([record[INPUT_COLUMNS[name]] for record in records])
+            for name in self.dataset.text_fields
+        }
+        return {
+            name: flatten(sequences)
+            for name, sequences in self.dataset.numericalize(columns).items()
+        }
+
+    def forward(self, batch):
+        if self.use_tags:
+            text, text_lengths, tag = get_batch_data_and_tag(batch)
+            return self.model(text, text_lengths, tag)
+
+        text, text_lengths = get_batch_data(batch)
+        return self.model(text, text_lengths)
+
+    def predict_task_probabilities(self, records):
+        """Returns the class probabilities of every label in input order"""
+        return self.encoded_task_probabilities(self.encode(records), len(records))
+
+    def encoded_task_probabilities(self, encoded, n_records):
+        """predict_task_probabilities of n_records already run through encode"""
+        iterator = CompiledIterator(
+            encoded,
+            {},
+            self.dataset.pad_indexes,
+            self.batch_size,
+            train=False,
+        )
+
+        probabilities = {
+            name: torch.zeros(n_records, len(labels))
+            for name, labels in self.task_labels.items()
+        }
+        with torch.no_grad():
+            for batch in iterator:
+                predictions = self.forward(batch)
+                if not isinstance(predictions, tuple):
+                    predictions = (predictions,)
+
+                indices = torch.from_numpy(batch.indices)
+                for name, prediction in zip(self.tasks, predictions):
+                    probabilities[name][indices] = F.softmax(prediction, dim=1).cpu()
+
+        return probabilities
+
+    def predict_probabilities(self, records):
+        """Returns the class probabilities of the records in input order"""
+        return self.predict_task_probabilities(records)[self.tasks[0]]
+
+    def predict_tasks(self, records):
+        """
+        Yields a dict of every record from each label to its prediction, the
+        confidence and the class probabilities
+        """
+        results = {}
+        for name, probabilities in self.predict_task_probabilities(records).items():
+            confidences, predictions = probabilities.max(dim=1)
+            results[name] = [
+                (self.task_labels[name][prediction], confidence, probability)
+                for prediction, confidence, probability in zip(
+                    predictions.tolist(), confidences.tolist(), probabilities.tolist()
+                )
+            ]
+
+        for index in range(len(records)):
+            yield {name: results[name][index] for name in self.tasks}
+
+    def predict(self, records):
+        """Yields the predicted label and the class probabilities of every record"""
+        for result in self.predict_tasks(records):
+            yield result[self.tasks[0]]
+
+
+def read_records(location):
+    """Yields the rows of a tsv file with a header or of a jsonl file as dicts"""
+    with open(location, encoding="utf8") as input_file:
+        if location.endswith(".jsonl"):
+            for line in input_file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(input_file, delimiter="\t")
+
+
+def chunked(records, chunk_size):
+    records = iter(records)
+    chunk = list(islice(records, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(records, chunk_size))
+
+
+def task_suffix(predictor, name):
+    """Suffix of the output columns of a label, none for the main one"""
+    return "" if name == predictor.tasks[0] else "_" + name
+
+
+def predict_file(predictor, input_location, output_location, chunk_size):
+    """
+    Streams the input through the predictor chunk by chunk and writes every
+    row with its prediction, confidence and class probabilities
+    """
+    writer = None
+    count = 0
+    with open(output_location, "w", encoding="utf8", newline="") as output_file:
+        for records in chunked(read_records(input_location), chunk_size):
+            for record, result in zip(records, predictor.predict_tasks(records)):
+                if output_location.endswith(".jsonl"):
+                    for name in predictor.tasks:
+                        label, confidence, probabilities = result[name]
+                        suffix = task_suffix(predictor, name)
+                        record["prediction" + suffix] = label
+                        record["confidence" + suffix] = confidence
+                        record["probabilities" + suffix] = dict(
+                            zip(predictor.task_labels[name], probabilities)
+                        )
+                    output_file.write(json.dumps(record) + "\n")
+                    continue
+
+                if writer is None:
+                    columns = list(record)
+                    for name in predictor.tasks:
+                        suffix = task_suffix(predictor, name)
+                        columns += ["prediction" + suffix, "confidence" + suffix] + [
+                            "probability{}_{}".format(suffix, label)
+                            for label in predictor.task_labels[name]
+                        ]
+                    writer = csv.DictWriter(
+                        output_file,
+                        fieldnames=columns,
+                        delimiter="\t",
+                        extrasaction="ignore",
+                    )
+                    writer.writeheader()
+
+                for name in predictor.tasks:
+                    label, confidence, probabilities = result[name]
+                    suffix = task_suffix(predictor, name)
+                    record["prediction" + suffix] = label
+                    record["confidence" + suffix] = confidence
+                    for class_name, probability in zip(
+                        predictor.task_labels[name], probabilities
+                    ):
+                        column = "probability{}_{}".format(suffix, class_name)
+                        record[column] = probability
+                writer.writerow(record)
+
+            count += len(records)
+            logger.debug("Predicted {} records".format(count))
+
+    return count
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to predict the type of question with a trained model"
+    )
+
+    parser.add_argument(
+        "-i", "--input", required=True, help="Input tsv or jsonl file to predict"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="predictions.tsv",
+        help="Output file, written as jsonl if it ends with .jsonl otherwise tsv",
+    )
+    parser.add_argument(
+        "-loc",
+        "--model-location",
+        default=[os.path.join(TRAINED_CLASSIFIER_FOLDER, TRAINED_CLASSIFIER_DEFAULT)],
+        nargs="+",
+        help="Location of the trained model, several are run as an ensemble",
+    )
+    parser.add_argument(
+        "-t",
+        "--tag",
+        default="answeronly",
+        choices=["multi", "answeronly"],
+        help="Dataset type the model was trained on, bundles know their own",
+    )
+    parser.add_argument(
+        "-batch",
+        "--batch_size",
+        default=None,
+        help="Records in a forward pass, defaults to the autotuned or BATCH_SIZE",
+        type=int,
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk-size",
+        default=PREDICTION_CHUNK_SIZE,
+        help="Number of records read, bucketed and written at once",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--combine",
+        default="mean",
+        choices=COMBINE_METHODS,
+        help="How an ensemble combines its members, mean probabilities or votes",
+    )
+    parser.add_argument(
+        "-et",
+        "--ensemble-threads",
+        default=0,
+        help="Ensemble members run at once, 0 runs them in turn",
+        type=int,
+    )
+
+    args = parser.parse_args()
+
+    predictor = Predictor.from_trained(
+        args.model_location,
+        args.tag,
+        args.batch_size,
+        args.combine,
+        args.ensemble_threads,
+    )
+    logger.info("Model Loaded in {:.4f}s".format(time.time() - start_time))
+
+    try:
+        count = predict_file(predictor, args.input, args.output, args.chunk_size)
+    finally:
+        predictor.close()
+
+    elapsed = time.time() - start_time
+    logger.info(
+        "Predicted {} records in {:.4f}s ({:.1f} records/s)".format(
+            count, elapsed, count / max(elapsed, 1e-9)
+        )
+    )
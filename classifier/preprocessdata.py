@@ -4,7 +4,13 @@ Preprocessing of raw data run this file by
 ```
     >>> python preprocessdata.py  
     >>> python preproecssdata.py --location <datasetLocation>
+    >>> python preprocessdata.py --location <datasetLocation> --stream
 ```
+--stream reads the dataset in chunks of --chunksize rows, normalizes every
+chunk and appends it to the train and test files, a row goes to the test
+split when a seeded hash of its content falls in the TEST_SPLIT share of the
+hash range, so memory stays bounded by the chunk size and the split does not
+depend on the order or chunking of the rows.
 """
 
 import argparse
@@ -18,9 +24,11 @@ import torch
 from sklearn.model_selection import train_test_split
 from config.data import (
     DATASET_FOLDER,
+    PREPROCESS_CHUNK_SIZE,
     PROCESSED_DATASET,
     PROCESSED_DATASET_FOLDER,
     RAW_DATASET,
+    TEST_SPLIT,
 )
 from config.root import LOGGING_FORMAT, LOGGING_LEVEL, SEED
 
@@ -28,38 +36,64 @@ from config.root import LOGGING_FORMAT, LOGGING_LEVEL, SEED
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
 
+# Row hashes are reduced to this many buckets, TEST_SPLIT of them are test rows
+HASH_BUCKETS = 10000
+
+
+def normalize_questions(questions):
+    """Blank, bracket, whitespace and slash normalization of the questions"""
+    # Changing ____ to <blank/> tags
+    questions = questions.str.replace(r"[_]{2,}", "<blank>", regex=True)
+    # Removing brackets
+    questions = questions.str.replace(r"[\)\(]", "", regex=True)
+    # Stripping whitespaces
+    questions = questions.str.strip()
+    # Replacing / to <slash/> tags
+    return questions.str.replace(r"\/", "<slash>", regex=True)
+
+
+def hash_split(rows, test_size, seed=SEED):
+    """
+    Boolean array of the rows in the test split, from a seeded hash of the
+    content of every row, equal rows always land in the same split
+    """
+    hashes = pd.util.hash_pandas_object(
+        rows, index=False, hash_key="{:016d}".format(seed)
+    )
+    return (hashes % HASH_BUCKETS < test_size * HASH_BUCKETS).to_numpy()
+
+
+def create_processed_folder():
+    if not os.path.exists(os.path.join(DATASET_FOLDER, PROCESSED_DATASET_FOLDER)):
+        os.mkdir(os.path.join(DATASET_FOLDER, PROCESSED_DATASET_FOLDER))
+
 
 class PreProcessDataset:
     """
     Class to preprocess dataset takes input location as input
-    otherwise will use configuration location
+    otherwise will use configuration location, with a chunksize the dataset
+    is streamed instead of loaded at once
     """
 
-    def __init__(self, location):
+    def __init__(self, location, chunksize=None):
         if location:
             self.dataset_location = location
         else:
             self.dataset_location = RAW_DATASET
 
-        self.dataset = pd.read_csv(self.dataset_location, delimiter="\t")
+        self.chunksize = chunksize
+        self.dataset = None
+        if chunksize is None:
+            self.dataset = pd.read_csv(self.dataset_location, delimiter="\t")
 
     def preprocess(self):
         """Preprocesses the dataset"""
-        # Changing ____ to <blank/> tags
-        self.dataset["Question"] = self.dataset["Question"].str.replace(
-            r"[_]{2,}", "<blank>"
-        )
-        # Removing brackets
-        self.dataset["Question"] = self.dataset["Question"].str.replace(r"[\)\(]", "")
-        # Stripping whitespaces
-        self.dataset["Question"] = self.dataset["Question"].apply(lambda x: x.strip())
-        # Replacing / to <slash/> tags
-        self.dataset["Question"] = self.dataset["Question"].str.replace(
-            r"\/", "<slash>"
-        )
+        if self.chunksize is not None:
+            return self.preprocess_stream()
+
+        self.dataset["Question"] = normalize_questions(self.dataset["Question"])
 
-        if not os.path.exists(os.path.join(DATASET_FOLDER, PROCESSED_DATASET_FOLDER)):
-            os.mkdir(os.path.join(DATASET_FOLDER, PROCESSED_DATASET_FOLDER))
+        create_processed_folder()
 
         # self.dataset["label"] = (
         #     " <Q_S> "
@@ -74,7 +108,7 @@ class PreProcessDataset:
         # )
 
         self.trainset, self.testset = train_test_split(
-            self.dataset, test_size=0.15, random_state=SEED
+            self.dataset, test_size=TEST_SPLIT, random_state=SEED
         )
 
         self.trainset.to_csv(PROCESSED_DATASET["train"], index=False, sep="\t")
@@ -86,6 +120,50 @@ class PreProcessDataset:
             )
         )
 
+    def preprocess_stream(self):
+        """
+        Normalize, split and append the dataset one chunk at a time, only a
+        chunk is held in memory
+        """
+        create_processed_folder()
+
+        counts = {"train": 0, "test": 0}
+        # Every cell is read as a string, a column inferred per chunk would
+        # hash the same row differently depending on its neighbours
+        chunks = pd.read_csv(
+            self.dataset_location,
+            delimiter="\t",
+            chunksize=self.chunksize,
+            dtype=str,
+            keep_default_na=False,
+        )
+        for index, chunk in enumerate(chunks):
+            chunk["Question"] = normalize_questions(chunk["Question"])
+            test = hash_split(chunk, TEST_SPLIT)
+
+            # The first chunk replaces the previous files and writes the header
+            for split, rows in (("train", chunk[~test]), ("test", chunk[test])):
+                rows.to_csv(
+                    PROCESSED_DATASET[split],
+                    index=False,
+                    sep="\t",
+                    mode="a" if index else "w",
+                    header=not index,
+                )
+                counts[split] += len(rows)
+
+            logger.debug(
+                "Processed {} train and {} test rows".format(
+                    counts["train"], counts["test"]
+                )
+            )
+
+        logger.debug(
+            "Saving the file preprocessed files to : {}".format(
+                PROCESSED_DATASET_FOLDER
+            )
+        )
+
 
 if __name__ == "__main__":
 
@@ -99,10 +177,25 @@ if __name__ == "__main__":
         default=None,
         help="Location of Dataset if left empty configuration will be used",
     )
+    parser.add_argument(
+        "--stream",
+        default=False,
+        action="store_true",
+        help="Read, normalize and write the dataset in chunks with a hash split",
+    )
+    parser.add_argument(
+        "-c",
+        "--chunksize",
+        default=PREPROCESS_CHUNK_SIZE,
+        help="Rows of every chunk with --stream",
+        type=int,
+    )
 
     args = parser.parse_args()
 
-    preprocessor = PreProcessDataset(args.location)
+    preprocessor = PreProcessDataset(
+        args.location, args.chunksize if args.stream else None
+    )
 
     preprocessor.preprocess()
 
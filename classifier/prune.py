@@ -0,0 +1,455 @@
+"""
+Structured pruning of the CNN classifiers run this file by
+
+```
+    >>> python prune.py --model-location trained/CNN1dClassifier
+    >>> python prune.py -loc trained/CNN1dExtraLayerClassifier --keep 0.25
+    >>> python prune.py -loc trained/CNN2dClassifier --filters 16 --criterion magnitude
+```
+The conv filters of CNN1dClassifier, CNN2dClassifier and
+CNN1dExtraLayerClassifier and the hidden units of CNN1dExtraLayerClassifier
+are ranked on the train split, by the mean activation they pass on times the
+norm of the weights reading it, or by the L1 norm of their own weights with
+--criterion magnitude. The lowest ranked ones are removed from the weights,
+the same number of filters from every width so the result is the classifier
+with a smaller n_filters and linear_hidden_dim. The pruned classifier is fine
+tuned for a few epochs and its best epoch is saved next to the original one,
+bundles as the bundle <model>.pruned and files written by torch.save as
+<model>.pruned.pt. The original, pruned and fine tuned classifiers are
+compared on the test split for accuracy, parameters, size and p50/p99 CPU
+latency.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from bundle import DATASETS, load_bundle, save_bundle
+from config.hyperparameters import (
+    BATCH_SIZE,
+    FREEZE_EMBEDDINGS,
+    LR,
+    PATIENCE,
+    PRUNE_CRITERION,
+    PRUNE_EPOCHS,
+    PRUNE_KEEP,
+    WEIGHT_DECAY,
+)
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    TRAINED_CLASSIFIER_FOLDER,
+    device,
+)
+from model import CNN1dExtraLayerClassifier, MultiTaskClassifier
+from quantize import cpu, report
+from train import fit
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+CRITERIA = ["activation", "magnitude"]
+
+
+def encoder_of(model):
+    """The CNN classifier itself or the shared encoder of a multi task model"""
+    return model.encoder if isinstance(model, MultiTaskClassifier) else model
+
+
+def readers(model):
+    """Linear layers reading the features of the encoder"""
+    heads = list(model.heads.values()) if isinstance(model, MultiTaskClassifier) else []
+    return [encoder_of(model).fc] + heads
+
+
+def reader_norms(layers):
+    """L2 norm of the weights reading every input of the layers"""
+    return torch.cat([layer.weight.data for layer in layers]).norm(dim=0)
+
+
+def conv_layers(encoder):
+    """The Conv1d or Conv2d layer of every filter width"""
+    if isinstance(encoder, CNN1dExtraLayerClassifier):
+        return [conv.convlayer for conv in encoder.convs]
+    return list(encoder.convs)
+
+
+def filter_count(encoder):
+    return conv_layers(encoder)[0].out_channels
+
+
+def magnitude_scores(model):
+    """L1 norm of the weights of every conv filter and hidden unit"""
+    encoder = encoder_of(model)
+    filter_scores = torch.cat(
+        [conv.weight.data.abs().flatten(1).sum(dim=1) for conv in conv_layers(encoder)]
+    )
+    if isinstance(encoder, CNN1dExtraLayerClassifier):
+        return filter_scores, encoder.hidden_layer.weight.data.abs().sum(dim=1)
+    return filter_scores, None
+
+
+def activation_scores(model, iterator):
+    """
+    Mean activation of every conv filter and hidden unit over the iterator
+    times the norm of the weights reading it
+    """
+    encoder = encoder_of(model)
+    extra_layer = isinstance(encoder, CNN1dExtraLayerClassifier)
+    filter_sums, hidden_sums, n_examples = 0, 0, 0
+
+    model.eval()
+    with torch.no_grad():
+        for batch in iterator:
+            text, text_lengths = batch.text
+            embedded = encoder.embedding(text)
+            features = encoder.features(embedded, text_lengths)
+
+            if extra_layer:
+                # Same conv outputs as features, averaged over the valid positions
+                conved = torch.relu(
+                    torch.cat(
+                        [conv(embedded.permute(1, 0, 2)) for conv in encoder.convs], -1
+                    )
+                )
+                mask = (
+                    torch.arange(conved.shape[1]).unsqueeze(0)
+                    < text_lengths.unsqueeze(1)
+                ).float()
+                filter_sums = filter_sums + (
+                    (conved * mask.unsqueeze(2)).sum(dim=1)
+                    / mask.sum(dim=1, keepdim=True)
+                ).sum(dim=0)
+                hidden_sums = hidden_sums + features.abs().sum(dim=0)
+            else:
+                filter_sums = filter_sums + features.sum(dim=0)
+            n_examples += text.shape[1]
+
+    if extra_layer:
+        return (
+            filter_sums / n_examples * reader_norms([encoder.hidden_layer]),
+            hidden_sums / n_examples * reader_norms(readers(model)),
+        )
+    return filter_sums / n_examples * reader_norms(readers(model)), None
+
+
+def kept_filters(scores, n_filters, n_kept):
+    """Indexes of the n_kept best filters of every width in their order"""
+    return torch.cat(
+        [
+            start + scores[start : start + n_filters].topk(n_kept)[1].sort()[0]
+            for start in range(0, len(scores), n_filters)
+        ]
+    )
+
+
+def pruned_linear(linear, rows=None, columns=None):
+    """Copy of a Linear layer with only the given outputs and inputs"""
+    weight, bias = linear.weight.data, linear.bias.data
+    if rows is not None:
+        weight, bias = weight[rows], bias[rows]
+    if columns is not None:
+        weight = weight[:, columns]
+
+    pruned = nn.Linear(weight.shape[1], weight.shape[0]).to(weight.device)
+    pruned.weight.data.copy_(weight)
+    pruned.bias.data.copy_(bias)
+    return pruned
+
+
+def pruned_conv(conv, rows):
+    """Copy of a Conv1d or Conv2d layer with only the given filters"""
+    pruned = type(conv)(
+        conv.in_channels, len(rows), conv.kernel_size, padding=conv.padding
+    ).to(conv.weight.device)
+    pruned.weight.data.copy_(conv.weight.data[rows])
+    pruned.bias.data.copy_(conv.bias.data[rows])
+    return pruned
+
+
+def prune(model, filter_scores, hidden_scores, n_filters, n_hidden):
+    """
+    Copy of the model keeping n_filters filters of every width and n_hidden
+    hidden units, the original model is left untouched
+    """
+    model = copy.deepcopy(model)
+    encoder = encoder_of(model)
+    original_filters = filter_count(encoder)
+    filters = kept_filters(filter_scores, original_filters, n_filters)
+
+    extra_layer = isinstance(encoder, CNN1dExtraLayerClassifier)
+    for index, conv in enumerate(conv_layers(encoder)):
+        width_filters = filters[index * n_filters : (index + 1) * n_filters]
+        pruned = pruned_conv(conv, width_filters - index * original_filters)
+        if extra_layer:
+            encoder.convs[index].convlayer = pruned
+        else:
+            encoder.convs[index] = pruned
+
+    if extra_layer:
+        hidden = hidden_scores.topk(n_hidden)[1].sort()[0]
+        encoder.hidden_layer = pruned_linear(encoder.hidden_layer, hidden, filters)
+        features = hidden
+    else:
+        features = filters
+
+    encoder.fc = pruned_linear(encoder.fc, columns=features)
+    if isinstance(model, MultiTaskClassifier):
+        for name, head in list(model.heads.items()):
+            model.heads[name] = pruned_linear(head, columns=features)
+
+    return model
+
+
+def parameter_count(model):
+    return sum(parameter.numel() for parameter in model.parameters())
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to prune the filters and hidden units of a CNN classifier"
+    )
+
+    parser.add_argument(
+        "-loc",
+        "--model-location",
+        default=os.path.join(TRAINED_CLASSIFIER_FOLDER, "CNN1dClassifier"),
+        help="Location of the trained model",
+    )
+    parser.add_argument(
+        "-t",
+        "--tag",
+        default="answeronly",
+        choices=["multi", "answeronly"],
+        help="Dataset type the model was trained on, bundles know their own",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Location of the pruned model, defaults to <model>.pruned(.pt)",
+    )
+    parser.add_argument(
+        "-k",
+        "--keep",
+        default=PRUNE_KEEP,
+        help="Share of the filters of every width and of the hidden units kept",
+        type=float,
+    )
+    parser.add_argument(
+        "-f",
+        "--filters",
+        default=None,
+        help="Filters kept of every width, overrides --keep",
+        type=int,
+    )
+    parser.add_argument(
+        "-hu",
+        "--hidden-units",
+        default=None,
+        help="Hidden units of CNN1dExtraLayerClassifier kept, overrides --keep",
+        type=int,
+    )
+    parser.add_argument(
+        "-c",
+        "--criterion",
+        default=PRUNE_CRITERION,
+        choices=CRITERIA,
+        help="Rank by activation on the train split or by weight magnitude",
+    )
+    parser.add_argument(
+        "--epochs",
+        default=PRUNE_EPOCHS,
+        help="Fine tuning epochs of the pruned model, 0 skips fine tuning",
+        type=int,
+    )
+    parser.add_argument(
+        "-lr",
+        "--learning-rate",
+        default=LR,
+        help="Learning rate of the fine tuning",
+        type=float,
+    )
+    parser.add_argument(
+        "-fe",
+        "--freeze-embeddings",
+        default=FREEZE_EMBEDDINGS,
+        help="Keep the embeddings frozen while fine tuning",
+        type=int,
+    )
+    parser.add_argument(
+        "-batch",
+        "--batch_size",
+        default=BATCH_SIZE,
+        help="Batch size of the ranking, fine tuning and accuracy evaluation",
+        type=int,
+    )
+    parser.add_argument(
+        "-lb",
+        "--latency-batch-size",
+        default=1,
+        help="Batch size of the latency measurement",
+        type=int,
+    )
+    parser.add_argument(
+        "-ln",
+        "--latency-batches",
+        default=500,
+        help="Number of batches timed for the latency percentiles, at least 1",
+        type=int,
+    )
+    parser.add_argument(
+        "-r", "--report", default=None, help="Also write the report to a json file"
+    )
+
+    args = parser.parse_args()
+
+    if args.latency_batches < 1:
+        parser.error("--latency-batches has to be at least 1")
+
+    location = args.model_location.rstrip(os.sep)
+    meta = None
+    if os.path.isdir(location):
+        model, bundle_dataset, meta = load_bundle(location, cpu)
+        args.tag = meta["dataset"]
+    else:
+        model = torch.load(location, map_location=cpu)
+        model.eval()
+
+    encoder = encoder_of(model)
+    classifier_type = encoder.__class__.__name__
+    if not hasattr(encoder, "convs"):
+        raise SystemExit("{} has no conv filters to prune".format(classifier_type))
+
+    dataset_class = DATASETS[args.tag]
+    dataset = dataset_class()
+    dataset.load_compiled(dataset_class.compile_if_needed())
+
+    n_filters = args.filters or max(1, round(filter_count(encoder) * args.keep))
+    n_hidden = None
+    if isinstance(encoder, CNN1dExtraLayerClassifier):
+        n_hidden = args.hidden_units or max(
+            1, round(encoder.hidden_layer.out_features * args.keep)
+        )
+
+    if args.criterion == "magnitude":
+        filter_scores, hidden_scores = magnitude_scores(model)
+    else:
+        filter_scores, hidden_scores = activation_scores(
+            model, dataset.iterator("train", args.batch_size, False, device=cpu)
+        )
+
+    pruned_model = prune(model, filter_scores, hidden_scores, n_filters, n_hidden)
+    logger.info(
+        "Kept {} filters of every width{}, {:,} of {:,} parameters".format(
+            n_filters,
+            " and {} hidden units".format(n_hidden) if n_hidden else "",
+            parameter_count(pruned_model),
+            parameter_count(model),
+        )
+    )
+
+    candidates = [("original", model), ("pruned", pruned_model)]
+    if args.epochs > 0:
+        finetuned_model = copy.deepcopy(pruned_model).to(device)
+        if isinstance(finetuned_model.embedding, nn.Embedding):
+            finetuned_model.embedding.weight.requires_grad = not args.freeze_embeddings
+
+        dataset.train_iterator = dataset.iterator("train", args.batch_size, True)
+        dataset.test_iterator = dataset.iterator("test", args.batch_size, False)
+
+        best_state = {}
+        best = fit(
+            finetuned_model,
+            dataset,
+            classifier_type,
+            args.epochs,
+            args.learning_rate,
+            WEIGHT_DECAY,
+            on_improvement=lambda model: best_state.update(
+                copy.deepcopy(model.state_dict())
+            ),
+            verbose=False,
+            patience=PATIENCE,
+        )
+        finetuned_model.load_state_dict(best_state)
+        finetuned_model = finetuned_model.to(cpu).eval()
+        logger.info("Fine tuned, best epoch {}".format(best["epoch"]))
+        candidates.append(("finetuned", finetuned_model))
+
+    final_model = candidates[-1][1]
+    if meta:
+        output = args.output or "{}.pruned".format(location)
+        hyperparameters = dict(meta["hyperparameters"], n_filters=n_filters)
+        if n_hidden:
+            hyperparameters["linear_hidden_dim"] = n_hidden
+        save_bundle(
+            output,
+            final_model,
+            meta["classifier"],
+            hyperparameters,
+            bundle_dataset,
+            meta["dataset"],
+        )
+    else:
+        output = args.output or "{}.pruned.pt".format(os.path.splitext(location)[0])
+        torch.save(final_model, output)
+    logger.info("Saved pruned model to {}".format(output))
+
+    results = {}
+    for name, candidate in candidates:
+        results[name] = report(
+            candidate,
+            dataset,
+            args.batch_size,
+            args.latency_batch_size,
+            args.latency_batches,
+        )
+        results[name]["parameters"] = parameter_count(candidate)
+    final_name = candidates[-1][0]
+    results["delta"] = {
+        key: results[final_name][key] - results["original"][key]
+        for key in results["original"]
+    }
+
+    print(
+        "{:<11}{:>10}{:>10}{:>12}{:>10}{:>10}{:>10}".format(
+            "", "Acc", "Macro F1", "Params", "Size MB", "p50 ms", "p99 ms"
+        )
+    )
+    for name, result in results.items():
+        print(
+            "{:<11}{:>10.4f}{:>10.4f}{:>12,}{:>10.2f}{:>10.3f}{:>10.3f}".format(
+                name,
+                result["accuracy"],
+                result["macro_f1"],
+                result["parameters"],
+                result["size_mb"],
+                result["p50_ms"],
+                result["p99_ms"],
+            )
+        )
+
+    if args.report:
+        results["pruning"] = {
+            "criterion": args.criterion,
+            "n_filters": n_filters,
+            "linear_hidden_dim": n_hidden,
+            "epochs": args.epochs,
+        }
+        with open(args.report, "w") as report_file:
+            json.dump(results, report_file, indent=2)
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
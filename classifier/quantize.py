@@ -0,0 +1,254 @@
+"""
+Post training dynamic int8 quantization of a trained classifier run this file by
+
+```
+    >>> python quantize.py --model-location trained/RNNHiddenClassifier
+    >>> python quantize.py -loc trained/RNNFieldClassifer --embeddings
+```
+The LSTM and Linear layers get int8 weights and dynamically quantized
+activations, --embeddings also stores the embedding rows in uint8. The
+quantized model is saved next to the float one and both are compared on the
+test split for accuracy, serialized size and p50/p99 CPU latency. Convolutions
+have no dynamic quantized version, only the Linear layers of the CNN
+classifiers are quantized.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.quantization import (
+    default_dynamic_qconfig,
+    float_qparams_weight_only_qconfig,
+    quantize_dynamic,
+)
+
+from config.hyperparameters import BATCH_SIZE
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    TRAINED_CLASSIFIER_FOLDER,
+    TRAINED_CLASSIFIER_DEFAULT,
+)
+from bundle import load_bundle
+from datasetloader import GrammarDasetAnswerTag, GrammarDasetMultiTag
+from helperfunctions import (
+    evaluate,
+    evaluate_multitask_model,
+    evaluate_tag_model,
+    get_batch_data,
+    get_batch_data_and_tag,
+)
+from model import MultiTaskClassifier, RNNFieldClassifer
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+# Quantized kernels only run on the CPU
+cpu = torch.device("cpu")
+# Batches run before the latency is measured
+WARMUP_BATCHES = 10
+
+
+def quantize(model, embeddings=False):
+    """Dynamic int8 copy of the model, the float model is left untouched"""
+    qconfig_spec = {
+        nn.LSTM: default_dynamic_qconfig,
+        nn.Linear: default_dynamic_qconfig,
+    }
+    if embeddings:
+        qconfig_spec[nn.Embedding] = float_qparams_weight_only_qconfig
+
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+
+def model_size(model):
+    """Size in bytes of the serialized weights"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def forward(model, batch):
+    if isinstance(model, RNNFieldClassifer) or getattr(model, "use_tags", False):
+        text, text_lengths, tag = get_batch_data_and_tag(batch)
+        return model(text, text_lengths, tag)
+
+    text, text_lengths = get_batch_data(batch)
+    return model(text, text_lengths)
+
+
+def test_metrics(model, dataset, batch_size):
+    iterator = dataset.iterator("test", batch_size, train=False, device=cpu)
+    criterion = nn.CrossEntropyLoss()
+    if isinstance(model, MultiTaskClassifier):
+        return evaluate_multitask_model(model, iterator, criterion)
+    if isinstance(model, RNNFieldClassifer):
+        return evaluate_tag_model(model, iterator, criterion)
+    return evaluate(model, iterator, criterion)
+
+
+def latency(model, dataset, batch_size, n_batches):
+    """p50 and p99 milliseconds of a forward pass over test batches"""
+    if n_batches < 1:
+        raise ValueError("No latency batches to time, got {}".format(n_batches))
+
+    # The test split is repeated when it has fewer batches than the run needs
+    batches = []
+    while len(batches) < WARMUP_BATCHES + n_batches:
+        batches.extend(dataset.iterator("test", batch_size, train=False, device=cpu))
+
+    timings = []
+    with torch.no_grad():
+        for index, batch in enumerate(batches[: WARMUP_BATCHES + n_batches]):
+            start_time = time.perf_counter()
+            forward(model, batch)
+            if index >= WARMUP_BATCHES:
+                timings.append(1000 * (time.perf_counter() - start_time))
+
+    return float(np.percentile(timings, 50)), float(np.percentile(timings, 99))
+
+
+def report(model, dataset, batch_size, latency_batch_size, latency_batches):
+    metrics = test_metrics(model, dataset, batch_size)
+    p50, p99 = latency(model, dataset, latency_batch_size, latency_batches)
+    return {
+        "accuracy": metrics["accuracy"],
+        "macro_f1": metrics["macro_f1"],
+        "size_mb": model_size(model) / 2 ** 20,
+        "p50_ms": p50,
+        "p99_ms": p99,
+    }
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to quantize a trained model to int8"
+    )
+
+    parser.add_argument(
+        "-loc",
+        "--model-location",
+        default=os.path.join(TRAINED_CLASSIFIER_FOLDER, TRAINED_CLASSIFIER_DEFAULT),
+        help="Location of the trained model",
+    )
+    parser.add_argument(
+        "-t",
+        "--tag",
+        default="answeronly",
+        choices=["multi", "answeronly"],
+        help="Dataset type the model was trained on, bundles know their own",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Location of the quantized model, defaults to <model>.int8.pt",
+    )
+    parser.add_argument(
+        "--embeddings",
+        default=False,
+        action="store_true",
+        help="Quantize the embedding layers too",
+    )
+    parser.add_argument(
+        "-batch",
+        "--batch_size",
+        default=BATCH_SIZE,
+        help="Batch size of the accuracy evaluation",
+        type=int,
+    )
+    parser.add_argument(
+        "-lb",
+        "--latency-batch-size",
+        default=1,
+        help="Batch size of the latency measurement",
+        type=int,
+    )
+    parser.add_argument(
+        "-ln",
+        "--latency-batches",
+        default=500,
+        help="Number of batches timed for the latency percentiles, at least 1",
+        type=int,
+    )
+    parser.add_argument(
+        "-r", "--report", default=None, help="Also write the report to a json file"
+    )
+
+    args = parser.parse_args()
+
+    if args.latency_batches < 1:
+        parser.error("--latency-batches has to be at least 1")
+
+    if os.path.isdir(args.model_location):
+        model, _, meta = load_bundle(args.model_location, cpu)
+        args.tag = meta["dataset"]
+    else:
+        model = torch.load(args.model_location, map_location=cpu)
+        model.eval()
+
+    if args.tag == "multi":
+        dataset_class = GrammarDasetMultiTag
+    else:
+        dataset_class = GrammarDasetAnswerTag
+
+    dataset = dataset_class()
+    dataset.load_compiled(dataset_class.compile_if_needed())
+
+    quantized_model = quantize(model, args.embeddings)
+
+    output = args.output or "{}.int8.pt".format(
+        os.path.splitext(args.model_location.rstrip(os.sep))[0]
+    )
+    torch.save(quantized_model, output)
+    logger.info("Saved quantized model to {}".format(output))
+
+    results = {
+        name: report(
+            candidate,
+            dataset,
+            args.batch_size,
+            args.latency_batch_size,
+            args.latency_batches,
+        )
+        for name, candidate in (("float", model), ("int8", quantized_model))
+    }
+    results["delta"] = {
+        key: results["int8"][key] - results["float"][key] for key in results["float"]
+    }
+
+    print(
+        "{:<8}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+            "", "Acc", "Macro F1", "Size MB", "p50 ms", "p99 ms"
+        )
+    )
+    for name, result in results.items():
+        print(
+            "{:<8}{:>10.4f}{:>10.4f}{:>10.2f}{:>10.3f}{:>10.3f}".format(
+                name,
+                result["accuracy"],
+                result["macro_f1"],
+                result["size_mb"],
+                result["p50_ms"],
+                result["p99_ms"],
+            )
+        )
+
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(results, report_file, indent=2)
+
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
@@ -0,0 +1,315 @@
+"""
+HTTP inference server for the trained classifiers run this file by
+
+```
+    >>> python server.py --model-location trained/RNNHiddenClassifier
+    >>> curl -d '{"answer": "She brought some chocolates."}' localhost:8000/predict
+```
+Concurrent requests are coalesced into micro batches bounded by
+--max-batch-size and --max-wait-ms, every micro batch is padded once and run
+in a single forward pass. GET /metrics returns the queue depth and the batch
+size histograms.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    SERVER_HOST,
+    SERVER_MAX_BATCH_SIZE,
+    SERVER_MAX_WAIT_MS,
+    SERVER_PORT,
+    TRAINED_CLASSIFIER_FOLDER,
+    TRAINED_CLASSIFIER_DEFAULT,
+)
+from model import COMBINE_METHODS
+from predict import INPUT_COLUMNS, Predictor
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Server Error"}
+
+
+class DynamicBatcher:
+    """
+    Collects queued records until max_batch_size of them are waiting or the
+    first one waited max_wait seconds, then predicts them in one call on a
+    single worker thread so the event loop keeps accepting requests
+    """
+
+    def __init__(self, predictor, max_batch_size, max_wait):
+        self.predictor = predictor
+        self.predictor.batch_size = max(self.predictor.batch_size, max_batch_size)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.requests = 0
+        self.batches = 0
+        self.batch_sizes = collections.Counter()
+        self.queue_depths = collections.Counter()
+        self.forward_time = 0.0
+
+    async def predict(self, record):
+        """Queue a record and wait for its prediction"""
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((record, future))
+        return await future
+
+    async def next_batch(self):
+        loop = asyncio.get_event_loop()
+        items = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(items) < self.max_batch_size:
+            if not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                continue
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return items
+
+    async def run(self):
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_event_loop()
+
+        while True:
+            items = await self.next_batch()
+            self.queue_depths[self.queue.qsize()] += 1
+            self.batch_sizes[len(items)] += 1
+            self.batches += 1
+            self.requests += len(items)
+
+            records = [record for record, _ in items]
+            start_time = time.time()
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, lambda: list(self.predictor.predict_tasks(records))
+                )
+            except Exception as error:
+                logger.exception("Prediction of a batch failed")
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            finally:
+                self.forward_time += time.time() - start_time
+
+            for (_, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def metrics(self):
+        return {
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / max(self.batches, 1),
+            "mean_forward_ms": 1000 * self.forward_time / max(self.batches, 1),
+            "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+            "queue_depth_histogram": dict(sorted(self.queue_depths.items())),
+        }
+
+
+class InferenceServer:
+    """Minimal HTTP/1.1 server with keep alive in front of a DynamicBatcher"""
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.columns = [
+            INPUT_COLUMNS[name] for name in batcher.predictor.dataset.text_fields
+        ]
+
+    async def predict(self, body):
+        payload = json.loads(body.decode("utf8"))
+        records = payload if isinstance(payload, list) else [payload]
+        # A bad record would fail the whole micro batch it is queued with
+        for record in records:
+            if not isinstance(record, dict):
+                raise ValueError("Records must be objects, got {}".format(record))
+            missing = [column for column in self.columns if column not in record]
+            if missing:
+                raise ValueError("Missing columns {}".format(missing))
+            invalid = [
+                column for column in self.columns if not isinstance(record[column], str)
+            ]
+            if invalid:
+                raise ValueError("Columns {} must be strings".format(invalid))
+
+        results = await asyncio.gather(
+            *(self.batcher.predict(record) for record in records)
+        )
+        predictor = self.batcher.predictor
+        responses = []
+        for result in results:
+            response = None
+            for name in predictor.tasks:
+                label, confidence, probabilities = result[name]
+                task_response = {
+                    "prediction": label,
+                    "confidence": confidence,
+                    "probabilities": dict(
+                        zip(predictor.task_labels[name], probabilities)
+                    ),
+                }
+                # Labels after the main one are nested under their name
+                if response is None:
+                    response = task_response
+                else:
+                    response[name] = task_response
+            responses.append(response)
+        return responses if isinstance(payload, list) else responses[0]
+
+    async def route(self, method, path, body):
+        if method == "POST" and path == "/predict":
+            try:
+                return 200, await self.predict(body)
+            except (ValueError, TypeError) as error:
+                return 400, {"error": str(error)}
+        if method == "GET" and path == "/metrics":
+            return 200, self.batcher.metrics()
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        return 404, {"error": "Unknown route {} {}".format(method, path)}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                try:
+                    status, payload = await self.route(method, path, body)
+                except Exception as error:
+                    logger.exception("Request failed")
+                    status, payload = 500, {"error": str(error)}
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                content = json.dumps(payload).encode("utf8")
+                writer.write(
+                    "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n"
+                    "Content-Length: {}\r\nConnection: {}\r\n\r\n".format(
+                        status,
+                        HTTP_STATUS[status],
+                        len(content),
+                        "keep-alive" if keep_alive else "close",
+                    ).encode("latin1")
+                    + content
+                )
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        batcher_task = asyncio.ensure_future(self.batcher.run())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info("Serving on http://{}:{}".format(host, port))
+        try:
+            await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Utility to serve a trained model over HTTP"
+    )
+
+    parser.add_argument(
+        "-loc",
+        "--model-location",
+        default=[os.path.join(TRAINED_CLASSIFIER_FOLDER, TRAINED_CLASSIFIER_DEFAULT)],
+        nargs="+",
+        help="Location of the trained model, several are served as an ensemble",
+    )
+    parser.add_argument(
+        "-t",
+        "--tag",
+        default="answeronly",
+        choices=["multi", "answeronly"],
+        help="Dataset type the model was trained on, bundles know their own",
+    )
+    parser.add_argument("--host", default=SERVER_HOST, help="Host to bind")
+    parser.add_argument(
+        "-p", "--port", default=SERVER_PORT, help="Port to bind", type=int
+    )
+    parser.add_argument(
+        "-mb",
+        "--max-batch-size",
+        default=SERVER_MAX_BATCH_SIZE,
+        help="Maximum number of requests in a forward pass",
+        type=int,
+    )
+    parser.add_argument(
+        "-mw",
+        "--max-wait-ms",
+        default=SERVER_MAX_WAIT_MS,
+        help="Maximum time a request waits for its batch to fill",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--combine",
+        default="mean",
+        choices=COMBINE_METHODS,
+        help="How an ensemble combines its members, mean probabilities or votes",
+    )
+    parser.add_argument(
+        "-et",
+        "--ensemble-threads",
+        default=0,
+        help="Ensemble members run at once, 0 runs them in turn",
+        type=int,
+    )
+
+    args = parser.parse_args()
+
+    predictor = Predictor.from_trained(
+        args.model_location,
+        args.tag,
+        args.max_batch_size,
+        args.combine,
+        args.ensemble_threads,
+    )
+    batcher = DynamicBatcher(predictor, args.max_batch_size, args.max_wait_ms / 1000)
+
+    try:
+        asyncio.run(InferenceServer(batcher).serve(args.host, args.port))
+    finally:
+        predictor.close()
@@ -0,0 +1,303 @@
+"""
+Parallel hyperparameter sweep over the classifiers run this file by
+
+```
+    >>> python sweep.py --spec sweep.json --workers 4
+```
+The spec is a json file with a grid or random search over the arguments of
+train.py
+
+```
+    {
+        "method": "random",
+        "trials": 20,
+        "tag": "answeronly",
+        "epochs": 5,
+        "parameters": {
+            "model": ["RNNHiddenClassifier", "CNN1dClassifier"],
+            "hidden_dim": [64, 128, 256],
+            "dropout": {"low": 0.2, "high": 0.7},
+            "learning_rate": {"low": 0.0001, "high": 0.01, "log": true}
+        }
+    }
+```
+Grid search takes the product of lists, random search samples lists
+uniformly and draws ranges from a uniform or log uniform distribution. The
+dataset is compiled once before the workers start and every worker memory
+maps the same compiled arrays, so the pages are shared between all of them.
+Every trial writes a row to results.tsv in the sweep folder as soon as it
+finishes.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+import helperfunctions
+from bundle import DATASETS, save_bundle
+from config.hyperparameters import EPOCHS, TRIAL_DEFAULTS, TRIAL_HYPERPARAMETERS
+from config.root import (
+    LOGGING_FORMAT,
+    LOGGING_LEVEL,
+    SEED,
+    SWEEP_FOLDER,
+    device,
+    seed_all,
+)
+from train import fit, initialize_new_model
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+METRIC_COLUMNS = ["epoch", "loss", "accuracy", "macro_f1", "stop_cause"]
+
+# Dataset of the worker process, loaded once by init_worker
+worker_dataset = None
+
+
+def sample(values, generator):
+    """Draw a value of a parameter for random search"""
+    if isinstance(values, list):
+        return generator.choice(values)
+    if values.get("log"):
+        return math.exp(
+            generator.uniform(math.log(values["low"]), math.log(values["high"]))
+        )
+    return generator.uniform(values["low"], values["high"])
+
+
+def trials_of(spec):
+    """List of trial configurations of a sweep spec"""
+    parameters = spec["parameters"]
+    # Checked up front, a misspelled name would only fail once its trial ran
+    unknown = [name for name in parameters if name not in TRIAL_DEFAULTS]
+    if unknown:
+        raise ValueError(
+            "Unknown parameters {} in the spec, expected some of {}".format(
+                unknown, list(TRIAL_DEFAULTS)
+            )
+        )
+
+    if spec.get("method", "grid") == "grid":
+        names = list(parameters)
+        # A bare value would be iterated, a string letter by letter
+        for name in names:
+            if not isinstance(parameters[name], list):
+                raise ValueError(
+                    "Grid search needs a list of values for {}, got {!r}".format(
+                        name, parameters[name]
+                    )
+                )
+        combinations = itertools.product(*(parameters[name] for name in names))
+        configs = [dict(zip(names, values)) for values in combinations]
+    else:
+        generator = random.Random(spec.get("seed", SEED))
+        configs = [
+            {name: sample(values, generator) for name, values in parameters.items()}
+            for _ in range(spec["trials"])
+        ]
+
+    return [dict(TRIAL_DEFAULTS, **config) for config in configs]
+
+
+def init_worker(tag, threads):
+    """Split the cores between the workers and memory map the dataset once"""
+    global worker_dataset
+
+    torch.set_num_threads(threads)
+    helperfunctions.PROGRESS_BAR = False
+
+    dataset_class = DATASETS[tag]
+    worker_dataset = dataset_class()
+    worker_dataset.load_compiled(dataset_class.compile_if_needed())
+
+
+def run_trial(trial, config, tag, epochs, bundle_location):
+    """Train one configuration and return its row of the results table"""
+    start_time = time.time()
+    seed_all(config["seed"])
+
+    dataset = worker_dataset
+    dataset.train_iterator = dataset.iterator("train", config["batch_size"], True)
+    dataset.test_iterator = dataset.iterator("test", config["batch_size"], False)
+
+    hyperparameters = {name: config[name] for name in TRIAL_HYPERPARAMETERS}
+    model = initialize_new_model(
+        config["model"],
+        dataset,
+        hyperparameters,
+        config["freeze_embeddings"],
+        config["sparse_embeddings"],
+    ).to(device)
+
+    on_improvement = None
+    if bundle_location is not None:
+        on_improvement = lambda model: save_bundle(
+            os.path.join(bundle_location, "trial-{:03}".format(trial)),
+            model,
+            config["model"],
+            hyperparameters,
+            dataset,
+            tag,
+        )
+
+    best = fit(
+        model,
+        dataset,
+        config["model"],
+        epochs,
+        config["learning_rate"],
+        config["l2_regularization"],
+        on_improvement=on_improvement,
+        verbose=False,
+        patience=config["patience"],
+    )
+
+    return dict(
+        {"trial": trial},
+        **config,
+        **{column: best[column] for column in METRIC_COLUMNS},
+        seconds=time.time() - start_time,
+    )
+
+
+def run_sweep(spec, workers, threads, location, save_bundles):
+    """Fan the trials of the spec out over a process pool"""
+    tag = spec.get("tag", "answeronly")
+    epochs = spec.get("epochs", EPOCHS)
+    trials = trials_of(spec)
+
+    # Compile once in the parent so the workers only memory map the result
+    DATASETS[tag].compile_if_needed()
+
+    if not os.path.exists(location):
+        os.makedirs(location)
+    bundle_location = os.path.join(location, "bundles") if save_bundles else None
+
+    logger.info(
+        "Running {} trials on {} workers with {} threads each".format(
+            len(trials), workers, threads
+        )
+    )
+
+    rows = []
+    columns = ["trial"] + list(TRIAL_DEFAULTS) + METRIC_COLUMNS + ["seconds"]
+    with open(
+        os.path.join(location, "results.tsv"), "w", newline=""
+    ) as results_file, ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(tag, threads),
+    ) as executor:
+        writer = csv.DictWriter(results_file, fieldnames=columns, delimiter="\t")
+        writer.writeheader()
+
+        futures = {
+            executor.submit(run_trial, trial, config, tag, epochs, bundle_location): (
+                trial
+            )
+            for trial, config in enumerate(trials)
+        }
+        for future in as_completed(futures):
+            try:
+                row = future.result()
+            except Exception:
+                logger.exception("Trial {} failed".format(futures[future]))
+                continue
+
+            writer.writerow(row)
+            results_file.flush()
+            rows.append(row)
+            logger.info(
+                "Trial {} finished: loss {:.4f} accuracy {:.4f} macro F1 {:.4f}".format(
+                    row["trial"], row["loss"], row["accuracy"], row["macro_f1"]
+                )
+            )
+
+    return sorted(rows, key=lambda row: row["loss"])
+
+
+if __name__ == "__main__":
+
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        description="Utility to run a parallel hyperparameter sweep"
+    )
+
+    parser.add_argument(
+        "-s", "--spec", required=True, help="Json file with the sweep spec"
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=max(1, os.cpu_count() // 2),
+        help="Number of trials trained at once",
+        type=int,
+    )
+    parser.add_argument(
+        "-th",
+        "--threads",
+        default=None,
+        help="Torch threads of every worker, defaults to the cores split evenly",
+        type=int,
+    )
+    parser.add_argument(
+        "-o",
+        "--output-folder",
+        default=None,
+        help="Folder of the results, defaults to sweeps/<spec name>",
+    )
+    parser.add_argument(
+        "--save-bundles",
+        default=False,
+        action="store_true",
+        help="Save the best epoch of every trial as a bundle",
+    )
+
+    args = parser.parse_args()
+
+    with open(args.spec) as spec_file:
+        spec = json.load(spec_file)
+
+    threads = args.threads or max(1, os.cpu_count() // args.workers)
+    location = args.output_folder or os.path.join(
+        SWEEP_FOLDER, os.path.splitext(os.path.basename(args.spec))[0]
+    )
+
+    rows = run_sweep(spec, args.workers, threads, location, args.save_bundles)
+
+    swept = list(spec["parameters"])
+    print(
+        "\t".join(["trial"] + swept + ["epoch", "loss", "accuracy", "macro_f1"])
+    )
+    for row in rows:
+        print(
+            "\t".join(
+                [str(row["trial"])]
+                + [str(row[name]) for name in swept]
+                + [
+                    str(row["epoch"]),
+                    "{:.4f}".format(row["loss"]),
+                    "{:.4f}".format(row["accuracy"]),
+                    "{:.4f}".format(row["macro_f1"]),
+                ]
+            )
+        )
+
+    logger.info("Results written to {}".format(os.path.join(location, "results.tsv")))
+    logger.debug(
+        "Utility Finished Execution in: {:.4f}s".format(time.time() - start_time)
+    )
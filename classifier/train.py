@@ -8,8 +8,6 @@ import time
 
 import torch
 import torch.nn as nn
-import torch.optim as optim
-from tqdm.auto import tqdm
 
 from config.hyperparameters import (
     BATCH_SIZE,
@@ -19,33 +17,43 @@ from config.hyperparameters import (
     EPOCHS,
     FREEZE_EMBEDDINGS,
     HIDDEN_DIM,
+    LABEL_WEIGHTS,
+    LABELS,
     LR,
     N_LAYERS,
+    PATIENCE,
+    SPARSE_EMBEDDINGS,
     WEIGHT_DECAY,
     CNN_N_FILTER,
     CNN_FILTER_SIZES,
     LINEAR_HIDDEN_DIM,
+    TRIAL_DEFAULTS,
 )
 from config.root import (
+    CROSSVALIDATION_FOLDER,
     LOGGING_FORMAT,
     LOGGING_LEVEL,
     TRAINED_CLASSIFIER_FOLDER,
-    TRAINED_CLASSIFIER_RNNHIDDEN,
     device,
     seed_all,
     SEED,
 )
+from bundle import load_bundle, save_bundle
+from cpuprofile import apply_profile
 from datasetloader import GrammarDasetMultiTag, GrammarDasetAnswerTag
-from helperfunctions import evaluate, train, train_tag_model, evaluate_tag_model
-from model import (
-    RNNHiddenClassifier,
-    RNNMaxpoolClassifier,
-    CNN2dClassifier,
-    CNN1dClassifier,
-    RNNFieldClassifer,
-    CNN1dExtraLayerClassifier,
+from helperfunctions import (
+    evaluate,
+    evaluate_multitask_model,
+    evaluate_tag_model,
+    train,
+    train_multitask_model,
+    train_tag_model,
 )
-from utility import categorical_accuracy, epoch_time
+from model import MultiTaskClassifier
+from modelbuilder import build_model
+from sparseoptimizer import build_optimizer
+from trainingcontrol import TrainingControl
+from utility import epoch_time
 
 # Initialize logger for this file
 logger = logging.getLogger(__name__)
@@ -57,105 +65,39 @@ def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
 
 
+def set_embedding_training(model, freeze_embeddings, sparse_embeddings):
+    """
+    Freeze the embedding table and pick its gradients, freeze_embeddings None
+    keeps its current state. Tables other than nn.Embedding, such as
+    PQEmbedding, have no weight to train and are left alone
+    """
+    if not isinstance(model.embedding, nn.Embedding):
+        return
+
+    if freeze_embeddings is not None:
+        model.embedding.weight.requires_grad = not freeze_embeddings
+    model.embedding.sparse = bool(sparse_embeddings)
+
+
 def initialize_new_model(
     classifier_type,
     dataset,
-    embedding_dim,
-    hidden_dim,
-    n_layers,
-    bidirectional,
-    dropout,
+    hyperparameters,
     freeze_embeddings,
-    dataset_tag,
-    linear_hidden_dim,
+    sparse_embeddings=SPARSE_EMBEDDINGS,
 ):
     """Method to initialise new model, takes in dataset object and hyperparameters as parameter"""
     logger.debug("Initializing Model")
-    if dataset_tag == "multi":
-        VOCAB_SIZE = len(dataset.question.vocab)
-        PAD_IDX = dataset.question.vocab.stoi[dataset.question.pad_token]
-        pretrained_embeddings = dataset.question.vocab.vectors
-        UNK_IDX = dataset.question.vocab.stoi[dataset.question.unk_token]
-    else:
-        VOCAB_SIZE = len(dataset.text.vocab)
-        PAD_IDX = dataset.text.vocab.stoi[dataset.text.pad_token]
-        pretrained_embeddings = dataset.text.vocab.vectors
-        UNK_IDX = dataset.text.vocab.stoi[dataset.text.unk_token]
-
-    OUTPUT_LAYERS = len(dataset.label.vocab)
-
-    if classifier_type == "RNNHiddenClassifier":
-
-        model = RNNHiddenClassifier(
-            VOCAB_SIZE,
-            embedding_dim,
-            hidden_dim,
-            OUTPUT_LAYERS,
-            n_layers,
-            bidirectional,
-            dropout,
-            PAD_IDX,
-        )
 
-    elif classifier_type == "RNNMaxpoolClassifier":
-        model = RNNMaxpoolClassifier(
-            VOCAB_SIZE,
-            embedding_dim,
-            hidden_dim,
-            OUTPUT_LAYERS,
-            n_layers,
-            bidirectional,
-            dropout,
-            PAD_IDX,
-        )
-    elif classifier_type == "CNN2dClassifier":
-        model = CNN2dClassifier(
-            VOCAB_SIZE,
-            embedding_dim,
-            CNN_N_FILTER,
-            CNN_FILTER_SIZES,
-            OUTPUT_LAYERS,
-            dropout,
-            PAD_IDX,
-        )
-    elif classifier_type == "CNN1dClassifier":
-        model = CNN1dClassifier(
-            VOCAB_SIZE,
-            embedding_dim,
-            CNN_N_FILTER,
-            CNN_FILTER_SIZES,
-            OUTPUT_LAYERS,
-            dropout,
-            PAD_IDX,
-        )
-    elif classifier_type == "RNNFieldClassifer":
-        model = RNNFieldClassifer(
-            VOCAB_SIZE,
-            embedding_dim,
-            hidden_dim,
-            OUTPUT_LAYERS,
-            n_layers,
-            bidirectional,
-            dropout,
-            PAD_IDX,
-            dataset.tags,
-        )
-    elif classifier_type == "CNN1dExtraLayerClassifier":
-        model = CNN1dExtraLayerClassifier(
-            VOCAB_SIZE,
-            embedding_dim,
-            CNN_N_FILTER,
-            CNN_FILTER_SIZES,
-            linear_hidden_dim,
-            OUTPUT_LAYERS,
-            dropout,
-            PAD_IDX,
-        )
-    else:
-        raise TypeError("Invalid Classifier selected")
+    text_field = dataset.text_field
+    PAD_IDX = text_field.vocab.stoi[text_field.pad_token]
+    UNK_IDX = text_field.vocab.stoi[text_field.unk_token]
+    pretrained_embeddings = text_field.vocab.vectors
+    embedding_dim = hyperparameters["embedding_dim"]
+
+    model = build_model(classifier_type, dataset, hyperparameters)
 
-    if freeze_embeddings:
-        model.embedding.weight.requires_grad = False
+    set_embedding_training(model, freeze_embeddings, sparse_embeddings)
 
     logger.debug(
         "Freeze Embeddings Value {}: {}".format(
@@ -181,6 +123,161 @@ def initialize_new_model(
     return model
 
 
+def epoch_functions(model, classifier_type):
+    """Train and evaluate functions of one epoch of the model"""
+    if isinstance(model, MultiTaskClassifier):
+        return train_multitask_model, evaluate_multitask_model
+    if classifier_type == "RNNFieldClassifer":
+        return train_tag_model, evaluate_tag_model
+    return train, evaluate
+
+
+def fit(
+    model,
+    dataset,
+    classifier_type,
+    epochs,
+    learning_rate,
+    l2_regularization,
+    on_improvement=None,
+    verbose=True,
+    patience=PATIENCE,
+    max_minutes=None,
+    max_steps=None,
+):
+    """
+    Train a model on the train iterator of the dataset and evaluate it on the
+    test iterator after every epoch, until the epochs run out or the
+    TrainingControl stops it
+    Input:
+        on_improvement: callable -> Called with the model whenever the test
+            loss improves, train.py saves its bundle there
+        verbose: bool -> Print the metrics of every epoch
+        patience, max_minutes, max_steps -> Passed to TrainingControl
+    Output:
+        best: dict -> Test metrics of the epoch with the lowest test loss, the
+            number of that epoch and the stop cause of the run
+    """
+    criterion = nn.CrossEntropyLoss().to(device)
+    optimizer = build_optimizer(model, learning_rate, l2_regularization)
+    control = TrainingControl(optimizer, patience, max_minutes, max_steps)
+
+    train_epoch, evaluate_epoch = epoch_functions(model, classifier_type)
+
+    best = None
+
+    for epoch in range(int(epochs)):
+
+        start_time = time.time()
+
+        train_metrics = train_epoch(
+            model, dataset.train_iterator, optimizer, criterion, control
+        )
+        test_metrics = evaluate_epoch(model, dataset.test_iterator, criterion)
+
+        end_time = time.time()
+
+        epoch_mins, epoch_secs = epoch_time(start_time, end_time)
+
+        stop = control.epoch_finished(test_metrics["loss"])
+        if control.improved or best is None:
+            best = dict(test_metrics, epoch=epoch + 1)
+            if on_improvement is not None:
+                on_improvement(model)
+
+        if verbose:
+            train_loss, train_acc = train_metrics["loss"], train_metrics["accuracy"]
+            test_loss, test_acc = test_metrics["loss"], test_metrics["accuracy"]
+
+            print(f"Epoch: {epoch+1:02} | Epoch Time: {epoch_mins}m {epoch_secs}s")
+            print(f"\tTrain Loss: {train_loss:.3f} | Train Acc: {train_acc*100:.2f}%")
+            print(f"\t Val. Loss: {test_loss:.3f} |  Val. Acc: {test_acc*100:.2f}%")
+            print(
+                f"\t Train. Macro F1: {train_metrics['macro_f1']:.2f} |  Val. Macro F1: {test_metrics['macro_f1']:.2f}"
+            )
+            for name, metrics in test_metrics.get("tasks", {}).items():
+                print(
+                    f"\t Val. {name} Acc: {metrics['accuracy']*100:.2f}% |  Val. {name} Macro F1: {metrics['macro_f1']:.2f}"
+                )
+            if "joint_accuracy" in test_metrics:
+                print(f"\t Val. Joint Acc: {test_metrics['joint_accuracy']*100:.2f}%")
+            first_label = getattr(model, "labels", ["label"])[0]
+            for label, precision, recall in zip(
+                getattr(dataset, first_label).vocab.itos,
+                test_metrics["precision"],
+                test_metrics["recall"],
+            ):
+                logger.debug(
+                    "Val. {}: Precision {:.2f} | Recall {:.2f}".format(
+                        label, precision, recall
+                    )
+                )
+
+        if stop:
+            break
+
+    control.finished()
+    best["stop_cause"] = control.stop_cause or "all epochs ran"
+    return best
+
+
+def cross_validate(args):
+    """Run the k-fold cross validation of the configuration of the arguments"""
+    # crossvalidate imports this module for fit
+    from crossvalidate import SUMMARY_COLUMNS, run_kfold
+
+    config = dict(
+        TRIAL_DEFAULTS,
+        model=args.model,
+        embedding_dim=args.embedding_dim,
+        hidden_dim=args.hidden_dim,
+        n_layers=args.n_layers,
+        bidirectional=args.bidirectional,
+        dropout=args.dropout,
+        linear_hidden_dim=args.linear_hidden_dim,
+        labels=args.labels,
+        label_weights=args.label_weights,
+        learning_rate=args.learning_rate,
+        l2_regularization=args.l2_regularization,
+        batch_size=args.batch_size,
+        freeze_embeddings=args.freeze_embeddings,
+        sparse_embeddings=args.sparse_embeddings,
+        patience=args.patience,
+        seed=args.seed,
+    )
+    workers = args.workers or max(1, min(args.kfold, os.cpu_count()))
+    threads = max(1, os.cpu_count() // workers)
+    location = os.path.join(
+        CROSSVALIDATION_FOLDER,
+        "{}-{}-k{}.tsv".format(args.model, args.tag, args.kfold),
+    )
+
+    rows, summary = run_kfold(
+        config, args.tag, args.epochs, args.kfold, workers, threads, location
+    )
+
+    print("{:<10}{:>10}{:>10}{:>10}".format("Fold", "Loss", "Acc", "Macro F1"))
+    for row in rows:
+        print(
+            "{:<10}{:>10.4f}{:>10.4f}{:>10.4f}".format(
+                row["fold"], row["loss"], row["accuracy"], row["macro_f1"]
+            )
+        )
+    print(
+        "{:<10}{:>10}{:>10}{:>10}".format(
+            "Mean",
+            *["{:.4f}".format(summary[column][0]) for column in SUMMARY_COLUMNS]
+        )
+    )
+    print(
+        "{:<10}{:>10}{:>10}{:>10}".format(
+            "Std",
+            *["{:.4f}".format(summary[column][1]) for column in SUMMARY_COLUMNS]
+        )
+    )
+    logger.info("Results written to {}".format(location))
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Utility to train the Model")
@@ -261,6 +358,14 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "-se",
+        "--sparse-embeddings",
+        default=SPARSE_EMBEDDINGS,
+        help="Train unfrozen embeddings with sparse gradients and SparseAdam",
+        type=int,
+    )
+
     parser.add_argument(
         "-t",
         "--tag",
@@ -301,82 +406,149 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "-p",
+        "--patience",
+        default=PATIENCE,
+        help="Epochs without validation improvement before stopping, 0 disables",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-minutes",
+        default=None,
+        help="Stop training once this many minutes have passed",
+        type=float,
+    )
+    parser.add_argument(
+        "--max-steps",
+        default=None,
+        help="Stop training after this many optimizer steps",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--labels",
+        default=LABELS,
+        nargs="+",
+        choices=["label", "subsection"],
+        help="Labels to predict, several train one shared encoder with a head each",
+    )
+    parser.add_argument(
+        "--label-weights",
+        default=LABEL_WEIGHTS,
+        nargs="+",
+        help="Weight of every label in the joint loss, defaults to 1 for each",
+        type=float,
+    )
+    parser.add_argument(
+        "-k",
+        "--kfold",
+        default=None,
+        help="Cross validate over K stratified folds of the train and test examples",
+        type=int,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=None,
+        help="Folds trained at once with --kfold, defaults to K up to the core count",
+        type=int,
+    )
+
     args = parser.parse_args()
 
     seed_all(args.seed)
     logger.debug(args)
     logger.debug("Custom seed set with: {}".format(args.seed))
 
-    logger.info("Loading Dataset")
-
-    if args.tag == "multi":
-        dataset = GrammarDasetMultiTag.get_iterators(args.batch_size)
+    if args.kfold:
+        if args.model_location:
+            parser.error("--kfold trains new models, it can not be combined with -loc")
+        cross_validate(args)
     else:
-        dataset = GrammarDasetAnswerTag.get_iterators(args.batch_size)
+        # Only the threads of the CPU profile, its batch size is tuned for inference
+        apply_profile(args.model_location or args.model)
 
-    logger.info("Dataset Loaded Successfully")
+        bundle = None
+        if args.model_location and os.path.isdir(args.model_location):
+            # A bundle keeps training on the dataset it was trained on
+            bundle = load_bundle(args.model_location)
+            args.tag = bundle[2]["dataset"]
 
-    if args.model_location:
-        model = torch.load(args.model_location)
-    else:
-        model = initialize_new_model(
-            args.model,
-            dataset,
-            args.embedding_dim,
-            args.hidden_dim,
-            args.n_layers,
-            args.bidirectional,
-            args.dropout,
-            args.freeze_embeddings,
-            args.tag,
-            args.linear_hidden_dim,
-        )
-
-    criterion = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(
-        model.parameters(), lr=LR, weight_decay=args.l2_regularization
-    )
-
-    model = model.to(device)
-    criterion = criterion.to(device)
-
-    logger.info(model)
-
-    if not os.path.exists(TRAINED_CLASSIFIER_FOLDER):
-        os.mkdir(TRAINED_CLASSIFIER_FOLDER)
-
-    best_test_loss = float("inf")
-
-    for epoch in range(int(args.epochs)):
-
-        start_time = time.time()
-        if args.model == "RNNFieldClassifer":
-            train_loss, train_acc = train_tag_model(
-                model, dataset.train_iterator, optimizer, criterion, dataset.tags
-            )
-            test_loss, test_acc = evaluate_tag_model(
-                model, dataset.test_iterator, criterion, dataset.tags
-            )
+        logger.info("Loading Dataset")
 
+        if args.tag == "multi":
+            dataset = GrammarDasetMultiTag.get_iterators(args.batch_size)
         else:
-            train_loss, train_acc = train(
-                model, dataset.train_iterator, optimizer, criterion, args.tag
+            dataset = GrammarDasetAnswerTag.get_iterators(args.batch_size)
+
+        logger.info("Dataset Loaded Successfully")
+
+        hyperparameters = {
+            "embedding_dim": args.embedding_dim,
+            "hidden_dim": args.hidden_dim,
+            "n_layers": args.n_layers,
+            "bidirectional": args.bidirectional,
+            "dropout": args.dropout,
+            "n_filters": CNN_N_FILTER,
+            "filter_sizes": CNN_FILTER_SIZES,
+            "linear_hidden_dim": args.linear_hidden_dim,
+            "labels": args.labels,
+            "label_weights": args.label_weights,
+        }
+
+        if bundle is not None:
+            # Keep training the classifier of a bundle with its own hyperparameters
+            model, bundle_dataset, meta = bundle
+            for name in dataset.vocab_fields:
+                if (
+                    getattr(bundle_dataset, name).vocab.itos
+                    != getattr(dataset, name).vocab.itos
+                ):
+                    parser.error(
+                        "The {} vocabulary of the bundle does not match the "
+                        "compiled {} dataset".format(name, args.tag)
+                    )
+            args.model, hyperparameters = meta["classifier"], meta["hyperparameters"]
+            # Bundles are rebuilt with every parameter trainable
+            set_embedding_training(
+                model, args.freeze_embeddings, args.sparse_embeddings
             )
-            test_loss, test_acc = evaluate(
-                model, dataset.test_iterator, criterion, args.tag
+        elif args.model_location:
+            model = torch.load(args.model_location)
+            set_embedding_training(model, None, args.sparse_embeddings)
+        else:
+            model = initialize_new_model(
+                args.model,
+                dataset,
+                hyperparameters,
+                args.freeze_embeddings,
+                args.sparse_embeddings,
             )
 
-        end_time = time.time()
+        model = model.to(device)
 
-        epoch_mins, epoch_secs = epoch_time(start_time, end_time)
+        logger.info(model)
 
-        if test_loss < best_test_loss:
-            best_test_loss = test_loss
-            torch.save(
-                model,
-                os.path.join(TRAINED_CLASSIFIER_FOLDER, TRAINED_CLASSIFIER_RNNHIDDEN),
-            )
+        if not os.path.exists(TRAINED_CLASSIFIER_FOLDER):
+            os.mkdir(TRAINED_CLASSIFIER_FOLDER)
 
-        print(f"Epoch: {epoch+1:02} | Epoch Time: {epoch_mins}m {epoch_secs}s")
-        print(f"\tTrain Loss: {train_loss:.3f} | Train Acc: {train_acc*100:.2f}%")
-        print(f"\t Val. Loss: {test_loss:.3f} |  Val. Acc: {test_acc*100:.2f}%")
+        fit(
+            model,
+            dataset,
+            args.model,
+            args.epochs,
+            args.learning_rate,
+            args.l2_regularization,
+            on_improvement=lambda model: save_bundle(
+                os.path.join(TRAINED_CLASSIFIER_FOLDER, args.model),
+                model,
+                args.model,
+                hyperparameters,
+                dataset,
+                args.tag,
+            ),
+            patience=args.patience,
+            max_minutes=args.max_minutes,
+            max_steps=args.max_steps,
+        )
@@ -0,0 +1,132 @@
+"""
+Stopping and learning rate control of the training loops
+
+Training stops when the validation loss has not improved for `patience`
+epochs, when the wall clock or optimizer step budget is spent or when every
+epoch has run, the cause is logged. The learning rate is reduced whenever the
+validation loss plateaus for `lr_patience` epochs, so it is lowered before
+training is stopped.
+"""
+
+import logging
+import time
+
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+
+from config.hyperparameters import LR_FACTOR, LR_PATIENCE, MIN_DELTA, MIN_LR, PATIENCE
+from config.root import LOGGING_FORMAT, LOGGING_LEVEL
+
+# Initialize logger for this file
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=LOGGING_LEVEL, format=LOGGING_FORMAT)
+
+
+class TrainingControl:
+    """
+    Tracks the validation loss, the elapsed time and the optimizer steps of a
+    training run
+    Input:
+        optimizer: torch.optim.Optimizer -> Optimizer whose learning rate is
+            reduced, one holding several in optimizers reduces all of them
+        patience: int -> Epochs without improvement before stopping, 0 disables
+        max_minutes: float -> Wall clock budget of the run, None disables
+        max_steps: int -> Optimizer step budget of the run, None disables
+    """
+
+    def __init__(
+        self,
+        optimizer,
+        patience=PATIENCE,
+        max_minutes=None,
+        max_steps=None,
+        lr_patience=LR_PATIENCE,
+        lr_factor=LR_FACTOR,
+        min_lr=MIN_LR,
+        min_delta=MIN_DELTA,
+    ):
+        self.optimizer = optimizer
+        self.schedulers = [
+            ReduceLROnPlateau(
+                inner_optimizer,
+                mode="min",
+                factor=lr_factor,
+                patience=lr_patience,
+                min_lr=min_lr,
+                threshold=min_delta,
+                threshold_mode="abs",
+            )
+            for inner_optimizer in getattr(optimizer, "optimizers", [optimizer])
+        ]
+        self.patience = patience
+        self.max_seconds = max_minutes * 60 if max_minutes else None
+        self.max_steps = max_steps
+        self.min_delta = min_delta
+
+        self.start_time = time.time()
+        self.steps = 0
+        self.epochs = 0
+        self.best_loss = float("inf")
+        self.bad_epochs = 0
+        self.improved = False
+        self.stop_cause = None
+
+    def learning_rates(self):
+        return [group["lr"] for group in self.optimizer.param_groups]
+
+    def out_of_budget(self):
+        """Sets the stop cause once the time or step budget is spent"""
+        if self.max_steps is not None and self.steps >= self.max_steps:
+            self.stop_cause = "step budget of {} spent".format(self.max_steps)
+        elif (
+            self.max_seconds is not None
+            and time.time() - self.start_time >= self.max_seconds
+        ):
+            self.stop_cause = "time budget of {:g} minutes spent".format(
+                self.max_seconds / 60
+            )
+        return self.stop_cause is not None
+
+    def step(self):
+        """Count an optimizer step, returns True when the epoch should end early"""
+        self.steps += 1
+        return self.out_of_budget()
+
+    def epoch_finished(self, loss):
+        """
+        Record the validation loss of an epoch, sets improved and returns True
+        when training should stop
+        """
+        self.epochs += 1
+        self.improved = loss < self.best_loss - self.min_delta
+        if self.improved:
+            self.best_loss = loss
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+
+        learning_rates = self.learning_rates()
+        for scheduler in self.schedulers:
+            scheduler.step(loss)
+        if self.learning_rates() != learning_rates:
+            logger.info(
+                "Validation loss plateaued, learning rate reduced to {}".format(
+                    ", ".join("{:.2e}".format(lr) for lr in self.learning_rates())
+                )
+            )
+
+        if self.out_of_budget():
+            return True
+        if self.patience and self.bad_epochs >= self.patience:
+            self.stop_cause = "no improvement for {} epochs".format(self.patience)
+        return self.stop_cause is not None
+
+    def finished(self):
+        """Log why the run ended"""
+        logger.info(
+            "Training stopped after {} epochs, {} steps and {:.1f}s: {}".format(
+                self.epochs,
+                self.steps,
+                time.time() - self.start_time,
+                self.stop_cause or "all epochs ran",
+            )
+        )
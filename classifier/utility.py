@@ -2,14 +2,27 @@
 Utility methods to be used for training and dataloading purposes
 """
 
+import hashlib
+import json
+import os
+import pickle
+import re
 import time
 
 import spacy
-import torch
+from spacy.symbols import ORTH
 
-from sklearn.metrics import confusion_matrix
+from config.data import TEMP_DIR
+from config.root import SPACY_MODEL, TOKENIZER_BATCH_SIZE
 
-nlp = spacy.load("en")
+# Bump whenever the tokenization rules change to invalidate the token cache
+TOKENIZER_VERSION = 1
+SPECIAL_TOKENS = ["<blank>", "<slash>", "<Q>", "</Q>", "<K>", "</K>", "<A>", "</A>"]
+SPECIAL_TOKENS_REGEX = re.compile(
+    "({})".format("|".join(re.escape(token) for token in SPECIAL_TOKENS))
+)
+# Only token.text is used, the rest of the pipeline is dead weight
+SPACY_DISABLED_COMPONENTS = ["tagger", "parser", "ner"]
 
 
 def epoch_time(start_time, end_time):
@@ -19,61 +32,148 @@ def epoch_time(start_time, end_time):
     return elapsed_mins, elapsed_secs
 
 
-def tokenizer(text):
-    results = []
-    text = text.replace("<blank>", " BLANKK ")
-    text = text.replace("<slash>", " SLASHH ")
-    text = text.replace("<Q>", " QSTARTIT ")
-    text = text.replace("</Q>", " QENDIT ")
-    text = text.replace("<K>", " KSTARTIT ")
-    text = text.replace("</K>", " KENDIT ")
-    text = text.replace("<A>", " ASTARTIT ")
-    text = text.replace("</A>", " AENDIT ")
-    for token in nlp(text):
-        if token.text == "BLANKK":
-            results.append("<blank>")
-        elif token.text == "SLASHH":
-            results.append("<slash>")
-        elif token.text == "QSTARTIT":
-            results.append("<Q>")
-        elif token.text == "QENDIT":
-            results.append("</Q>")
-        elif token.text == "KSTARTIT":
-            results.append("<K>")
-        elif token.text == "KENDIT":
-            results.append("</K>")
-        elif token.text == "ASTARTIT":
-            results.append("<A>")
-        elif token.text == "AENDIT":
-            results.append("</A>")
-        else:
-            results.append(token.text)
-
-    return results
-
-
-def categorical_accuracy(preds, y):
+class BatchTokenizer:
     """
-    Returns accuracy per batch
+    spaCy tokenizer which runs only the tokenizer of the pipeline, treats the
+    dataset tags (<blank>, <slash>, <Q> ... </A>) as special cases and
+    tokenizes whole columns at once with nlp.pipe. Tokens are memoized by the
+    hash of the text and persisted in cache_dir, the cache file is tied to the
+    spaCy model version and the special token rules so it invalidates itself
     """
-    max_preds = preds.argmax(dim=1, keepdim=True)
-    correct = max_preds.squeeze(1).eq(y)
-    return correct.sum() / torch.FloatTensor([y.shape[0]])
+
+    def __init__(self, model_name, batch_size, cache_dir):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_dir = cache_dir
+        self._nlp = None
+        self._signature = None
+        self._tokens = None
+        self.unsaved = 0
+
+    @property
+    def nlp(self):
+        """spaCy is loaded only when the cache misses"""
+        if self._nlp is None:
+            self._nlp = spacy.load(self.model_name, disable=SPACY_DISABLED_COMPONENTS)
+            for special_token in SPECIAL_TOKENS:
+                self._nlp.tokenizer.add_special_case(
+                    special_token, [{ORTH: special_token}]
+                )
+        return self._nlp
+
+    @property
+    def signature(self):
+        """Hash of everything that changes the output of the tokenizer"""
+        if self._signature is None:
+            self._signature = self.spec_hash()
+        return self._signature
+
+    def spec_hash(self):
+        spec = {
+            "version": TOKENIZER_VERSION,
+            "spacy": spacy.__version__,
+            "model": self.model_name,
+            "model_version": spacy.info(self.model_name, silent=True)["version"],
+            "special_tokens": SPECIAL_TOKENS,
+        }
+        return hashlib.blake2b(
+            json.dumps(spec, sort_keys=True).encode("utf8"), digest_size=8
+        ).hexdigest()
+
+    @property
+    def cache_location(self):
+        return os.path.join(self.cache_dir, "tokens-{}.pickle".format(self.signature))
+
+    @property
+    def tokens(self):
+        """Text hash -> tokens, read from the disk cache on first access"""
+        if self._tokens is None:
+            self._tokens = {}
+            if os.path.exists(self.cache_location):
+                with open(self.cache_location, "rb") as cache_file:
+                    self._tokens = pickle.load(cache_file)
+        return self._tokens
+
+    def save(self):
+        """Write the cache back to disk if something new was tokenized"""
+        if not self.unsaved:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Written under a temporary name first so concurrent or interrupted
+        # runs never leave a truncated cache behind
+        partial_location = "{}.{}.partial".format(self.cache_location, os.getpid())
+        with open(partial_location, "wb") as cache_file:
+            pickle.dump(self.tokens, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial_location, self.cache_location)
+        self.unsaved = 0
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.blake2b(text.encode("utf8"), digest_size=16).digest()
+
+    @staticmethod
+    def separate_special_tokens(text):
+        """Surround every special token with spaces so spaCy sees it as a word"""
+        return SPECIAL_TOKENS_REGEX.sub(r" \1 ", text)
+
+    def pipe(self, texts):
+        """Tokenize an iterable of strings in batches and memoize the results"""
+        texts = {self.text_hash(text): text for text in texts}
+        keys = [key for key in texts if key not in self.tokens]
+        if not keys:
+            return 0
+
+        docs = self.nlp.pipe(
+            (self.separate_special_tokens(texts[key]) for key in keys),
+            batch_size=self.batch_size,
+        )
+        for key, doc in zip(keys, docs):
+            self.tokens[key] = tuple(token.text for token in doc)
+
+        self.unsaved += len(keys)
+        return len(keys)
+
+    def tokenize(self, texts):
+        """
+        Tokens of every text in order, misses are tokenized in batches but not
+        memoized so streaming large inputs does not grow the cache
+        """
+        keys = [self.text_hash(text) for text in texts]
+        missing = [text for key, text in zip(keys, texts) if key not in self.tokens]
+        docs = iter(
+            self.nlp.pipe(
+                map(self.separate_special_tokens, missing), batch_size=self.batch_size
+            )
+            if missing
+            else []
+        )
+        return [
+            list(self.tokens[key])
+            if key in self.tokens
+            else [token.text for token in next(docs)]
+            for key in keys
+        ]
+
+    def __call__(self, text):
+        key = self.text_hash(text)
+        if key not in self.tokens:
+            self.tokens[key] = tuple(
+                token.text for token in self.nlp(self.separate_special_tokens(text))
+            )
+            self.unsaved += 1
+
+        return list(self.tokens[key])
+
+
+tokenizer = BatchTokenizer(SPACY_MODEL, TOKENIZER_BATCH_SIZE, TEMP_DIR)
 
 
-def precision_recall_f1(preds, y):
+def categorical_accuracy(preds, y):
     """
     Returns accuracy per batch
     """
     max_preds = preds.argmax(dim=1, keepdim=True)
     correct = max_preds.squeeze(1).eq(y)
-    return correct.sum() / torch.FloatTensor([y.shape[0]])
-
-
-def other_evaluations(preds, y):
-    """
-    Returns F1, Precision and Recall for the batch
-    """
-    preds = preds.argmax(dim=1, keepdim=True)
-
-    print(confusion_matrix(preds.cpu().detach().numpy(), y.cpu().detach().numpy()))
+    return correct.float().mean()